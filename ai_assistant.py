@@ -1,38 +1,126 @@
 import os
+import json
 import asyncio
-import requests
 import time
+import httpx
+from collections import OrderedDict
+from ai_cache import advice_cache
+from metrics import metrics
 
 GEMINI_KEY = os.environ.get("GEMINI_API_KEY")
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+AI_MEMORY_USERS = int(os.environ.get("AI_MEMORY_USERS", "500"))
+AI_TIMEOUT = float(os.environ.get("AI_TIMEOUT", "25"))
+AI_DEADLINE = float(os.environ.get("AI_DEADLINE", "40"))
+AI_MAX_CONNECTIONS = int(os.environ.get("AI_MAX_CONNECTIONS", "10"))
+AI_MODELS_TTL = float(os.environ.get("AI_MODELS_TTL", "3600"))
+AI_COOLDOWN_429 = float(os.environ.get("AI_COOLDOWN_429", "60"))
+AI_COOLDOWN_5XX = float(os.environ.get("AI_COOLDOWN_5XX", "15"))
+AI_BREAKER_THRESHOLD = int(os.environ.get("AI_BREAKER_THRESHOLD", "3"))
+# Hedged request: gửi song song tới 2 model khỏe nhất, lấy kết quả về trước
+AI_HEDGE = os.environ.get("AI_HEDGE", "0") == "1"
+AI_HEDGE_DELAY = float(os.environ.get("AI_HEDGE_DELAY", "2"))
+
+FALLBACK_MODELS = ["models/gemini-1.5-flash", "models/gemini-2.0-flash", "models/gemini-1.5-pro"]
+BUSY_REPLY = "❌ Hiện tại tất cả model Gemini đều đang bận hoặc hết hạn mức. Vui lòng thử lại sau vài phút."
+STREAM_CUT_SUFFIX = "\n\n❌ Kết nối tới Gemini bị ngắt giữa chừng, câu trả lời chưa đầy đủ. Vui lòng hỏi lại."
+
+
+class ModelError(Exception):
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"HTTP {status}")
+        self.status, self.retry_after = status, retry_after
+
+
+class ModelHealth:
+    """Circuit breaker cho 1 model: 429 thì nghỉ theo Retry-After, lỗi 5xx/timeout liên tiếp thì ngắt có backoff"""
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+
+    def available(self, now):
+        return now >= self.open_until
+
+    def record_success(self):
+        self.failures = 0; self.open_until = 0.0
+
+    def record_failure(self, status, retry_after=None, now=None):
+        now = now or time.monotonic()
+        if status == 429:
+            self.open_until = now + (retry_after or AI_COOLDOWN_429)
+            return
+        self.failures += 1
+        if self.failures >= AI_BREAKER_THRESHOLD:
+            backoff = AI_COOLDOWN_5XX * (2 ** min(self.failures - AI_BREAKER_THRESHOLD, 5))
+            self.open_until = now + backoff
+
 
 class PortfolioAI:
     def __init__(self):
         self.api_key = GEMINI_KEY
-        self.chat_history = []
+        # Trí nhớ hội thoại riêng cho từng chat (LRU, giới hạn số người dùng giữ trong RAM)
+        self.histories = OrderedDict()
         self.available_models = []
+        self._models_at = 0.0
+        self._models_lock = None
+        self.health = {}
+        self._client = None
+        self.cache = advice_cache
+
+    def get_history(self, user_id):
+        history = self.histories.setdefault(user_id, [])
+        self.histories.move_to_end(user_id)
+        while len(self.histories) > AI_MEMORY_USERS: self.histories.popitem(last=False)
+        return history
+
+    def clear_history(self, user_id):
+        self.histories.pop(user_id, None)
 
-    def fetch_available_models(self):
+    # --- HTTP CLIENT DÙNG CHUNG (keep-alive) ---
+    @property
+    def client(self):
+        if self._client is None or self._client.is_closed:
+            limits = httpx.Limits(max_connections=AI_MAX_CONNECTIONS, max_keepalive_connections=AI_MAX_CONNECTIONS, keepalive_expiry=120)
+            self._client = httpx.AsyncClient(base_url=GEMINI_BASE_URL, limits=limits, timeout=httpx.Timeout(AI_TIMEOUT, connect=5))
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None: await self._client.aclose(); self._client = None
+
+    # --- DANH SÁCH MODEL (cache có TTL) ---
+    async def fetch_available_models(self):
         """Lấy danh sách các model thực tế mà API Key của bạn được phép dùng"""
         try:
-            url = f"https://generativelanguage.googleapis.com/v1beta/models?key={self.api_key}"
-            res = requests.get(url, timeout=10)
+            res = await self.client.get("/models", params={"key": self.api_key}, timeout=10)
             if res.status_code == 200:
                 models = res.json().get('models', [])
                 # Ưu tiên các model Flash vì tốc độ nhanh và hạn mức cao
-                flash_models = [m['name'] for m in models if 'generateContent' in m['supportedGenerationMethods'] and 'flash' in m['name']]
-                other_models = [m['name'] for m in models if 'generateContent' in m['supportedGenerationMethods'] and 'flash' not in m['name']]
-                return flash_models + other_models
-        except: pass
+                flash_models = [m['name'] for m in models if 'generateContent' in m.get('supportedGenerationMethods', []) and 'flash' in m['name']]
+                other_models = [m['name'] for m in models if 'generateContent' in m.get('supportedGenerationMethods', []) and 'flash' not in m['name']]
+                if flash_models or other_models: return flash_models + other_models
+        except (httpx.HTTPError, ValueError, KeyError): pass
         # Fallback nếu không lấy được danh sách
-        return ["models/gemini-1.5-flash", "models/gemini-2.0-flash", "models/gemini-1.5-pro"]
+        return None
 
-    async def get_advice(self, user_query, full_asset_data):
-        if not self.api_key: return "❌ Lỗi: Thiếu GEMINI_API_KEY trong biến môi trường."
-        
-        # Cập nhật danh sách model nếu trống
-        if not self.available_models:
-            self.available_models = self.fetch_available_models()
+    async def get_models(self):
+        if self.available_models and time.monotonic() - self._models_at < AI_MODELS_TTL: return self.available_models
+        if self._models_lock is None: self._models_lock = asyncio.Lock()
+        async with self._models_lock:
+            if self.available_models and time.monotonic() - self._models_at < AI_MODELS_TTL: return self.available_models
+            models = await self.fetch_available_models()
+            # Lỗi mạng: dùng danh sách cũ (nếu có) và thử lại sớm hơn thay vì chờ hết TTL
+            self.available_models = models or self.available_models or FALLBACK_MODELS
+            self._models_at = time.monotonic() if models else time.monotonic() - AI_MODELS_TTL + 60
+        return self.available_models
 
+    def healthy_models(self, models):
+        now = time.monotonic()
+        healthy = [m for m in models if self.health.setdefault(m, ModelHealth()).available(now)]
+        # Tất cả đều đang nghỉ: chỉ thử model sắp hồi phục nhất thay vì dò cả danh sách
+        return healthy or sorted(models, key=lambda m: self.health[m].open_until)[:1]
+
+    def build_contents(self, user_query, full_asset_data, user_id):
         system_context = (
             f"dữ liệu tài sản hiện tại: {full_asset_data}\n"
             f"nhiệm vụ: tư vấn tối ưu tương lai. tập trung vào tái cơ cấu tỷ trọng để giảm rủi ro và đạt mục tiêu nhanh nhất. "
@@ -41,34 +129,119 @@ class PortfolioAI:
             f"câu hỏi: {user_query}"
         )
 
-        if len(self.chat_history) > 4: self.chat_history = self.chat_history[-4:]
-        api_contents = self.chat_history.copy()
+        chat_history = self.get_history(user_id)
+        if len(chat_history) > 4: del chat_history[:-4]
+        api_contents = chat_history.copy()
         api_contents.append({"role": "user", "parts": [{"text": system_context}]})
+        return chat_history, api_contents
 
-        def try_all_models():
-            # Thử lần lượt các model trong danh sách khả dụng
-            for model_path in self.available_models:
-                url = f"https://generativelanguage.googleapis.com/v1beta/{model_path}:generateContent?key={self.api_key}"
-                try:
-                    res = requests.post(url, json={"contents": api_contents, "generationConfig": {"temperature": 0.5}}, timeout=25)
-                    
-                    if res.status_code == 200:
-                        data = res.json()
-                        if 'candidates' in data and data['candidates'][0]['content']['parts'][0]['text']:
-                            return data['candidates'][0]['content']['parts'][0]['text']
-                    
-                    # Nếu gặp lỗi 429 (hết lượt) hoặc các lỗi khác, chuyển sang model tiếp theo
-                    continue 
-                except:
-                    continue
-            return "❌ Hiện tại tất cả model Gemini đều đang bận hoặc hết hạn mức. Vui lòng thử lại sau vài phút."
-
-        ai_reply = await asyncio.to_thread(try_all_models)
-        
-        if not ai_reply.startswith("❌"):
-            self.chat_history.append({"role": "user", "parts": [{"text": user_query}]})
-            self.chat_history.append({"role": "model", "parts": [{"text": ai_reply}]})
-        return ai_reply
+    # --- STREAMING (SSE): trả từng đoạn text ngay khi model sinh ra ---
+    async def _stream_model(self, model_path, api_contents):
+        health = self.health.setdefault(model_path, ModelHealth())
+        t, first = time.perf_counter(), True
+        with metrics.timer('ai_request_seconds', model=model_path, mode='stream'):
+            async with self.client.stream("POST", f"/{model_path}:streamGenerateContent", params={"key": self.api_key, "alt": "sse"},
+                                          json={"contents": api_contents, "generationConfig": {"temperature": 0.5}}) as res:
+                if res.status_code != 200:
+                    retry_after = res.headers.get("retry-after")
+                    health.record_failure(res.status_code, float(retry_after) if retry_after and retry_after.isdigit() else None)
+                    raise ModelError(res.status_code)
+                async for line in res.aiter_lines():
+                    if not line.startswith("data:"): continue
+                    try:
+                        candidates = json.loads(line[5:]).get('candidates') or [{}]
+                    except ValueError:
+                        continue
+                    for part in candidates[0].get('content', {}).get('parts', []):
+                        if part.get('text'):
+                            if first: first = False; metrics.observe('ai_first_token_seconds', time.perf_counter() - t, model=model_path)
+                            yield part['text']
+        health.record_success()
 
-portfolio_ai = PortfolioAI()
+    async def _pump(self, model_path, api_contents, queue):
+        """Chạy stream của 1 model trong task riêng, đẩy (model, đoạn text) vào queue; kết thúc bằng (model, None) hoặc (model, lỗi)"""
+        try:
+            async for chunk in self._stream_model(model_path, api_contents):
+                await queue.put((model_path, chunk))
+        except (ModelError, httpx.HTTPError) as e:
+            if isinstance(e, httpx.HTTPError): self.health[model_path].record_failure(None)
+            await queue.put((model_path, e)); return
+        await queue.put((model_path, None))
+
+    async def _stream_models(self, api_contents):
+        """Sinh các đoạn text từ model đầu tiên trả được token, trong tổng hạn AI_DEADLINE.
+
+        Thử lần lượt các model còn khỏe (AI_HEDGE: từng cặp, model thứ 2 chạy sau AI_HEDGE_DELAY giây
+        nếu model đầu chưa có token). Đã có token thì bám model đó; đứt giữa chừng thì raise ModelError,
+        hết hạn thì raise asyncio.TimeoutError. Không model nào trả token thì kết thúc mà không sinh gì."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + AI_DEADLINE
+        models = self.healthy_models(await self.get_models())
+        step = 2 if AI_HEDGE else 1
+        for i in range(0, len(models), step):
+            queue, waiting, tasks, winner = asyncio.Queue(), list(models[i:i + step]), {}, None
+            try:
+                # Giai đoạn 1: chờ token đầu tiên, khởi động model dự phòng khi quá AI_HEDGE_DELAY hoặc model trước đã lỗi
+                while winner is None:
+                    if not tasks:
+                        if not waiting: break
+                        model_path = waiting.pop(0)
+                        tasks[model_path] = asyncio.create_task(self._pump(model_path, api_contents, queue))
+                    remaining = deadline - loop.time()
+                    if remaining <= 0: raise asyncio.TimeoutError
+                    try:
+                        model_path, item = await asyncio.wait_for(queue.get(), timeout=min(remaining, AI_HEDGE_DELAY) if waiting else remaining)
+                    except asyncio.TimeoutError:
+                        if not waiting: raise
+                        model_path = waiting.pop(0)
+                        tasks[model_path] = asyncio.create_task(self._pump(model_path, api_contents, queue))
+                        continue
+                    if isinstance(item, str):
+                        winner = model_path
+                        for other, t in tasks.items():
+                            if other != winner: t.cancel()
+                        yield item
+                    else:
+                        tasks.pop(model_path, None)
+                if winner is None: continue
+                # Giai đoạn 2: đọc tiếp luồng của model thắng tới hết, vẫn trong tổng hạn
+                while True:
+                    model_path, item = await asyncio.wait_for(queue.get(), timeout=max(deadline - loop.time(), 0))
+                    if model_path != winner: continue
+                    if item is None: return
+                    if not isinstance(item, str): raise ModelError(getattr(item, 'status', None))
+                    yield item
+            finally:
+                for t in tasks.values(): t.cancel()
 
+    async def stream_advice(self, user_query, full_asset_data, user_id=0):
+        """Async generator trả về các đoạn câu trả lời; tự chuyển model nếu lỗi trước khi có token đầu tiên, tổng thời gian giới hạn bởi AI_DEADLINE"""
+        if not self.api_key: yield "❌ Lỗi: Thiếu GEMINI_API_KEY trong biến môi trường."; return
+        chat_history, api_contents = self.build_contents(user_query, full_asset_data, user_id)
+        # Câu hỏi mở đầu hội thoại tương đương trên cùng ảnh chụp dữ liệu: trả ngay từ cache, không gọi model.
+        # Đã có lịch sử thì câu trả lời phụ thuộc các lượt trước nên không tra/ghi cache
+        cache_key = None if chat_history else self.cache.make_key(user_query, full_asset_data)
+        cached = await self.cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            self._remember(chat_history, user_query, cached)
+            yield cached; return
+
+        parts, failed = [], False
+        try:
+            async for chunk in self._stream_models(api_contents):
+                parts.append(chunk)
+                yield chunk
+        except (ModelError, asyncio.TimeoutError):
+            failed = True
+        if not parts: yield BUSY_REPLY; return
+        # Câu trả lời bị cắt giữa chừng: báo cho người dùng, không lưu vào lịch sử hay cache
+        if failed: yield STREAM_CUT_SUFFIX; return
+
+        self._remember(chat_history, user_query, "".join(parts))
+        if cache_key: await self.cache.put(cache_key, "".join(parts))
+
+    def _remember(self, chat_history, user_query, reply):
+        chat_history.append({"role": "user", "parts": [{"text": user_query}]})
+        chat_history.append({"role": "model", "parts": [{"text": reply}]})
+
+portfolio_ai = PortfolioAI()
@@ -0,0 +1,102 @@
+import os
+import re
+import time
+import sqlite3
+import asyncio
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from metrics import metrics
+
+AI_CACHE_TTL = float(os.environ.get("AI_CACHE_TTL", "21600"))
+AI_CACHE_SIZE = int(os.environ.get("AI_CACHE_SIZE", "1000"))
+# Đường dẫn file SQLite để cache sống qua lần khởi động lại (để trống = chỉ giữ trong RAM)
+AI_CACHE_DB = os.environ.get("AI_CACHE_DB", "")
+
+# Các từ đệm cuối câu không làm đổi ý hỏi
+FILLERS = {'ạ', 'nhé', 'nha', 'vậy', 'đi', 'ơi', 'không', 'ko', 'k', 'hả', 'thế'}
+
+
+def normalize_query(text):
+    """Chuẩn hóa câu hỏi: chữ thường, bỏ dấu câu/khoảng trắng thừa và từ đệm cuối câu"""
+    text = unicodedata.normalize('NFC', text).lower()
+    words = re.sub(r'[^\w\s%]', ' ', text).split()
+    while words and words[-1] in FILLERS: words.pop()
+    return ' '.join(words)
+
+
+class AdviceCache:
+    """Cache câu trả lời AI theo (câu hỏi đã chuẩn hóa, hash dữ liệu tài sản): TTL + LRU, tùy chọn lưu SQLite.
+    Chỉ dùng cho câu hỏi mở đầu hội thoại: câu trả lời khi đã có lịch sử phụ thuộc cả các lượt trước"""
+
+    def __init__(self, ttl=AI_CACHE_TTL, max_entries=AI_CACHE_SIZE, path=AI_CACHE_DB):
+        self.ttl, self.max_entries, self.path = ttl, max_entries, path
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @staticmethod
+    def make_key(query, context):
+        q = hashlib.sha256(normalize_query(query).encode()).hexdigest()[:32]
+        c = hashlib.sha256(context.encode()).hexdigest()[:32]
+        return f"{q}:{c}"
+
+    def _disk(self):
+        if not self.path: return None
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS advice_cache (key TEXT PRIMARY KEY, reply TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_advice_expires ON advice_cache (expires_at)")
+        return self._conn
+
+    def get_sync(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._mem.get(key)
+            if item is not None and item[0] > now:
+                self._mem.move_to_end(key); metrics.inc('ai_cache_total', result='hit')
+                return item[1]
+            if item is not None: del self._mem[key]
+            conn = self._disk()
+            row = conn.execute("SELECT reply, expires_at FROM advice_cache WHERE key = ? AND expires_at > ?", (key, now)).fetchone() if conn else None
+            if row is None:
+                metrics.inc('ai_cache_total', result='miss')
+                return None
+            self._remember(key, row[1], row[0]); metrics.inc('ai_cache_total', result='hit')
+            return row[0]
+
+    def put_sync(self, key, reply):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, expires_at, reply)
+            conn = self._disk()
+            if conn:
+                conn.execute("INSERT OR REPLACE INTO advice_cache (key, reply, expires_at) VALUES (?, ?, ?)", (key, reply, expires_at))
+                # Dọn bản hết hạn và giữ bảng trong giới hạn kích thước
+                conn.execute("DELETE FROM advice_cache WHERE expires_at <= ?", (time.time(),))
+                conn.execute("DELETE FROM advice_cache WHERE key IN (SELECT key FROM advice_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+                conn.commit()
+
+    def _remember(self, key, expires_at, reply):
+        self._mem[key] = (expires_at, reply); self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries: self._mem.popitem(last=False)
+
+    async def get(self, key):
+        # Chỉ chạm đĩa khi có backing SQLite, còn lại tra RAM ngay trên event loop
+        if not self.path: return self.get_sync(key)
+        return await asyncio.to_thread(self.get_sync, key)
+
+    async def put(self, key, reply):
+        if not self.path: return self.put_sync(key, reply)
+        await asyncio.to_thread(self.put_sync, key, reply)
+
+    def clear(self):
+        with self._lock:
+            self._mem.clear()
+            conn = self._disk()
+            if conn: conn.execute("DELETE FROM advice_cache"); conn.commit()
+
+
+advice_cache = AdviceCache()
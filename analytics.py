@@ -0,0 +1,115 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from db import db, data_version
+
+ANALYTICS_CACHE_USERS = int(os.environ.get("ANALYTICS_CACHE_USERS", "256"))
+
+
+def _group_cumsum(values, starts):
+    """cumsum reset tại mỗi vị trí starts[i] == True (starts[0] phải True).
+    Quét phân đoạn kiểu Hillis-Steele: log2(độ dài đoạn dài nhất) lượt cộng mảng, mỗi phần tử chỉ cộng với phần tử cùng đoạn.
+    Không trừ tổng lũy kế toàn cục nên đoạn có giá trị rất lớn (1/p khi vị thế bị bán dần) không làm mất độ chính xác của đoạn sau"""
+    out = np.array(values, dtype=float)
+    n = len(out)
+    pos = np.arange(n)
+    seg_start = np.maximum.accumulate(np.where(starts, pos, 0))
+    offset = pos - seg_start
+    k, longest = 1, int(offset.max()) + 1 if n else 0
+    while k < longest:
+        out[k:] += np.where(offset[k:] >= k, out[:-k], 0.0)
+        k *= 2
+    return out
+
+
+def compute_trade_metrics(ids, symbols, is_buy, qty, price, fee):
+    """Tính lãi/lỗ thực hiện cho từng lệnh bán theo giá vốn bình quân, hoàn toàn bằng phép toán mảng.
+
+    Mảng đầu vào phải sắp theo (symbol, id). Giá vốn sau lệnh i thỏa C_i = r_i * C_{i-1} + b_i
+    (r_i = Q_i/Q_{i-1} khi bán, b_i = tiền mua kể cả phí), giải bằng tích lũy trong từng đoạn vị thế."""
+    n = len(ids)
+    if n == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    signed = np.where(is_buy, qty, -qty)
+    sym_start = np.ones(n, dtype=bool); sym_start[1:] = symbols[1:] != symbols[:-1]
+    pos = _group_cumsum(signed, sym_start)
+    pos_prev = pos - signed
+    # Mỗi lần vị thế về 0 thì giá vốn làm lại từ đầu: tách thành các đoạn độc lập
+    seg_start = sym_start | (np.abs(pos_prev) < 1e-9)
+    sells = ~is_buy & (pos_prev > 1e-9)
+    ratio = np.ones(n)
+    np.divide(pos, pos_prev, out=ratio, where=sells & (pos > 1e-9))
+    log_p = _group_cumsum(np.log(ratio), seg_start)
+    p = np.exp(log_p)
+    buys_value = np.where(is_buy, qty * price + fee, 0.0)
+    cost = p * _group_cumsum(buys_value / p, seg_start)
+    cost_prev = np.zeros(n); cost_prev[1:] = cost[:-1]
+    cost_prev[seg_start] = 0.0
+    avg_cost = np.divide(cost_prev, pos_prev, out=np.zeros(n), where=pos_prev > 1e-9)
+    pnl = qty * price - fee - avg_cost * qty
+    return ids[sells], pnl[sells]
+
+
+def summarize(sell_ids, pnl, total_bought):
+    if len(pnl) == 0:
+        return {'trades': 0, 'realized_pnl': 0.0, 'win_rate': 0.0, 'profit_factor': None, 'max_drawdown': 0.0, 'max_drawdown_pct': 0.0}
+    order = np.argsort(sell_ids, kind='stable')
+    equity = np.cumsum(pnl[order])
+    peak = np.maximum.accumulate(np.concatenate(([0.0], equity)))[1:]
+    max_dd = float(np.max(peak - equity))
+    gross_win, gross_loss = float(pnl[pnl > 0].sum()), float(-pnl[pnl < 0].sum())
+    return {
+        'trades': int(len(pnl)),
+        'realized_pnl': float(equity[-1]),
+        'win_rate': float((pnl > 0).mean() * 100),
+        'profit_factor': (gross_win / gross_loss) if gross_loss > 0 else (float('inf') if gross_win > 0 else None),
+        'max_drawdown': max_dd,
+        # Sụt giảm lớn nhất của đường lãi/lỗ lũy kế, tính trên tổng vốn đã giải ngân
+        'max_drawdown_pct': (max_dd / total_bought * 100) if total_bought > 0 else 0.0,
+    }
+
+
+class AnalyticsEngine:
+    """Chỉ số hiệu suất giao dịch, cache theo phiên bản bảng stock_orders của từng người dùng"""
+
+    def __init__(self, max_users=ANALYTICS_CACHE_USERS):
+        self.max_users = max_users
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load_columns(conn, user_id):
+        rows = conn.execute("SELECT id, symbol, type, qty, price, fee FROM stock_orders WHERE user_id = ? ORDER BY symbol, id", (user_id,)).fetchall()
+        if not rows:
+            return None
+        ids, symbols, types, qty, price, fee = zip(*rows)
+        return (np.array(ids, dtype=np.int64), np.array(symbols), np.array(types) == 'Mua',
+                np.array(qty, dtype=float), np.array(price, dtype=float), np.nan_to_num(np.array(fee, dtype=float)))
+
+    def metrics(self, user_id, conn=None):
+        if conn is None:
+            with db.reader() as conn: return self.metrics(user_id, conn)
+        version = data_version(conn, user_id, 'orders')
+        with self._lock:
+            hit = self._cache.get(user_id)
+            if hit is not None and hit[0] == version:
+                self._cache.move_to_end(user_id)
+                return hit[1]
+        cols = self._load_columns(conn, user_id)
+        if cols is None:
+            result = summarize(np.empty(0), np.empty(0), 0)
+        else:
+            ids, symbols, is_buy, qty, price, fee = cols
+            sell_ids, pnl = compute_trade_metrics(ids, symbols, is_buy, qty, price, fee)
+            result = summarize(sell_ids, pnl, float((qty * price + fee)[is_buy].sum()))
+        with self._lock:
+            self._cache[user_id] = (version, result); self._cache.move_to_end(user_id)
+            while len(self._cache) > self.max_users: self._cache.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self._lock: self._cache.clear()
+
+
+analytics = AnalyticsEngine()
@@ -0,0 +1,176 @@
+import os
+import json
+import gzip
+import shutil
+import struct
+import sqlite3
+import hashlib
+import logging
+import datetime
+import tempfile
+from db import db
+from schema import SCHEMA_VERSION
+
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "backups")
+# Số bản full giữ lại (bản vi sai đi kèm bản full bị xóa theo)
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "7"))
+CHUNK = 1024 * 1024
+
+# Cột tối thiểu để init_db nâng cấp được (chấp nhận cả DB 1 người dùng cũ)
+REQUIRED_COLUMNS = {'transactions': {'id', 'category', 'type', 'amount', 'date'}, 'assets': {'category', 'current_value'}}
+
+
+class RestoreError(Exception):
+    pass
+
+
+def _stamp():
+    return datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+
+def temp_near(path, suffix):
+    """File tạm cùng thư mục với `path` để os.replace là thao tác nguyên tử (cùng filesystem)"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)) or '.', prefix='.', suffix=suffix)
+    os.close(fd)
+    return tmp
+
+def remove_files(*paths):
+    for p in paths:
+        try: os.remove(p)
+        except FileNotFoundError: pass
+
+
+# --- SAO LƯU ---
+def snapshot(dest):
+    """Chụp DB đang chạy ra file `dest` bằng online backup API từ 1 reader: WAL nên writer không bị chặn"""
+    out = sqlite3.connect(dest)
+    try:
+        with db.reader() as conn: conn.backup(out)
+    finally:
+        out.close()
+
+def _page_size(path):
+    with open(path, 'rb') as f:
+        f.seek(16); size = struct.unpack('>H', f.read(2))[0]
+    return 65536 if size == 1 else size
+
+def _pages(path, page_size):
+    with open(path, 'rb') as f:
+        while True:
+            page = f.read(page_size)
+            if not page: return
+            yield page
+
+def _digests(path, page_size):
+    return [hashlib.blake2b(p, digest_size=16).digest() for p in _pages(path, page_size)]
+
+def _gzip(src, dest):
+    with open(src, 'rb') as fin, gzip.open(dest, 'wb', compresslevel=6) as fout: shutil.copyfileobj(fin, fout, CHUNK)
+
+def _latest_full(directory=BACKUP_DIR):
+    fulls = sorted(f for f in os.listdir(directory) if f.startswith('full-') and f.endswith('.db.gz')) if os.path.isdir(directory) else []
+    return os.path.join(directory, fulls[-1]) if fulls else None
+
+def create_backup(incremental=False, directory=BACKUP_DIR):
+    """Tạo bản sao lưu nén gzip, trả về đường dẫn file.
+
+    Bản full kèm file .pages (hash từng trang). Bản incremental chỉ chứa các trang khác với bản full gần nhất
+    (vi sai, nên khôi phục chỉ cần bản full + 1 file .delta.gz); chưa có bản full thì tạo bản full."""
+    os.makedirs(directory, exist_ok=True)
+    base = _latest_full(directory) if incremental else None
+    raw = temp_near(os.path.join(directory, 'x'), '.db')
+    try:
+        snapshot(raw)
+        page_size = _page_size(raw)
+        digests = _digests(raw, page_size)
+        if base is None or not os.path.exists(base[:-len('.db.gz')] + '.pages'):
+            dest = os.path.join(directory, f"full-{_stamp()}.db.gz")
+            _gzip(raw, dest)
+            with open(dest[:-len('.db.gz')] + '.pages', 'wb') as f: f.write(b''.join(digests))
+            _prune(directory)
+        else:
+            with open(base[:-len('.db.gz')] + '.pages', 'rb') as f: old = f.read()
+            old = [old[i:i + 16] for i in range(0, len(old), 16)]
+            dest = os.path.join(directory, f"incr-{_stamp()}.delta.gz")
+            header = {'base': os.path.basename(base), 'page_size': page_size, 'page_count': len(digests)}
+            with gzip.open(dest, 'wb', compresslevel=6) as out:
+                out.write(json.dumps(header).encode() + b'\n')
+                for i, page in enumerate(_pages(raw, page_size)):
+                    if i >= len(old) or old[i] != digests[i]: out.write(struct.pack('>I', i) + page)
+        logging.info(f"Đã sao lưu DB -> {dest} ({os.path.getsize(dest) / 1024:.0f}KB)")
+        return dest
+    finally:
+        remove_files(raw)
+
+def _prune(directory, keep=BACKUP_KEEP):
+    fulls = sorted(f for f in os.listdir(directory) if f.startswith('full-') and f.endswith('.db.gz'))
+    for name in fulls[:-keep] if keep > 0 else []:
+        remove_files(os.path.join(directory, name), os.path.join(directory, name[:-len('.db.gz')] + '.pages'))
+        for f in os.listdir(directory):
+            if f.startswith('incr-') and f.endswith('.delta.gz'):
+                with gzip.open(os.path.join(directory, f)) as d:
+                    if json.loads(d.readline()).get('base') == name: remove_files(os.path.join(directory, f))
+
+
+# --- KHÔI PHỤC ---
+def _find_base(name, src, directory=BACKUP_DIR):
+    """Bản full gốc của 1 file .delta.gz: tìm trong thư mục sao lưu trước, sau đó cạnh chính file vi sai"""
+    name = os.path.basename(name or '')
+    for d in (directory, os.path.dirname(os.path.abspath(src))):
+        path = os.path.join(d, name)
+        if name and os.path.isfile(path): return path
+    raise RestoreError(f"Thiếu bản full gốc {name} trong {directory}")
+
+def unpack(src, dest, directory=BACKUP_DIR):
+    """Giải nén bản sao lưu (.db / .db.gz / .delta.gz + bản full gốc trong `directory` hoặc cạnh file) ra file DB `dest`"""
+    with open(src, 'rb') as f: is_gzip = f.read(2) == b'\x1f\x8b'
+    if not is_gzip:
+        shutil.copyfile(src, dest); return
+    with gzip.open(src, 'rb') as f:
+        first = f.peek(16)[:16] if hasattr(f, 'peek') else b''
+        if first.startswith(b'SQLite format 3'):
+            with open(dest, 'wb') as out: shutil.copyfileobj(f, out, CHUNK)
+            return
+        try: header = json.loads(f.readline())
+        except ValueError: raise RestoreError("File nén không phải bản sao lưu DB")
+        unpack(_find_base(header.get('base'), src, directory), dest, directory)
+        page_size = header['page_size']
+        with open(dest, 'r+b') as out:
+            while True:
+                rec = f.read(4)
+                if not rec: break
+                pgno = struct.unpack('>I', rec)[0]
+                out.seek(pgno * page_size); out.write(f.read(page_size))
+            out.truncate(header['page_count'] * page_size)
+
+def validate(path):
+    """integrity_check + kiểm tra bảng/cột tối thiểu; trả về user_version của file, lỗi thì RestoreError"""
+    try:
+        conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+    except sqlite3.Error as e:
+        raise RestoreError(f"Không mở được file: {e}")
+    try:
+        check = conn.execute("PRAGMA integrity_check").fetchall()
+        if check != [('ok',)]: raise RestoreError("File DB bị hỏng: " + "; ".join(r[0] for r in check[:3]))
+        for table, cols in REQUIRED_COLUMNS.items():
+            have = {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+            if not cols <= have: raise RestoreError(f"Không phải DB của bot: bảng {table} thiếu {', '.join(sorted(cols - have)) or 'toàn bộ'}")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION: raise RestoreError(f"DB có schema v{version} mới hơn bản bot này (v{SCHEMA_VERSION})")
+        return version
+    except sqlite3.DatabaseError as e:
+        raise RestoreError(f"File không phải SQLite hợp lệ: {e}")
+    finally:
+        conn.close()
+
+def restore_file(src):
+    """Giải nén -> kiểm tra -> thay thế nguyên tử. File gốc `src` không bị sửa; lỗi thì DB đang chạy giữ nguyên."""
+    staged = temp_near(db.path, '.restore')
+    try:
+        try: unpack(src, staged)
+        except (OSError, EOFError, KeyError, struct.error) as e: raise RestoreError(f"Không giải nén được bản sao lưu: {e}")
+        version = validate(staged)
+        db.replace_file(staged)
+        return version
+    finally:
+        # validate mở file ở chế độ WAL nên có thể để lại -wal/-shm rỗng
+        remove_files(staged, staged + '-wal', staged + '-shm')
@@ -0,0 +1,223 @@
+"""Đo hiệu năng các đường nóng của bot trên dữ liệu giả lập nhiều năm, nhiều người dùng.
+
+    python benchmark.py --sizes 10000,100000,1000000 --users 5 --json bench.json
+    python benchmark.py --sizes 10000 --compare bench.json   # so với lần đo trước, exit 1 nếu chậm hơn ngưỡng
+
+Mỗi kích thước dùng 1 file DB tạm riêng với `size` giao dịch và `size * orders_ratio` lệnh cổ phiếu.
+Các thao tác có cache (biểu đồ, Excel, chỉ số giao dịch) được đo ở trạng thái cache nguội.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import asyncio
+import datetime
+import tempfile
+import platform
+import subprocess
+import tracemalloc
+
+# DB_FILE phải trỏ vào thư mục tạm trước khi import các module của bot
+os.environ.setdefault("DB_FILE", os.path.join(tempfile.gettempdir(), "bench_portfolio.db"))
+
+import sqlite3
+import numpy as np
+from db import db
+from schema import init_db
+from stock_manager import stock_manager, FEE_RATE
+from analytics import analytics
+from performance import performance
+from exporter import reporter
+from charts import chart_service
+import main as bot
+import search
+
+CATEGORIES = ['Crypto', 'Stock', 'Cash']
+SYMBOLS = ['FPT', 'VNM', 'HPG', 'MWG', 'VCB', 'TCB', 'SSI', 'VHM', 'MSN', 'GAS', 'PNJ', 'REE', 'DGC', 'CTG', 'ACB']
+YEARS = 5
+NOTES = ['lương tháng', 'thưởng tết', 'trả nợ thẻ', 'chốt lời', 'cắt lỗ', 'tiền nhà', 'học phí', 'mua vàng', 'quỹ khẩn cấp', 'bench']
+CHUNK = 50000
+
+
+# --- SINH DỮ LIỆU ---
+def _dates(rng, n, today):
+    start = today - datetime.timedelta(days=365 * YEARS)
+    return sorted((start + datetime.timedelta(days=rng.randrange(365 * YEARS))).isoformat() for _ in range(n))
+
+def _transactions(rng, uid, n, today):
+    for d in _dates(rng, n, today):
+        t = 'Nạp' if rng.random() < 0.7 else 'Rút'
+        yield (uid, rng.choice(CATEGORIES), t, round(rng.lognormvariate(15, 1.2), -3), d, f"{rng.choice(NOTES)} {rng.randint(1, 12)}" if rng.random() < 0.3 else None)
+
+def _orders(rng, uid, n, today):
+    """Chuỗi lệnh hợp lệ (không bán quá số đang giữ) + danh mục cuối cùng theo giá vốn bình quân"""
+    price = {s: rng.uniform(10000, 150000) for s in SYMBOLS}
+    pos = {s: [0.0, 0.0] for s in SYMBOLS}
+    orders = []
+    for d in _dates(rng, n, today):
+        s = rng.choice(SYMBOLS); price[s] = max(1000.0, price[s] * rng.uniform(0.97, 1.03)); p = round(price[s], -2)
+        qty, cost = pos[s]
+        if qty > 0 and rng.random() < 0.4:
+            q = float(rng.randint(1, int(qty // 100) or 1) * 100) if qty >= 100 else qty
+            pos[s] = [qty - q, cost * (qty - q) / qty]; t = 'Bán'
+        else:
+            q = float(rng.randint(1, 10) * 100); pos[s] = [qty + q, cost + q * p * (1 + FEE_RATE)]; t = 'Mua'
+        orders.append((uid, s, t, q, p, q * p * FEE_RATE, d + " 10:00"))
+    holdings = [(uid, s, q, c / q, c) for s, (q, c) in pos.items() if q > 0]
+    return orders, holdings
+
+def _chunks(rows, size=CHUNK):
+    buf = []
+    for r in rows:
+        buf.append(r)
+        if len(buf) >= size: yield buf; buf = []
+    if buf: yield buf
+
+def generate(size, users, orders_ratio, seed):
+    rng, today = random.Random(seed), datetime.date.today()
+    n_orders = int(size * orders_ratio)
+    for uid in range(1, users + 1):
+        n_tx = size // users + (1 if uid <= size % users else 0)
+        n_ord = n_orders // users + (1 if uid <= n_orders % users else 0)
+        for chunk in _chunks(_transactions(rng, uid, n_tx, today)):
+            with db.writer() as c: c.executemany("INSERT INTO transactions (user_id, category, type, amount, date, note) VALUES (?, ?, ?, ?, ?, ?)", chunk)
+        orders, holdings = _orders(rng, uid, n_ord, today)
+        with db.writer() as c:
+            for chunk in _chunks(orders): c.executemany("INSERT INTO stock_orders (user_id, symbol, type, qty, price, fee, date) VALUES (?, ?, ?, ?, ?, ?, ?)", chunk)
+            c.executemany("INSERT OR REPLACE INTO stock_holdings (user_id, symbol, qty, avg_price, total_cost) VALUES (?, ?, ?, ?, ?)", holdings)
+            # Tiền mặt Stock đủ lớn để lệnh mua trong phần đo luôn khớp
+            c.executemany("INSERT OR REPLACE INTO assets (user_id, category, current_value) VALUES (?, ?, ?)",
+                          [(uid, 'Crypto', 3e8), (uid, 'Stock', 1e13), (uid, 'Cash', 5e7)])
+
+def deep_page_token(uid, depth=0.9):
+    """Page token của trang nằm ở `depth` phần độ sâu lịch sử (như người dùng bấm 'Sau' rất nhiều lần)"""
+    with db.reader() as c:
+        n = c.execute("SELECT COUNT(*) FROM transactions WHERE user_id = ?", (uid,)).fetchone()[0]
+        page = int(n * depth) // bot.PAGE_SIZE
+        row = c.execute("SELECT date, id FROM transactions WHERE user_id = ? ORDER BY date DESC, id DESC LIMIT 1 OFFSET ?", (uid, page * bot.PAGE_SIZE)).fetchone()
+    return bot.page_token(page, row) if row else None
+
+
+# --- ĐO ---
+def clear_caches():
+    chart_service.clear(); reporter.clear(); analytics.clear(); performance.clear()
+
+def cases(users, repeat):
+    """(tên, số lần đo, hàm reset trước mỗi lần, hàm gọi(uid) trả về giá trị hoặc coroutine)"""
+    tokens = {u: deep_page_token(u) for u in range(1, users + 1)}
+    few = max(3, repeat // 10)
+    return [
+        ('get_stats', repeat, None, lambda u: bot.get_stats(u)),
+        ('history_recent', repeat, None, lambda u: bot.get_history_menu(u)),
+        ('history_deep', repeat, None, lambda u: bot.get_history_menu(u, tokens[u])),
+        ('chart_all', few, chart_service.clear, lambda u: bot.get_chart(u, 'ALL')),
+        ('chart_1m', few, chart_service.clear, lambda u: bot.get_chart(u, '1M')),
+        ('export_excel', few, reporter.clear, lambda u: reporter.export_excel_report(u).close()),
+        ('search_notes', repeat, None, lambda u: db.read(search.load_page, u, search.parse_query('thưởng', bot.parse_amount))),
+        ('search_filter', repeat, None, lambda u: db.read(search.load_page, u, search.parse_query('stock rút >10tr 2023', bot.parse_amount))),
+        ('period_month', repeat, None, lambda u: bot.get_period_report(u, 'M')),
+        ('period_year', repeat, None, lambda u: bot.get_period_report(u, 'Y')),
+        ('returns', repeat, performance.clear, lambda u: performance.returns(u)),
+        ('portfolio_summary', repeat, analytics.clear, lambda u: stock_manager.get_portfolio_summary(u)),
+        ('execute_order', repeat, None, lambda u: stock_manager.execute_order(u, 'BENCH', 100, 10000, 'Mua')),
+    ]
+
+async def _call(fn, uid):
+    res = fn(uid)
+    return await res if asyncio.iscoroutine(res) else res
+
+async def run_case(fn, n, reset, users, rng):
+    await _call(fn, 1)  # khởi động: pool process vẽ, kết nối, import lười
+    samples = []
+    for _ in range(n):
+        if reset: reset()
+        uid = rng.randint(1, users)
+        t = time.perf_counter(); await _call(fn, uid); samples.append((time.perf_counter() - t) * 1000)
+    # Đỉnh bộ nhớ Python của 1 lần gọi (không tính process vẽ biểu đồ)
+    if reset: reset()
+    tracemalloc.start()
+    try:
+        await _call(fn, 1); peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return samples, peak
+
+async def bench_size(size, args):
+    path = os.path.join(args.dir, f"bench_{size}.db")
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix): os.remove(path + suffix)
+    db.close(); db.path = path; clear_caches()
+    t = time.perf_counter(); init_db(); generate(size, args.users, args.orders_ratio, args.seed)
+    setup = {'size': size, 'generate_s': round(time.perf_counter() - t, 2)}
+    rng, results = random.Random(args.seed), []
+    for name, n, reset, fn in cases(args.users, args.repeat):
+        if args.only and name not in args.only: continue
+        samples, peak = await run_case(fn, n, reset, args.users, rng)
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+        results.append({'size': size, 'case': name, 'n': n, 'mean_ms': round(float(np.mean(samples)), 3), 'p50_ms': round(float(p50), 3),
+                        'p95_ms': round(float(p95), 3), 'p99_ms': round(float(p99), 3), 'peak_kb': round(peak / 1024, 1)})
+        print(f"{size:>9,} {name:<18} n={n:<4} p50={p50:9.2f}ms p95={p95:9.2f}ms p99={p99:9.2f}ms peak={peak / 1024:9.1f}KB", flush=True)
+    db.close(); setup['db_mb'] = round(os.path.getsize(path) / 1024 / 1024, 1)
+    if not args.keep:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix): os.remove(path + suffix)
+    return setup, results
+
+
+def _git_commit():
+    try: return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError: return None
+
+def compare(old, new, threshold):
+    """In chênh lệch p50/p95 so với lần đo trước, trả về số trường hợp chậm hơn ngưỡng %"""
+    before = {(r['size'], r['case']): r for r in old['results']}
+    worse = 0
+    print(f"\nSo với {old.get('commit') or '?'} (ngưỡng {threshold:g}%):")
+    for r in new['results']:
+        o = before.get((r['size'], r['case']))
+        if not o: continue
+        d50, d95 = (r['p50_ms'] / o['p50_ms'] - 1) * 100 if o['p50_ms'] else 0, (r['p95_ms'] / o['p95_ms'] - 1) * 100 if o['p95_ms'] else 0
+        flag = d50 > threshold
+        worse += flag
+        print(f"{r['size']:>9,} {r['case']:<18} p50 {o['p50_ms']:9.2f} -> {r['p50_ms']:9.2f}ms ({d50:+6.1f}%)  p95 ({d95:+6.1f}%){'  ⚠️' if flag else ''}")
+    return worse
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--sizes', default='10000,100000,1000000', help='số giao dịch mỗi lượt, phân tách bằng dấu phẩy')
+    ap.add_argument('--users', type=int, default=5)
+    ap.add_argument('--orders-ratio', type=float, default=1.0, help='số lệnh cổ phiếu = size * tỷ lệ này')
+    ap.add_argument('--repeat', type=int, default=50, help='số lần đo mỗi thao tác (biểu đồ/Excel đo repeat/10 lần)')
+    ap.add_argument('--only', type=lambda s: set(s.split(',')), default=None, help='chỉ đo các thao tác này')
+    ap.add_argument('--seed', type=int, default=42)
+    ap.add_argument('--dir', default=tempfile.gettempdir(), help='thư mục chứa file DB tạm')
+    ap.add_argument('--keep', action='store_true', help='giữ lại file DB sau khi đo')
+    ap.add_argument('--json', help='ghi kết quả dạng JSON ra file này')
+    ap.add_argument('--compare', help='file JSON của lần đo trước để so sánh')
+    ap.add_argument('--threshold', type=float, default=20.0, help='%% chậm hơn ở p50 bị coi là hồi quy')
+    return ap.parse_args(argv)
+
+async def run(args):
+    report = {'commit': _git_commit(), 'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+              'sqlite': sqlite3.sqlite_version, 'users': args.users, 'orders_ratio': args.orders_ratio, 'setup': [], 'results': []}
+    try:
+        for size in [int(s) for s in args.sizes.split(',') if s]:
+            setup, results = await bench_size(size, args)
+            report['setup'].append(setup); report['results'] += results
+    finally:
+        chart_service.shutdown()
+    return report
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f: old = json.load(f)
+        return 1 if compare(old, report, args.threshold) else 0
+    return 0
+
+if __name__ == '__main__': sys.exit(main())
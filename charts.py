@@ -0,0 +1,115 @@
+import os
+import io
+import json
+import asyncio
+import datetime
+import hashlib
+import threading
+from collections import OrderedDict
+from metrics import metrics
+
+CHART_WORKERS = int(os.environ.get("CHART_WORKERS", "2"))
+CHART_CACHE_MB = float(os.environ.get("CHART_CACHE_MB", "32"))
+
+CAPITAL_STYLE = {'figsize': (10, 5), 'dpi': 120, 'color': '#1f77b4', 'up': '#2ecc71', 'down': '#e74c3c', 'value': '#9b59b6'}
+ALLOCATION_STYLE = {'figsize': (6, 6), 'dpi': 100}
+
+
+# --- HÀM VẼ (chạy trong process con, chỉ dùng API hướng đối tượng Figure, không đụng pyplot) ---
+def _png(fig, dpi):
+    buf = io.BytesIO(); fig.savefig(buf, format='png', dpi=dpi)
+    return buf.getvalue()
+
+def render_capital(dates, caps, total_val, today, style, value_dates=(), values=()):
+    """Biểu đồ vốn nạp ròng theo thời gian + các ảnh chụp tài sản thực + điểm tài sản thực hiện có"""
+    from matplotlib.figure import Figure
+    import matplotlib.dates as mdates
+    import matplotlib.ticker as ticker
+    xs = [datetime.datetime.strptime(d, "%Y-%m-%d") for d in dates]
+    fig = Figure(figsize=style['figsize']); ax = fig.subplots()
+    ax.plot(xs, caps, color=style['color'], linewidth=2, label='Vốn thực nạp ròng', marker='o', markersize=3); ax.fill_between(xs, caps, color=style['color'], alpha=0.15)
+    if values: ax.plot([datetime.datetime.strptime(d, "%Y-%m-%d") for d in value_dates], values, color=style['value'], linewidth=1.5, label='Tài sản thực (theo ngày)', marker='.', markersize=3)
+    color_t = style['up'] if total_val >= caps[-1] else style['down']
+    ax.plot([xs[-1], datetime.datetime.strptime(today, "%Y-%m-%d")], [caps[-1], total_val], label="Tài sản thực hiện có", color=color_t, marker='o', linestyle='--', linewidth=2)
+    ax.yaxis.set_major_formatter(ticker.FuncFormatter(lambda x, p: f"{x/1000000:,.0f}M")); ax.xaxis.set_major_formatter(mdates.DateFormatter('%m/%Y'))
+    ax.grid(True, linestyle='--', alpha=0.4); ax.legend()
+    return _png(fig, style['dpi'])
+
+def render_allocation(labels, vals, style):
+    """Biểu đồ tròn tỷ trọng tài sản"""
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=style['figsize']); ax = fig.subplots()
+    ax.pie(vals, labels=labels, autopct='%1.1f%%', startangle=90)
+    return _png(fig, style['dpi'])
+
+
+class ChartService:
+    """Render biểu đồ trên process pool, cache PNG theo hash nội dung (LRU giới hạn dung lượng)"""
+
+    def __init__(self, workers=CHART_WORKERS, max_bytes=int(CHART_CACHE_MB * 1024 * 1024)):
+        self.workers = max(1, workers)
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._executor = None
+        self.hits = self.misses = 0
+
+    def _pool(self):
+        if self._executor is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # spawn: tránh fork một process đang có nhiều thread (pool DB, executor...)
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    @staticmethod
+    def cache_key(kind, args):
+        return hashlib.sha256(json.dumps([kind, args], sort_keys=True, default=str).encode()).hexdigest()
+
+    def _get(self, key):
+        with self._lock:
+            png = self._cache.get(key)
+            if png is not None: self._cache.move_to_end(key); self.hits += 1
+            return png
+
+    def _put(self, key, png):
+        if len(png) > self.max_bytes: return
+        with self._lock:
+            if key in self._cache: return
+            self._cache[key] = png; self._size += len(png)
+            while self._size > self.max_bytes:
+                _, old = self._cache.popitem(last=False); self._size -= len(old)
+
+    async def _render(self, kind, fn, *args):
+        key = self.cache_key(kind, args)
+        png = self._get(key)
+        if png is not None: return png
+        # Gộp các yêu cầu trùng nhau đang render dở
+        if key in self._inflight: return await asyncio.shield(self._inflight[key])
+        self.misses += 1
+        fut = asyncio.get_running_loop().run_in_executor(self._pool(), fn, *args)
+        self._inflight[key] = fut
+        try:
+            with metrics.timer('chart_render_seconds', kind=kind): png = await fut
+        finally:
+            self._inflight.pop(key, None)
+        self._put(key, png)
+        return png
+
+    async def capital_chart(self, dates, caps, total_val, value_dates=(), values=(), style=CAPITAL_STYLE):
+        today = datetime.date.today().strftime("%Y-%m-%d")
+        return await self._render('capital', render_capital, list(dates), list(caps), total_val, today, style, list(value_dates), list(values))
+
+    async def allocation_chart(self, labels, vals, style=ALLOCATION_STYLE):
+        return await self._render('allocation', render_allocation, list(labels), list(vals), style)
+
+    def clear(self):
+        with self._lock: self._cache.clear(); self._size = 0
+
+    def shutdown(self):
+        if self._executor is not None: self._executor.shutdown(wait=False, cancel_futures=True); self._executor = None
+
+
+chart_service = ChartService()
@@ -0,0 +1,185 @@
+import os
+import re
+import queue
+import sqlite3
+import asyncio
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
+
+# Cấu hình qua biến môi trường (mặc định phù hợp cho 1 bot chạy đơn lẻ)
+DB_FILE = os.environ.get("DB_FILE", "portfolio.db")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", "5"))
+DB_CACHE_KB = int(os.environ.get("DB_CACHE_KB", "8192"))
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL").upper()
+
+
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def _sql_label(sql):
+    # IN (?,?,…) dài ngắn tùy số tham số: gom về 1 nhãn, không để mỗi độ dài thành 1 series metric riêng
+    return _IN_LIST.sub("IN (…)", " ".join(sql.split()))
+
+
+def _fn_label(fn):
+    # lambda trong fetchall/fetchone/execute mang tên hàm bao ngoài
+    return getattr(fn, '__qualname__', repr(fn)).replace('.<locals>.<lambda>', '')
+
+
+class _TimedConnection(sqlite3.Connection):
+    """Kết nối đo thời gian execute của từng câu SQL (nhãn = câu lệnh đã gom khoảng trắng)"""
+
+    def execute(self, sql, *args):
+        with metrics.timer('db_query_seconds', sql=_sql_label(sql)): return super().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        with metrics.timer('db_query_seconds', sql=_sql_label(sql)): return super().executemany(sql, *args)
+
+
+class Database:
+    """Lớp truy cập dữ liệu dùng chung: pool reader + 1 writer duy nhất, chạy trên thread executor"""
+
+    def __init__(self, path=DB_FILE, pool_size=DB_POOL_SIZE):
+        self.path = path
+        self.pool_size = max(1, pool_size)
+        self._idle = queue.LifoQueue()
+        self._sem = threading.BoundedSemaphore(self.pool_size)
+        self._generation = 0
+        self._writer = None
+        self._writer_gen = -1
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+        self._read_executor = None
+        self._write_executor = None
+        self._executor_lock = threading.Lock()
+
+    # --- KẾT NỐI ---
+    def _connect(self, readonly):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False, factory=_TimedConnection if metrics.enabled else sqlite3.Connection)
+        conn.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT * 1000)}")
+        if not readonly:
+            # WAL cho phép reader đọc song song trong khi writer đang ghi
+            conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_KB}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        if readonly: conn.execute("PRAGMA query_only = 1")
+        return conn
+
+    def _ensure_writer(self):
+        if self._writer is None or self._writer_gen != self._generation:
+            if self._writer is not None: self._writer.close()
+            self._writer = self._connect(readonly=False)
+            self._writer_gen = self._generation
+
+    @contextmanager
+    def reader(self):
+        """Mượn 1 kết nối chỉ-đọc từ pool (chặn nếu pool đã hết)"""
+        self._sem.acquire()
+        try:
+            # Khởi tạo writer trước để file DB luôn ở chế độ WAL khi reader mở
+            if self._writer is None:
+                with self._write_lock: self._ensure_writer()
+            try:
+                gen, conn = self._idle.get_nowait()
+                if gen != self._generation: conn.close(); raise queue.Empty
+            except queue.Empty:
+                gen, conn = self._generation, self._connect(readonly=True)
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction: conn.rollback()
+                if gen == self._generation: self._idle.put((gen, conn))
+                else: conn.close()
+        finally:
+            self._sem.release()
+
+    @contextmanager
+    def writer(self):
+        """Giao dịch ghi tuần tự qua kết nối writer duy nhất (cho phép lồng nhau trong cùng thread)"""
+        with self._write_lock:
+            self._ensure_writer()
+            conn = self._writer
+            if self._write_depth > 0:
+                self._write_depth += 1
+                try: yield conn
+                finally: self._write_depth -= 1
+                return
+            self._write_depth = 1
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._write_depth = 0
+
+    # --- CHẠY TRÊN EXECUTOR ---
+    def _executors(self):
+        with self._executor_lock:
+            if self._read_executor is None:
+                self._read_executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="db-read")
+                self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+            return self._read_executor, self._write_executor
+
+    def _call_read(self, fn, args):
+        with metrics.timer('db_call_seconds', fn=_fn_label(fn), mode='read'), self.reader() as conn: return fn(conn, *args)
+
+    def _call_write(self, fn, args):
+        with metrics.timer('db_call_seconds', fn=_fn_label(fn), mode='write'), self.writer() as conn: return fn(conn, *args)
+
+    async def read(self, fn, *args):
+        """Chạy fn(conn, *args) với 1 reader trên thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(self._executors()[0], self._call_read, fn, args)
+
+    async def write(self, fn, *args):
+        """Chạy fn(conn, *args) trong 1 giao dịch ghi trên thread writer riêng"""
+        return await asyncio.get_running_loop().run_in_executor(self._executors()[1], self._call_write, fn, args)
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def execute(self, sql, params=()):
+        """Thực thi 1 câu lệnh ghi, trả về lastrowid"""
+        return await self.write(lambda conn: conn.execute(sql, params).lastrowid)
+
+    def close(self):
+        """Đóng toàn bộ kết nối (dùng khi thay file DB). Kết nối đang mượn sẽ tự đóng khi trả về."""
+        with self._write_lock:
+            self._generation += 1
+            if self._writer is not None:
+                self._writer.close(); self._writer = None
+            while True:
+                try: self._idle.get_nowait()[1].close()
+                except queue.Empty: break
+
+    def replace_file(self, path):
+        """Thay file DB bằng `path` (os.replace nguyên tử) trong khi giữ khóa ghi; kết nối tới file cũ đều bị loại bỏ"""
+        with self._write_lock:
+            self.close()
+            os.replace(path, self.path)
+            # WAL/SHM của file cũ không được áp lên file mới
+            for suffix in ('-wal', '-shm'):
+                try: os.remove(self.path + suffix)
+                except FileNotFoundError: pass
+            # Reader mở giữa 2 lần close vẫn trỏ vào file cũ: tăng generation lần nữa để loại luôn
+            self.close()
+
+
+def data_version(conn, user_id, scope='ledger'):
+    """Bộ đếm phiên bản dữ liệu của 1 người dùng (trigger tự tăng khi bảng thuộc scope thay đổi), dùng làm khóa cache"""
+    row = conn.execute("SELECT version FROM data_versions WHERE user_id = ? AND scope = ?", (user_id, scope)).fetchone()
+    return row[0] if row else 0
+
+
+db = Database()
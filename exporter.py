@@ -1,108 +1,147 @@
-import sqlite3
-import pandas as pd
-import io
-import datetime
 import os
+import asyncio
+import logging
+import datetime
+import tempfile
+import threading
+from collections import OrderedDict
+from db import db, data_version
+
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", "2000"))
+EXPORT_CACHE_USERS = int(os.environ.get("EXPORT_CACHE_USERS", "16"))
 
-DB_FILE = 'portfolio.db'
+def _unlink(path):
+    try: os.unlink(path)
+    except OSError: pass
 
 class ReportExporter:
-    def export_excel_report(self):
+    def __init__(self):
+        # Cache file báo cáo gần nhất của mỗi người dùng theo phiên bản dữ liệu (LRU theo user_id)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # Thư mục tạm riêng của process: file báo cáo sót lại (kể cả của handle chưa đóng) bị xóa cùng lúc khi tắt bot
+        self._tmpdir = None
+
+    def _dir(self):
+        with self._lock:
+            if self._tmpdir is None: self._tmpdir = tempfile.TemporaryDirectory(prefix='reports-', ignore_cleanup_errors=True)
+            return self._tmpdir.name
+
+    def _load_summary(self, conn, uid):
+        assets = {r[0]: r[1] or 0 for r in conn.execute("SELECT category, current_value FROM assets WHERE user_id = ?", (uid,))}
+        totals = {(r[0], r[1]): r[2] for r in conn.execute("SELECT category, type, total FROM tx_totals WHERE user_id = ?", (uid,))}
+        target_val = (conn.execute("SELECT value FROM settings WHERE user_id = ? AND key='target_asset'", (uid,)).fetchone() or [500000000])[0]
+        summary_data = []
+        for cat in ['Crypto', 'Stock', 'Cash']:
+            curr = assets.get(cat, 0)
+            von = totals.get((cat, 'Nạp'), 0) - totals.get((cat, 'Rút'), 0)
+            lai_lo = curr - von
+            pct = (lai_lo / von * 100) if von != 0 else 0
+            summary_data.append((cat, von, curr, lai_lo, round(pct, 2)))
+        return summary_data, target_val
+
+    def _build(self, out, uid):
+        """Ghi workbook vào file `out` ở chế độ constant_memory, giao dịch được đọc theo từng khối"""
+        import xlsxwriter  # nạp khi xuất báo cáo lần đầu, không làm chậm lúc khởi động
+        workbook = xlsxwriter.Workbook(out, {'constant_memory': True})
+        title_fmt = workbook.add_format({'bold': True, 'font_size': 18, 'font_color': '#1F4E78'})
+        header_fmt = workbook.add_format({'bold': True, 'bg_color': '#D7E4BC', 'border': 1, 'align': 'center'})
+        num_fmt = workbook.add_format({'num_format': '#,##0', 'border': 1})
+        red_fmt = workbook.add_format({'font_color': '#9C0006', 'bg_color': '#FFC7CE', 'num_format': '#,##0', 'border': 1})
+        green_fmt = workbook.add_format({'font_color': '#006100', 'bg_color': '#C6EFCE', 'num_format': '#,##0', 'border': 1})
+
+        with db.reader() as conn:
+            summary_data, target_val = self._load_summary(conn, uid)
+
+            # --- SHEET 1: DASHBOARD (constant_memory bắt buộc ghi theo thứ tự dòng) ---
+            ws = workbook.add_worksheet('Dashboard')
+            ws.set_column('A:E', 18, num_fmt)
+            ws.write('A1', 'HỆ THỐNG QUẢN TRỊ GIA SẢN CÁ NHÂN', title_fmt)
+            ws.write('A2', f'Dữ liệu tính đến: {datetime.datetime.now().strftime("%d/%m/%Y %H:%M")}')
+            ws.write('A3', f'Mục tiêu tài chính: {int(target_val):,} VNĐ')
+            ws.write_row(4, 0, ['Danh mục', 'Vốn thực (Cost)', 'Giá trị hiện tại', 'Lãi/Lỗ (VNĐ)', 'Hiệu suất (%)'], header_fmt)
+            for i, row in enumerate(summary_data): ws.write_row(5 + i, 0, row)
+
+            # Áp dụng format màu cho Lãi/Lỗ
+            ws.conditional_format('D6:D8', {'type': 'cell', 'criteria': '>=', 'value': 0, 'format': green_fmt})
+            ws.conditional_format('D6:D8', {'type': 'cell', 'criteria': '<', 'value': 0, 'format': red_fmt})
+
+            # --- VẼ BIỂU ĐỒ 1: PHÂN BỔ TÀI SẢN (PIE) ---
+            chart1 = workbook.add_chart({'type': 'pie'})
+            chart1.add_series({
+                'name': 'Tỷ trọng tài sản',
+                'categories': ['Dashboard', 5, 0, 7, 0],
+                'values':     ['Dashboard', 5, 2, 7, 2],
+                'data_labels': {'percentage': True, 'font': {'size': 10}},
+            })
+            chart1.set_title({'name': 'Cơ cấu Danh mục Hiện tại'})
+            ws.insert_chart('G2', chart1)
+
+            # --- VẼ BIỂU ĐỒ 2: HIỆU SUẤT LÃI LỖ (COLUMN) ---
+            chart2 = workbook.add_chart({'type': 'column'})
+            chart2.add_series({
+                'name': 'Mức sinh lời (VNĐ)',
+                'categories': ['Dashboard', 5, 0, 7, 0],
+                'values':     ['Dashboard', 5, 3, 7, 3],
+                'fill':       {'color': '#4F81BD'}
+            })
+            chart2.set_title({'name': 'So sánh Lãi/Lỗ giữa các kênh'})
+            ws.insert_chart('G18', chart2)
+
+            # --- SHEET 2: GIAO DỊCH CHI TIẾT (stream từ SQLite, không giữ toàn bộ trong RAM) ---
+            ws_tx = workbook.add_worksheet('Giao_Dich_Chi_Tiet')
+            ws_tx.set_column('A:B', 15)
+            ws_tx.set_column('C:C', 18)
+            ws_tx.set_column('D:D', 15)
+            ws_tx.set_column('E:E', 40)
+            ws_tx.write_row(0, 0, ['Danh mục', 'Loại', 'Số tiền', 'Ngày', 'Ghi chú'], header_fmt)
+            cur = conn.execute("SELECT category, type, amount, date, note FROM transactions WHERE user_id = ? ORDER BY date DESC, id DESC", (uid,))
+            row_idx = 1
+            while True:
+                chunk = cur.fetchmany(EXPORT_CHUNK_ROWS)
+                if not chunk: break
+                for row in chunk: ws_tx.write_row(row_idx, 0, row); row_idx += 1
+        workbook.close()
+
+    def export_excel_report(self, uid):
+        """Tạo báo cáo (đồng bộ, chạy trong worker thread). Trả về file handle riêng (mở 'rb', đọc từ đầu) hoặc None.
+        Báo cáo nằm trên đĩa, người gọi gửi thẳng handle đi và tự đóng, không nạp cả file vào RAM."""
         try:
-            if not os.path.exists(DB_FILE): return None
-            conn = sqlite3.connect(DB_FILE)
-            
-            # Đọc dữ liệu từ DB
-            df_assets = pd.read_sql_query("SELECT category, current_value FROM assets", conn)
-            df_tx = pd.read_sql_query("SELECT category, type, amount, date, note FROM transactions", conn)
-            target_val = (conn.execute("SELECT value FROM settings WHERE key='target_asset'").fetchone() or [500000000])[0]
-            conn.close()
-
-            # --- XỬ LÝ LOGIC TÀI CHÍNH ---
-            summary_data = []
-            for cat in ['Crypto', 'Stock', 'Cash']:
-                curr = df_assets[df_assets['category'] == cat]['current_value'].sum()
-                tx = df_tx[df_tx['category'] == cat]
-                nap = tx[tx['type'] == 'Nạp']['amount'].sum()
-                rut = tx[tx['type'] == 'Rút']['amount'].sum()
-                von = nap - rut
-                lai_lo = curr - von
-                pct = (lai_lo / von * 100) if von != 0 else 0
-                
-                summary_data.append({
-                    'Danh mục': cat,
-                    'Vốn thực (Cost)': von,
-                    'Giá trị hiện tại': curr,
-                    'Lãi/Lỗ (VNĐ)': lai_lo,
-                    'Hiệu suất (%)': round(pct, 2)
-                })
-
-            df_s = pd.DataFrame(summary_data)
-            output = io.BytesIO()
-
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                df_s.to_excel(writer, sheet_name='Dashboard', index=False, startrow=4)
-                
-                # Đổi tên cột có thêm Ghi chú và xuất ra Excel
-                df_tx_export = df_tx.sort_values('date', ascending=False).copy()
-                df_tx_export.columns = ['Danh mục', 'Loại', 'Số tiền', 'Ngày', 'Ghi chú']
-                df_tx_export.to_excel(writer, sheet_name='Giao_Dich_Chi_Tiet', index=False)
-
-                workbook = writer.book
-                ws = writer.sheets['Dashboard']
-                
-                # Căn rộng cột Ghi chú (Cột E) ra để dễ đọc
-                ws_tx = writer.sheets['Giao_Dich_Chi_Tiet']
-                ws_tx.set_column('A:B', 15)
-                ws_tx.set_column('C:C', 18)
-                ws_tx.set_column('D:D', 15)
-                ws_tx.set_column('E:E', 40)
-
-                # Định dạng chuyên nghiệp
-                title_fmt = workbook.add_format({'bold': True, 'font_size': 18, 'font_color': '#1F4E78'})
-                header_fmt = workbook.add_format({'bold': True, 'bg_color': '#D7E4BC', 'border': 1, 'align': 'center'})
-                num_fmt = workbook.add_format({'num_format': '#,##0', 'border': 1})
-                pct_fmt = workbook.add_format({'num_format': '0.0"%"', 'border': 1})
-                red_fmt = workbook.add_format({'font_color': '#9C0006', 'bg_color': '#FFC7CE', 'num_format': '#,##0', 'border': 1})
-                green_fmt = workbook.add_format({'font_color': '#006100', 'bg_color': '#C6EFCE', 'num_format': '#,##0', 'border': 1})
-
-                # Header báo cáo
-                ws.write('A1', 'HỆ THỐNG QUẢN TRỊ GIA SẢN CÁ NHÂN', title_fmt)
-                ws.write('A2', f'Dữ liệu tính đến: {datetime.datetime.now().strftime("%d/%m/%Y %H:%M")}')
-                ws.write('A3', f'Mục tiêu tài chính: {int(target_val):,} VNĐ')
-
-                # Áp dụng format màu cho Lãi/Lỗ
-                ws.conditional_format('D6:D8', {'type': 'cell', 'criteria': '>=', 'value': 0, 'format': green_fmt})
-                ws.conditional_format('D6:D8', {'type': 'cell', 'criteria': '<', 'value': 0, 'format': red_fmt})
-                ws.set_column('A:E', 18, num_fmt)
-
-                # --- VẼ BIỂU ĐỒ 1: PHÂN BỔ TÀI SẢN (PIE) ---
-                chart1 = workbook.add_chart({'type': 'pie'})
-                chart1.add_series({
-                    'name': 'Tỷ trọng tài sản',
-                    'categories': ['Dashboard', 5, 0, 7, 0],
-                    'values':     ['Dashboard', 5, 2, 7, 2],
-                    'data_labels': {'percentage': True, 'font': {'size': 10}},
-                })
-                chart1.set_title({'name': 'Cơ cấu Danh mục Hiện tại'})
-                ws.insert_chart('G2', chart1)
-
-                # --- VẼ BIỂU ĐỒ 2: HIỆU SUẤT LÃI LỖ (COLUMN) ---
-                chart2 = workbook.add_chart({'type': 'column'})
-                chart2.add_series({
-                    'name': 'Mức sinh lời (VNĐ)',
-                    'categories': ['Dashboard', 5, 0, 7, 0],
-                    'values':     ['Dashboard', 5, 3, 7, 3],
-                    'fill':       {'color': '#4F81BD'}
-                })
-                chart2.set_title({'name': 'So sánh Lãi/Lỗ giữa các kênh'})
-                ws.insert_chart('G18', chart2)
-
-            output.seek(0)
-            return output
+            with db.reader() as conn: version = data_version(conn, uid)
+            with self._lock:
+                cached = self._cache.get(uid)
+                if cached is not None and cached[0] == version:
+                    self._cache.move_to_end(uid)
+                    return open(cached[1], 'rb')
+            out = tempfile.NamedTemporaryFile(suffix='.xlsx', dir=self._dir(), delete=False)
+            path = out.name
+            try:
+                with out: self._build(out, uid)
+            except Exception:
+                _unlink(path); raise
+            # Mở handle trước khi đưa vào cache: file bị thay/xóa sau đó handle này vẫn đọc được
+            handle = open(path, 'rb')
+            with self._lock:
+                old = self._cache.pop(uid, None)
+                if old is not None: _unlink(old[1])
+                self._cache[uid] = (version, path)
+                while len(self._cache) > EXPORT_CACHE_USERS: _unlink(self._cache.popitem(last=False)[1][1])
+            return handle
         except Exception as e:
-            print(f"Lỗi Report: {e}")
+            logging.warning(f"Lỗi Report: {e}", exc_info=True)
             return None
 
-reporter = ReportExporter()
+    async def export(self, uid):
+        return await asyncio.to_thread(self.export_excel_report, uid)
+
+    def clear(self):
+        with self._lock:
+            while self._cache: _unlink(self._cache.popitem(last=False)[1][1])
 
+    def close(self):
+        """Xóa cache và cả thư mục tạm (gọi khi tắt bot)"""
+        self.clear()
+        with self._lock:
+            if self._tmpdir is not None: self._tmpdir.cleanup(); self._tmpdir = None
+
+reporter = ReportExporter()
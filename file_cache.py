@@ -0,0 +1,114 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from telegram import InputFile
+from telegram.error import BadRequest
+from db import db
+from metrics import metrics
+
+FILE_CACHE_SIZE = int(os.environ.get("FILE_CACHE_SIZE", "2000"))
+# file_id không dùng tới sau số ngày này thì bỏ (Telegram không cam kết giữ file cũ mãi)
+FILE_CACHE_DAYS = float(os.environ.get("FILE_CACHE_DAYS", "30"))
+# Chỉ ghi lại last_used khi lần ghi trước đã cũ hơn khoảng này, tránh 1 lệnh ghi DB mỗi lần gửi
+TOUCH_INTERVAL = 3600
+HASH_CHUNK = 1 << 20
+
+
+def _file_id(message):
+    """file_id trong Message Telegram trả về sau khi gửi (ảnh lấy bản lớn nhất)"""
+    if not hasattr(message, 'photo'): return None  # edit_message_media trên tin inline trả về True
+    if message.photo: return message.photo[-1].file_id
+    if message.document: return message.document.file_id
+    return None
+
+
+class FileIdCache:
+    """Map hash nội dung file (PNG/XLSX) -> file_id Telegram: gửi lại file giống hệt chỉ cần file_id, không upload lại.
+    RAM (LRU) phía trước, bảng tg_file_ids phía sau để sống qua lần khởi động lại."""
+
+    def __init__(self, max_entries=FILE_CACHE_SIZE, ttl_days=FILE_CACHE_DAYS):
+        self.max_entries, self.ttl = max_entries, ttl_days * 86400
+        self._mem = OrderedDict()  # hash -> (file_id, last_used đã ghi DB)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(data, filename=''):
+        """`data` là bytes hoặc file handle nhị phân (băm theo từng khối rồi tua về đầu, không nạp cả file)"""
+        h = hashlib.sha256()
+        if isinstance(data, bytes): h.update(data)
+        else:
+            for block in iter(lambda: data.read(HASH_CHUNK), b''): h.update(block)
+            data.seek(0)
+        # Tên file nằm trong khóa: gửi bằng file_id giữ nguyên tên của lần upload đầu
+        h.update(b'|' + filename.encode())
+        return h.hexdigest()[:40]
+
+    def _remember(self, key, file_id, touched):
+        self._mem[key] = (file_id, touched); self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries: self._mem.popitem(last=False)
+
+    def _get(self, conn, key, now):
+        return conn.execute("SELECT file_id, last_used FROM tg_file_ids WHERE hash = ? AND last_used > ?", (key, now - self.ttl)).fetchone()
+
+    async def get(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._mem.get(key)
+        if item is not None and item[1] > now - self.ttl:
+            file_id, touched = item
+        else:
+            row = await db.read(self._get, key, now)
+            if row is None: return None
+            file_id, touched = row
+        if touched < now - TOUCH_INTERVAL:
+            await db.write(lambda c: c.execute("UPDATE tg_file_ids SET last_used = ? WHERE hash = ?", (now, key)))
+            touched = now
+        with self._lock: self._remember(key, file_id, touched)
+        return file_id
+
+    def _put(self, conn, key, kind, file_id, now):
+        conn.execute("INSERT OR REPLACE INTO tg_file_ids (hash, kind, file_id, last_used) VALUES (?, ?, ?, ?)", (key, kind, file_id, now))
+        # Dọn bản quá hạn và giữ bảng trong giới hạn kích thước (bỏ bản lâu không dùng nhất)
+        conn.execute("DELETE FROM tg_file_ids WHERE last_used <= ?", (now - self.ttl,))
+        conn.execute("DELETE FROM tg_file_ids WHERE hash IN (SELECT hash FROM tg_file_ids ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    async def put(self, key, kind, file_id):
+        now = time.time()
+        with self._lock: self._remember(key, file_id, now)
+        await db.write(self._put, key, kind, file_id, now)
+
+    async def drop(self, key):
+        with self._lock: self._mem.pop(key, None)
+        await db.write(lambda c: c.execute("DELETE FROM tg_file_ids WHERE hash = ?", (key,)))
+
+    async def send(self, send, data, kind, filename=''):
+        """Gửi file qua `send(media)`: media là file_id nếu nội dung này đã từng upload, không thì là bytes
+        (hoặc InputFile stream thẳng từ file handle khi `data` là file, không đọc hết vào RAM).
+        file_id hỏng/hết hạn (BadRequest về file) thì xóa khỏi cache và upload lại."""
+        key = self.make_key(data, filename) if isinstance(data, bytes) else await asyncio.to_thread(self.make_key, data, filename)
+        file_id = await self.get(key)
+        if file_id:
+            try:
+                message = await send(file_id)
+                metrics.inc('file_cache_total', kind=kind, result='hit')
+                return message
+            except BadRequest as e:
+                if 'file' not in str(e).lower(): raise
+                logging.warning(f"file_id {kind} không dùng được nữa ({e}), upload lại")
+                await self.drop(key)
+        message = await send(data if isinstance(data, bytes) else InputFile(data, filename=filename or None, read_file_handle=False))
+        metrics.inc('file_cache_total', kind=kind, result='miss')
+        new_id = _file_id(message)
+        if new_id: await self.put(key, kind, new_id)
+        return message
+
+    def clear(self):
+        """Chỉ xóa lớp RAM (vd sau khi khôi phục DB); bảng trong DB vẫn là nguồn chuẩn"""
+        with self._lock: self._mem.clear()
+
+
+file_cache = FileIdCache()
@@ -0,0 +1,218 @@
+import os
+import re
+import csv
+import hashlib
+import datetime
+import unicodedata
+from functools import lru_cache
+from db import db
+from stock_manager import FEE_RATE
+
+IMPORT_CHUNK_ROWS = int(os.environ.get("IMPORT_CHUNK_ROWS", "5000"))
+
+# Tên cột thường gặp trong sao kê sàn/ngân hàng (đã bỏ dấu, chữ thường) -> trường nội bộ
+ALIASES = {
+    'date': ['date', 'ngay', 'ngay giao dich', 'thoi gian', 'time', 'datetime', 'trade date', 'ngay khop'],
+    'category': ['category', 'danh muc', 'tai san', 'loai tai san', 'asset', 'account', 'tai khoan'],
+    'type': ['type', 'loai', 'loai giao dich', 'giao dich', 'side', 'action', 'lenh', 'mua/ban', 'chieu'],
+    'amount': ['amount', 'so tien', 'gia tri', 'value', 'total', 'tien'],
+    'note': ['note', 'ghi chu', 'noi dung', 'description', 'memo', 'dien giai'],
+    'symbol': ['symbol', 'ma', 'ma ck', 'ma chung khoan', 'ticker', 'coin'],
+    'qty': ['qty', 'quantity', 'so luong', 'khoi luong', 'kl', 'volume'],
+    'price': ['price', 'gia', 'gia khop', 'don gia'],
+    'fee': ['fee', 'phi', 'phi giao dich'],
+}
+CATEGORIES = {'crypto': 'Crypto', 'coin': 'Crypto', 'stock': 'Stock', 'chung khoan': 'Stock', 'ck': 'Stock', 'cash': 'Cash', 'tien mat': 'Cash', 'bank': 'Cash'}
+TX_TYPES = {'nap': 'Nạp', 'deposit': 'Nạp', 'in': 'Nạp', '+': 'Nạp', 'rut': 'Rút', 'withdraw': 'Rút', 'withdrawal': 'Rút', 'out': 'Rút', '-': 'Rút'}
+ORDER_TYPES = {'mua': 'Mua', 'buy': 'Mua', 'b': 'Mua', 'ban': 'Bán', 'sell': 'Bán', 's': 'Bán'}
+
+
+class StatementError(Exception):
+    pass
+
+
+@lru_cache(maxsize=4096)
+def _plain_str(text):
+    text = unicodedata.normalize('NFD', text).replace('đ', 'd').replace('Đ', 'D')
+    return ' '.join(''.join(ch for ch in text if unicodedata.category(ch) != 'Mn').lower().split())
+
+def _plain(text):
+    """Bỏ dấu tiếng Việt + chữ thường + gom khoảng trắng để so tên cột/giá trị (cột loại/danh mục lặp lại nhiều nên có cache)"""
+    return _plain_str(str(text or ''))
+
+def category_from_text(text):
+    return CATEGORIES.get(_plain(text))
+
+def map_columns(header):
+    """{trường: vị trí cột} theo ALIASES, xác định luôn loại sao kê: 'orders' (lệnh) hoặc 'transactions' (nạp/rút)"""
+    lookup = {alias: field for field, names in ALIASES.items() for alias in names}
+    cols = {}
+    for i, name in enumerate(header):
+        field = lookup.get(_plain(name))
+        if field and field not in cols: cols[field] = i
+    if {'symbol', 'qty', 'price'} <= cols.keys() and 'date' in cols: return 'orders', cols
+    if {'amount', 'date'} <= cols.keys(): return 'transactions', cols
+    raise StatementError("Không nhận ra cột. Cần ít nhất: ngày + số tiền (nạp/rút) hoặc ngày + mã + số lượng + giá (lệnh).")
+
+_NOT_NUMBER = re.compile(r'[^\d,.\-]')
+_SEPARATORS = re.compile(r'[.,]')
+_THOUSANDS = re.compile(r'-?[1-9]\d{0,2}[.,]\d{3}')
+# Y-M-D hoặc D-M-Y (phân cách - / .), có thể kèm giờ
+_DATE = re.compile(r'\s*(\d{1,4})[-/.](\d{1,2})[-/.](\d{1,4})(?:[ T]+(\d{1,2}):(\d{2})(?::(\d{2}))?)?')
+
+def parse_number(value):
+    if isinstance(value, (int, float)): return float(value)
+    s = _NOT_NUMBER.sub('', str(value or ''))
+    if not s.strip('-'): raise ValueError("không phải số")
+    if s.count('.') + s.count(',') > 1:
+        # 1.000.000,5 / 1,000,000.5: dấu chỉ xuất hiện 1 lần ở cuối là dấu thập phân, còn lại là phân cách nghìn
+        last = max(s.rfind('.'), s.rfind(','))
+        if s.count(s[last]) == 1: return float(_SEPARATORS.sub('', s[:last]) + '.' + s[last + 1:])
+        return float(_SEPARATORS.sub('', s))
+    # 1.500 / 25,000 theo kiểu Việt Nam là số nguyên, còn 0.500 hay 1.25 là số thập phân
+    if _THOUSANDS.fullmatch(s): return float(_SEPARATORS.sub('', s))
+    return float(s.replace(',', '.'))
+
+@lru_cache(maxsize=65536)
+def _parse_date_str(s):
+    m = _DATE.match(s)
+    if not m: raise ValueError(f"ngày không hợp lệ: {s!r}")
+    a, mo, b, hh, mm, ss = m.groups()
+    y, d = (a, b) if len(a) == 4 else (b, a)
+    if len(y) != 4: raise ValueError(f"ngày không hợp lệ: {s!r}")
+    return datetime.datetime(int(y), int(mo), int(d), int(hh or 0), int(mm or 0), int(ss or 0))
+
+def parse_date(value):
+    if isinstance(value, datetime.datetime): return value
+    if isinstance(value, datetime.date): return datetime.datetime(value.year, value.month, value.day)
+    return _parse_date_str(str(value or ''))
+
+
+# --- ĐỌC FILE THEO LUỒNG ---
+def _csv_rows(path):
+    with open(path, newline='', encoding='utf-8-sig', errors='replace') as f:
+        sample = f.read(4096); f.seek(0)
+        try: dialect = csv.Sniffer().sniff(sample, delimiters=',;\t|')
+        except csv.Error: dialect = csv.excel
+        yield from csv.reader(f, dialect)
+
+def _xlsx_rows(path):
+    from openpyxl import load_workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from wb.worksheets[0].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+def read_rows(path, name):
+    rows = _xlsx_rows(path) if name.lower().endswith(('.xlsx', '.xlsm')) else _csv_rows(path)
+    # Bỏ các dòng tiêu đề phụ/trống phía trên: dòng đầu tiên map được cột là header
+    for skipped, header in enumerate(rows):
+        if skipped > 20: break
+        try: kind, cols = map_columns(header)
+        except StatementError: continue
+        return kind, cols, rows, skipped + 2
+    raise StatementError("Không tìm thấy dòng tiêu đề trong 20 dòng đầu.")
+
+
+# --- CHUẨN HÓA DÒNG ---
+def _cell(row, cols, field):
+    i = cols.get(field)
+    return row[i] if i is not None and i < len(row) else None
+
+def _tx_row(row, cols, default_category):
+    amount = parse_number(_cell(row, cols, 'amount'))
+    t = TX_TYPES.get(_plain(_cell(row, cols, 'type')))
+    if t is None:
+        if 'type' in cols and _plain(_cell(row, cols, 'type')): raise ValueError("loại giao dịch không rõ")
+        t = 'Rút' if amount < 0 else 'Nạp'
+    cat = CATEGORIES.get(_plain(_cell(row, cols, 'category'))) or default_category
+    if cat is None: raise ValueError("thiếu danh mục")
+    note = str(_cell(row, cols, 'note') or '').strip() or None
+    return parse_date(_cell(row, cols, 'date')).strftime("%Y-%m-%d"), cat, t, abs(amount), note
+
+def _order_row(row, cols, default_category):
+    t = ORDER_TYPES.get(_plain(_cell(row, cols, 'type')))
+    qty = parse_number(_cell(row, cols, 'qty'))
+    if t is None:
+        if qty == 0 or ('type' in cols and _plain(_cell(row, cols, 'type'))): raise ValueError("lệnh không rõ mua/bán")
+        t = 'Bán' if qty < 0 else 'Mua'
+    price = parse_number(_cell(row, cols, 'price'))
+    qty = abs(qty)
+    if qty <= 0 or price <= 0: raise ValueError("số lượng/giá phải > 0")
+    fee = parse_number(_cell(row, cols, 'fee')) if _cell(row, cols, 'fee') not in (None, '') else qty * price * FEE_RATE
+    symbol = str(_cell(row, cols, 'symbol') or '').strip().upper()
+    if not symbol: raise ValueError("thiếu mã")
+    return parse_date(_cell(row, cols, 'date')).strftime("%Y-%m-%d %H:%M"), symbol, t, qty, price, abs(fee)
+
+TARGETS = {
+    'transactions': (_tx_row, "INSERT OR IGNORE INTO transactions (user_id, date, category, type, amount, note, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?)"),
+    'orders': (_order_row, "INSERT OR IGNORE INTO stock_orders (user_id, date, symbol, type, qty, price, fee, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"),
+}
+
+def content_hash(kind, values, occurrence):
+    """Hash nội dung dòng + số thứ tự lần xuất hiện trong file: 2 dòng giống hệt nhau vẫn là 2 giao dịch,
+    còn tải lại cùng sao kê (hoặc sao kê chồng lấn) thì trùng hash và bị INSERT OR IGNORE bỏ qua"""
+    key = "|".join(f"{v:.4f}" if isinstance(v, float) else str(v if v is not None else '') for v in values)
+    return hashlib.sha256(f"{kind}|{key}|#{occurrence}".encode()).hexdigest()[:32]
+
+
+def rebuild_holdings(conn, user_id):
+    """Tính lại stock_holdings từ toàn bộ stock_orders (giá vốn bình quân, giống StockManager._apply_order)"""
+    pos = {}
+    for symbol, t, qty, price, fee in conn.execute("SELECT symbol, type, qty, price, fee FROM stock_orders WHERE user_id = ? ORDER BY date, id", (user_id,)):
+        q, cost = pos.get(symbol, (0.0, 0.0))
+        if t == 'Mua': pos[symbol] = (q + qty, cost + qty * price + (fee or 0))
+        elif q > 0:
+            left = max(0.0, q - qty); pos[symbol] = (left, cost * left / q)
+    conn.execute("DELETE FROM stock_holdings WHERE user_id = ?", (user_id,))
+    conn.executemany("INSERT INTO stock_holdings (user_id, symbol, qty, avg_price, total_cost) VALUES (?, ?, ?, ?, ?)",
+                     [(user_id, s, q, c / q, c) for s, (q, c) in pos.items() if q > 1e-9])
+
+def _chunks(rows, line_no, convert, cols, default_category, stats):
+    """Đọc + chuẩn hóa dòng (ngoài khóa ghi), sinh từng khối tối đa IMPORT_CHUNK_ROWS giá trị"""
+    chunk = []
+    for line_no, row in enumerate(rows, line_no):
+        if not row or all(v in (None, '') for v in row): continue
+        try:
+            values = convert(row, cols, default_category)
+        except (ValueError, TypeError) as e:
+            stats['errors'] += 1
+            if len(stats['error_lines']) < 5: stats['error_lines'].append(f"{line_no}: {e}")
+            continue
+        chunk.append(values)
+        if len(chunk) >= IMPORT_CHUNK_ROWS: yield chunk; chunk = []
+    if chunk: yield chunk
+
+def import_statement(path, name, user_id, default_category=None):
+    """Nhập sao kê CSV/XLSX: đọc, chuẩn hóa và băm từng khối ngoài khóa ghi, chỉ giữ db.writer() quanh mỗi executemany.
+    stock_holdings được tính lại trong giao dịch của khối cuối (lỗi giữa chừng thì tính lại ngay), nên không lệch với
+    stock_orders; tải lại sau khi lỗi vẫn an toàn nhờ content_hash. Trả về dict: kind, inserted, duplicates, errors,
+    error_lines (tối đa 5 dòng đầu bị lỗi)"""
+    kind, cols, rows, line_no = read_rows(path, name)
+    convert, sql = TARGETS[kind]
+    stats = {'kind': kind, 'inserted': 0, 'duplicates': 0, 'errors': 0, 'error_lines': []}
+    # Đếm số lần xuất hiện trên cả file (không phụ thuộc thứ tự dòng hay ranh giới khối); chỉ giữ digest 16 byte mỗi dòng
+    seen, valid = {}, 0
+    chunks = _chunks(rows, line_no, convert, cols, default_category, stats)
+    chunk = next(chunks, None)
+    try:
+        while chunk is not None:
+            batch = []
+            for values in chunk:
+                base = hashlib.blake2b(repr(values).encode(), digest_size=16).digest()
+                seen[base] = occurrence = seen.get(base, 0) + 1
+                batch.append((user_id, *values, content_hash(kind, values, occurrence)))
+            valid += len(batch)
+            # Đọc trước khối sau (ngoài khóa) để biết khối này có phải khối cuối không
+            chunk = next(chunks, None)
+            with db.writer() as conn:
+                # rowcount không tính dòng bị OR IGNORE bỏ qua và dòng do trigger ghi
+                stats['inserted'] += conn.executemany(sql, batch).rowcount
+                if chunk is None and kind == 'orders' and stats['inserted']: rebuild_holdings(conn, user_id)
+    except BaseException:
+        if kind == 'orders' and stats['inserted']:
+            with db.writer() as conn: rebuild_holdings(conn, user_id)
+        raise
+    stats['duplicates'] = valid - stats['inserted']
+    return stats
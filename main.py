@@ -1,62 +1,69 @@
+import time
+_T0 = time.perf_counter()  # mốc đo thời gian khởi động (trước mọi import nặng)
 import os
-import sqlite3
 import logging
 import datetime
-import io
 import re
 import asyncio
-import pandas as pd
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import matplotlib.ticker as ticker
+import weakref
+import functools
 from ai_assistant import portfolio_ai
 from exporter import reporter
+from db import db, DB_FILE
+from schema import init_db, verify_totals, OWNER_CHAT_ID
+from charts import chart_service
+import backup
+from metrics import metrics
+from file_cache import file_cache
+import search
+from notifier import notifier
+from quotes import quote_service
+from scheduler import scheduler
+from price_alerts import price_alerts, PriceAlertError
+import price_alerts as alert_rules
 from telegram import (
     Update, ReplyKeyboardMarkup, InlineKeyboardButton, 
-    InlineKeyboardMarkup
+    InlineKeyboardMarkup, InputMediaPhoto
 )
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
     CallbackQueryHandler, filters, ContextTypes
 )
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
-DB_FILE = 'portfolio.db'
-
-try:
-    from data import INITIAL_ASSETS, INITIAL_TRANSACTIONS
-except ImportError:
-    INITIAL_ASSETS, INITIAL_TRANSACTIONS = [], []
-
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS assets (category TEXT PRIMARY KEY, current_value REAL)''')
-    # Thêm note TEXT vào lệnh tạo bảng transactions
-    c.execute('''CREATE TABLE IF NOT EXISTS transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, category TEXT, type TEXT, amount REAL, date TEXT, note TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value REAL)''')
-    
-    # Lệnh tự động nâng cấp DB cũ
-    try:
-        c.execute("ALTER TABLE transactions ADD COLUMN note TEXT")
-    except sqlite3.OperationalError:
-        pass
+# Chat quản trị: được backup/restore toàn bộ DB (chứa dữ liệu của mọi người dùng)
+ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_CHAT_IDS", "").replace(" ", "").split(",") if x} | ({OWNER_CHAT_ID} if OWNER_CHAT_ID else set())
 
-    c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('target_asset', 500000000)")
-    
-    c.execute("SELECT COUNT(*) FROM transactions")
-    if c.fetchone()[0] == 0 and INITIAL_TRANSACTIONS:
-        c.executemany("INSERT INTO assets (category, current_value) VALUES (?, ?)", INITIAL_ASSETS)
-        # Thêm cột note rỗng cho dữ liệu ban đầu để tránh lỗi
-        processed_tx = [(*t, "") for t in INITIAL_TRANSACTIONS]
-        c.executemany("INSERT INTO transactions (category, type, amount, date, note) VALUES (?, ?, ?, ?, ?)", processed_tx)
-    conn.commit()
-    conn.close()
+# Webhook: đặt WEBHOOK_URL (URL công khai) để nhận update qua HTTP thay cho polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+PORT = int(os.environ.get("PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# Số update xử lý song song (người khác nhau); cùng 1 chat vẫn tuần tự nhờ chat_lock
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "32"))
+# Trỏ sang Bot API tự host hoặc server giả lập khi thử nghiệm, VD http://127.0.0.1:8081
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "").rstrip("/")
+
+_chat_locks = weakref.WeakValueDictionary()
+
+def chat_lock(chat_id):
+    """Lock riêng của 1 chat, tự giải phóng khi không còn handler nào giữ"""
+    lock = _chat_locks.get(chat_id)
+    if lock is None: lock = _chat_locks[chat_id] = asyncio.Lock()
+    return lock
+
+def per_chat(handler):
+    """Tuần tự hóa các update của cùng 1 chat: máy trạng thái user_data và chuỗi ghi DB không bị chen ngang"""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        if update.effective_chat is None: return await handler(update, context)
+        async with chat_lock(update.effective_chat.id): return await handler(update, context)
+    return wrapper
 
 def format_m(amount): return f"{amount / 1000000:.1f}M" if amount != 0 else "0"
 def format_money(amount): return f"{int(amount):,}"
+def format_rate(rate): return f"{rate * 100:+.1f}%" if rate is not None else "—"
 def parse_amount(text):
     match = re.search(r'^([\d\.]+)(tr|triệu|trieu|m|tỷ|ty|k|nghìn)?$', text.lower().strip().replace(',', '').replace(' ', ''))
     if match:
@@ -67,15 +74,17 @@ def parse_amount(text):
         else: return v
     return None
 
-def get_stats():
-    conn = sqlite3.connect(DB_FILE); c = conn.cursor()
-    assets = {row[0]: row[1] for row in c.execute("SELECT category, current_value FROM assets").fetchall()}
-    tx_data = c.execute("SELECT category, type, SUM(amount) FROM transactions GROUP BY category, type").fetchall()
-    target_asset = (c.execute("SELECT value FROM settings WHERE key='target_asset'").fetchone() or [500000000])[0]
-    conn.close()
+def _load_stats(c, uid):
+    assets = {row[0]: row[1] for row in c.execute("SELECT category, current_value FROM assets WHERE user_id = ?", (uid,)).fetchall()}
+    tx_data = c.execute("SELECT category, type, total FROM tx_totals WHERE user_id = ?", (uid,)).fetchall()
+    target_asset = (c.execute("SELECT value FROM settings WHERE user_id = ? AND key='target_asset'", (uid,)).fetchone() or [500000000])[0]
+    return assets, tx_data, target_asset
+
+async def get_stats(uid):
+    assets, tx_data, target_asset = await db.read(_load_stats, uid)
     s = {'Crypto': {'Nạp': 0, 'Rút': 0}, 'Stock': {'Nạp': 0, 'Rút': 0}, 'Cash': {'Nạp': 0, 'Rút': 0}}
     for cat, t_type, amt in tx_data:
-        if cat in s: s[cat][t_type] = amt
+        if cat in s and t_type in s[cat]: s[cat][t_type] = amt
     res, tv, tn, trut = {}, 0, 0, 0
     for cat in ['Crypto', 'Stock', 'Cash']:
         hc = assets.get(cat, 0); nap = s[cat]['Nạp']; rut = s[cat]['Rút']
@@ -85,9 +94,143 @@ def get_stats():
     tvon = tn - trut; tlai = tv - tvon; tlai_pct = (tlai/tvon*100) if tvon!=0 else 0
     return {'total_val': tv, 'total_von': tvon, 'total_lai': tlai, 'total_lai_pct': tlai_pct, 'total_nap': tn, 'total_rut': trut, 'target_asset': target_asset, 'progress': (tv/target_asset*100) if target_asset>0 else 0, 'details': res}
 
+async def get_returns(uid, start=None, end=None):
+    """XIRR/TWR theo danh mục và tổng ('*'), cache theo phiên bản sổ cái nên gọi lại gần như tức thì"""
+    from performance import performance  # numpy chỉ nạp khi có người xem hiệu suất lần đầu
+    return await db.read(lambda c: performance.returns(uid, start, end, c))
+
+async def get_holdings_block(uid):
+    """Khối cổ phiếu đang nắm giữ định giá theo thị trường (1 lần lấy giá cho mọi mã); chưa có giá thì theo giá vốn"""
+    if not await db.fetchone("SELECT 1 FROM stock_holdings WHERE user_id = ? AND qty > 0 LIMIT 1", (uid,)): return ""
+    from stock_manager import stock_manager  # kéo theo numpy (analytics): chỉ nạp khi người dùng có cổ phiếu
+    p = await stock_manager.get_live_summary(uid)
+    lines = [f"• {h['symbol']}: {h['qty']:g} × {format_money(h['market_price']) if h['market_price'] is not None else 'giá vốn'}"
+             f" = {format_money(h['market_value'])} ({'+' if h['unrealized_pnl'] >= 0 else ''}{format_money(h['unrealized_pnl'])})" for h in p['holdings']]
+    return "🧾 *CỔ PHIẾU (giá thị trường)*\n" + "\n".join(lines) + f"\n💼 Giá trị: {format_money(p['stock_value'])} | NAV: {format_money(p['nav'])}\n\n"
+
+def returns_line(r): return f"📐 XIRR/năm: {format_rate(r['xirr'])} | TWR: {format_rate(r['twr'])}"
+
+# Khoảng thời gian của biểu đồ vốn: số ngày lùi lại (YTD = từ 1/1, ALL = toàn bộ)
+CHART_RANGES = {'1M': 30, '6M': 182, 'YTD': None, 'ALL': None}
+CHART_MAX_POINTS = int(os.environ.get("CHART_MAX_POINTS", "365"))
+
+def chart_start(rng, today=None):
+    today = today or datetime.date.today()
+    if rng == 'YTD': return today.replace(month=1, day=1).isoformat()
+    return (today - datetime.timedelta(days=CHART_RANGES[rng])).isoformat() if CHART_RANGES.get(rng) else ''
+
+def downsample(points, limit=CHART_MAX_POINTS):
+    """Giảm số điểm của chuỗi bậc thang: giữ điểm cuối mỗi bước (giá trị đúng của cả bước) và luôn giữ điểm đầu"""
+    if len(points) <= limit: return points
+    step = -(-len(points) // limit); out = points[::-1][::step][::-1]
+    return out if out[0] is points[0] else [points[0]] + out
+
+def _load_series(c, uid, start):
+    # Điểm cuối trước khoảng xem được kéo vào làm điểm mở đầu để đường vốn không bắt đầu từ 0
+    caps = c.execute("""SELECT date, cap FROM (SELECT date, SUM(SUM(net_flow)) OVER (ORDER BY date) AS cap FROM daily_flows WHERE user_id = ? GROUP BY date)
+                        WHERE date >= (SELECT COALESCE(MAX(date), '') FROM daily_flows WHERE user_id = ? AND date < ?)""", (uid, uid, start)).fetchall()
+    vals = c.execute("""SELECT date, value FROM daily_values WHERE user_id = ? AND category = '*'
+                        AND date >= (SELECT COALESCE(MAX(date), '') FROM daily_values WHERE user_id = ? AND category = '*' AND date < ?) ORDER BY date""", (uid, uid, start)).fetchall()
+    total = c.execute("SELECT COALESCE(SUM(current_value), 0) FROM assets WHERE user_id = ?", (uid,)).fetchone()[0]
+    return caps, vals, total
+
+async def get_chart(uid, rng='ALL'):
+    start = chart_start(rng)
+    caps, vals, total = await db.read(_load_series, uid, start)
+    if not caps: return None, None
+    caps, vals = [(max(d, start), v) for d, v in downsample(caps)], [(max(d, start), v) for d, v in downsample(vals)]
+    png = await chart_service.capital_chart([d for d, _ in caps], [v for _, v in caps], total, [d for d, _ in vals], [v for _, v in vals])
+    kb = [[InlineKeyboardButton(("• " if r == rng else "") + ("Tất cả" if r == 'ALL' else r), callback_data=f"chart_{r}") for r in CHART_RANGES]]
+    return png, InlineKeyboardMarkup(kb)
+
+# Thống kê theo kỳ: quý/năm được cộng từ các dòng tháng ('YYYY-MM') của period_rollups
+PERIOD_KEYS = {'M': "month", 'Q': "substr(month, 1, 4) || '-Q' || ((CAST(substr(month, 6, 2) AS INTEGER) + 2) / 3)", 'Y': "substr(month, 1, 4)"}
+PERIOD_BUTTONS = {'M': '🗓️ Tháng', 'Q': '📆 Quý', 'Y': '📅 Năm'}
+CATEGORY_ICONS = {'Crypto': '🟡', 'Stock': '📈', 'Cash': '💵'}
+
+def format_signed(amount): return ("+" if amount > 0 else "") + format_m(amount)
+def period_label(p): return f"{p[5:]}/{p[:4]}" if len(p) > 4 else p
+
+def _load_periods(c, uid, grain, since):
+    return c.execute(f"""SELECT {PERIOD_KEYS[grain]} AS p, category, SUM(inflow), SUM(outflow), SUM(cnt) FROM period_rollups
+                         WHERE user_id = ? AND month >= ? AND month GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]' GROUP BY 1, 2 HAVING SUM(cnt) > 0 ORDER BY 1 DESC""", (uid, since)).fetchall()
+
+def _load_range(c, uid, lo, hi):
+    # Khoảng ngày YYYYMMDD trên cột date_int (chỉ mục phủ), không phải parse chuỗi ngày
+    tx = c.execute("SELECT COALESCE(SUM(CASE WHEN type = 'Nạp' THEN amount ELSE -amount END), 0), COUNT(*) FROM transactions WHERE user_id = ? AND date_int BETWEEN ? AND ?", (uid, lo, hi)).fetchone()
+    orders = c.execute("SELECT COUNT(*), COALESCE(SUM(qty * price), 0) FROM stock_orders WHERE user_id = ? AND date_int BETWEEN ? AND ?", (uid, lo, hi)).fetchone()
+    return tx + orders
+
+def _load_month_view(c, uid, today):
+    cur = today.replace(day=1); prev_last = cur - datetime.timedelta(days=1)
+    prev, prev_same_day = prev_last.replace(day=1), prev_last.replace(day=min(today.day, prev_last.day))
+    as_int = lambda d: int(d.strftime("%Y%m%d"))
+    rows = _load_periods(c, uid, 'M', (cur - datetime.timedelta(days=160)).strftime("%Y-%m"))
+    return rows, _load_range(c, uid, as_int(cur), as_int(today)), _load_range(c, uid, as_int(prev), as_int(prev_same_day))
+
+async def get_period_report(uid, grain='M'):
+    """Màn '🗓️ Theo kỳ': tháng này so với tháng trước (kèm cùng kỳ tới hôm nay), 4 quý gần nhất, hoặc từng năm"""
+    today = datetime.date.today()
+    if grain == 'M':
+        rows, mtd, prev_mtd = await db.read(_load_month_view, uid, today)
+    else:
+        rows = await db.read(_load_periods, uid, grain, f"{today.year - 1}-01" if grain == 'Q' else "")
+    by = {}
+    for p, cat, i, o, n in rows: by.setdefault(p, {})[cat] = (i, o, n)
+    total = lambda p: tuple(map(sum, zip(*by.get(p, {}).values()))) or (0, 0, 0)
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton(("• " if g == grain else "") + name, callback_data=f"per_{g}") for g, name in PERIOD_BUTTONS.items()]])
+    if grain == 'M':
+        cur, prev = today.strftime("%Y-%m"), (today.replace(day=1) - datetime.timedelta(days=1)).strftime("%Y-%m")
+        lines = [f"🗓️ THÁNG {period_label(cur)} so với {period_label(prev)}"]
+        for cat in ['Crypto', 'Stock', 'Cash']:
+            i, o, n = by.get(cur, {}).get(cat, (0, 0, 0)); pi, po, pn = by.get(prev, {}).get(cat, (0, 0, 0))
+            lines.append(f"{CATEGORY_ICONS[cat]} {cat}: Nạp {format_m(i)} | Rút {format_m(o)} | Ròng {format_signed(i - o)} (tháng trước {format_signed(pi - po)})")
+        (i, o, n), (pi, po, pn) = total(cur), total(prev)
+        lines.append(f"Σ Tổng: Ròng {format_signed(i - o)} ({n} GD) | tháng trước {format_signed(pi - po)} ({pn} GD)")
+        lines.append(f"\n⏱️ Cùng kỳ ngày 1–{today.day}: ròng {format_signed(mtd[0])} ({mtd[1]} GD) | tháng trước {format_signed(prev_mtd[0])} ({prev_mtd[1]} GD)")
+        lines.append(f"📈 Lệnh CK: {mtd[2]} lệnh, GTGD {format_m(mtd[3])} | tháng trước {prev_mtd[2]} lệnh, {format_m(prev_mtd[3])}")
+        lines.append("\n📋 Ròng 6 tháng gần nhất:\n" + "\n".join(f"{period_label(p)}: {format_signed(total(p)[0] - total(p)[1])} ({total(p)[2]} GD)" for p in sorted(by, reverse=True)[:6]))
+        return "\n".join(lines), kb
+    periods = sorted(by, reverse=True)[:4] if grain == 'Q' else sorted(by, reverse=True)
+    if not periods: return "Chưa có giao dịch.", kb
+    lines = ["📆 4 QUÝ GẦN NHẤT" if grain == 'Q' else "📅 TỔNG KẾT THEO NĂM"]
+    for k, p in enumerate(periods):
+        i, o, n = total(p)
+        change = ""
+        if grain == 'Y' and k + 1 < len(periods):
+            pi, po, _ = total(periods[k + 1]); change = f" | Δ ròng so với {periods[k + 1]}: {format_signed((i - o) - (pi - po))}"
+        lines.append(f"\n{period_label(p)}: Nạp {format_m(i)} | Rút {format_m(o)} | Ròng {format_signed(i - o)} ({n} GD){change}")
+        lines += [f"   {CATEGORY_ICONS.get(cat, '•')} {cat}: {format_signed(ci - co)}" for cat, (ci, co, cn) in sorted(by[p].items()) if cn]
+    return "\n".join(lines), kb
+
+# Telegram giới hạn tần suất sửa tin nhắn: gom các đoạn AI trả về, tối đa 1 lần sửa mỗi AI_EDIT_INTERVAL giây
+AI_EDIT_INTERVAL = float(os.environ.get("AI_EDIT_INTERVAL", "1.2"))
+TG_MAX_LEN = 4096
+
+async def _safe_edit(message, text, final=False):
+    try: await message.edit_text(text)
+    except RetryAfter as e:
+        # Bản tạm thì bỏ qua (lần sau gửi bản đầy đủ hơn), bản cuối thì chờ rồi gửi lại
+        if final: await asyncio.sleep(e.retry_after if isinstance(e.retry_after, (int, float)) else e.retry_after.total_seconds()); await message.edit_text(text)
+    except BadRequest as e:
+        if 'not modified' not in str(e).lower(): raise
+
+async def stream_to_message(placeholder, chunks):
+    """Sửa dần tin nhắn chờ theo luồng text, có throttle; phần vượt 4096 ký tự gửi thành tin mới"""
+    text, last_edit = "", 0.0
+    async for chunk in chunks:
+        text += chunk
+        now = time.monotonic()
+        if now - last_edit >= AI_EDIT_INTERVAL and len(text) < TG_MAX_LEN - 2:
+            last_edit = now
+            await _safe_edit(placeholder, text + " ▌")
+    if not text.strip(): text = "❌ AI không trả lời."
+    await _safe_edit(placeholder, text[:TG_MAX_LEN], final=True)
+    for i in range(TG_MAX_LEN, len(text), TG_MAX_LEN): await placeholder.reply_text(text[i:i + TG_MAX_LEN])
+
 def get_main_menu(): return ReplyKeyboardMarkup([['🏦 Quản lý Tài sản', '💸 Giao dịch'], ['📊 Thống kê', '🤖 Trợ lý AI'], ['⚙️ Hệ thống']], resize_keyboard=True)
 def get_asset_menu(): return ReplyKeyboardMarkup([['💰 Xem Tổng Tài sản', '💵 Cập nhật Số dư'], ['💳 Quỹ Tiền mặt', '🎯 Đặt Mục tiêu'], ['🏠 Menu Chính']], resize_keyboard=True)
-def get_stats_menu(): return ReplyKeyboardMarkup([['📜 Lịch sử', '🥧 Phân bổ', '📈 Biểu đồ'], ['🏠 Menu Chính']], resize_keyboard=True)
+def get_stats_menu(): return ReplyKeyboardMarkup([['📜 Lịch sử', '🥧 Phân bổ', '📈 Biểu đồ'], ['🗓️ Theo kỳ', '🔍 Tìm kiếm', '🏠 Menu Chính']], resize_keyboard=True)
 def get_sys_menu(): 
     return ReplyKeyboardMarkup([
         ['💾 Backup DB', '♻️ Restore DB'], # Hàng 1
@@ -95,58 +238,170 @@ def get_sys_menu():
         ['🏠 Menu Chính']                 # Hàng 3
     ], resize_keyboard=True)
 
-def get_history_menu(page=None):
-    conn = sqlite3.connect(DB_FILE)
-    rows = conn.execute("SELECT id, category, type, amount, date FROM transactions ORDER BY date DESC, id DESC").fetchall(); conn.close()
+PAGE_SIZE = 10
+
+def page_token(page, cursor=None):
+    """Mã hóa trang lịch sử vào callback_data: '<số trang>.<ngày>.<id>' của dòng đầu trang"""
+    return f"{page}.{cursor[0]}.{cursor[1]}" if cursor else str(page)
+
+def parse_page_token(bd):
+    if bd is None or bd == "recent": return None, None
+    p = bd.split(".")
+    return int(p[0]), ((p[1], int(p[2])) if len(p) == 3 else None)
+
+def _load_history_page(c, uid, cursor):
+    # Seek theo chỉ mục (user_id, date, id): chi phí trang N bằng trang 1, lấy dư 1 dòng làm con trỏ trang sau
+    if cursor is None:
+        rows = c.execute("SELECT id, category, type, amount, date FROM transactions WHERE user_id = ? ORDER BY date DESC, id DESC LIMIT ?", (uid, PAGE_SIZE + 1)).fetchall()
+        prev = None
+    else:
+        rows = c.execute("SELECT id, category, type, amount, date FROM transactions WHERE user_id = ? AND (date, id) <= (?, ?) ORDER BY date DESC, id DESC LIMIT ?", (uid, *cursor, PAGE_SIZE + 1)).fetchall()
+        prev = c.execute("SELECT date, id FROM transactions WHERE user_id = ? AND (date, id) > (?, ?) ORDER BY date ASC, id ASC LIMIT 1 OFFSET ?", (uid, *cursor, PAGE_SIZE - 1)).fetchone()
+    return rows, prev
+
+async def get_history_menu(uid, page=None):
+    """page: None = 10 giao dịch gần nhất, hoặc page token lấy từ callback_data"""
+    pg, cursor = parse_page_token(page)
+    rows, prev = await db.read(_load_history_page, uid, cursor)
+    if not rows and cursor is not None: pg, cursor = 0, None; rows, prev = await db.read(_load_history_page, uid, None)
+    # Trang không có con trỏ luôn là trang đầu, dù token ghi số trang nào
+    if pg is not None and cursor is None: pg = 0
     if not rows: return "Chưa có giao dịch.", None
-    PAGE_SIZE = 10
-    if page is None: display, bd, msg = rows[:10], "recent", "📜 10 GIAO DỊCH GẦN NHẤT\n\nClick để Sửa/Xóa:"
-    else: start = page * PAGE_SIZE; display, bd, msg = rows[start:start+PAGE_SIZE], str(page), f"📜 LỊCH SỬ (Trang {page+1})"
+    display, has_next = rows[:PAGE_SIZE], len(rows) > PAGE_SIZE
+    if pg is None: bd, msg = "recent", "📜 10 GIAO DỊCH GẦN NHẤT\n\nClick để Sửa/Xóa:"
+    else: bd, msg = page_token(pg, cursor), f"📜 LỊCH SỬ (Trang {pg+1})"
     kb = []
     emojis = ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣', '7️⃣', '8️⃣', '9️⃣', '🔟']
     for i, r in enumerate(display): kb.append([InlineKeyboardButton(f"{emojis[i] if i<10 else i+1}. {r[1]} | {r[2]} {format_money(r[3])} ({r[4]})", callback_data=f"hist_{r[0]}_{bd}")])
-    if page is None: kb.append([InlineKeyboardButton("📄 Xem full lịch sử", callback_data="view_page_0")])
+    if pg is None: kb.append([InlineKeyboardButton("📄 Xem full lịch sử", callback_data="view_page_0")])
     else:
         nav = []
-        if page > 0: nav.append(InlineKeyboardButton("⬅️ Trước", callback_data=f"view_page_{page-1}"))
-        if (page+1)*PAGE_SIZE < len(rows): nav.append(InlineKeyboardButton("Sau ➡️", callback_data=f"view_page_{page+1}"))
+        # Phía trước còn ít hơn 1 trang (dòng mới hơn đã bị xóa): lùi thẳng về trang đầu thay vì 1 trang sai số thứ tự
+        if pg > 0: nav.append(InlineKeyboardButton("⬅️ Trước", callback_data=f"view_page_{page_token(pg-1, prev) if pg > 1 and prev is not None else page_token(0)}"))
+        if has_next: nav.append(InlineKeyboardButton("Sau ➡️", callback_data=f"view_page_{page_token(pg+1, (rows[-1][4], rows[-1][0]))}"))
         if nav: kb.append(nav)
         kb.append([InlineKeyboardButton("⬅️ Đóng", callback_data="back_to_recent")])
     return msg, InlineKeyboardMarkup(kb)
 
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+SEARCH_HELP = ("🔍 Nhập từ khóa ghi chú và/hoặc bộ lọc, VD:\n`lương 2024`\n`crypto rút >5tr`\n`thưởng 1tr-10tr 01/2025..06/2025`\n\n"
+               "Bộ lọc: crypto/stock/cash, nạp/rút, >5tr <=10tr 1tr-5tr, 2024 03/2024 15/03/2024 (khoảng: A..B)")
+
+PRICE_ALERT_HELP = ("🔔 Đặt cảnh báo giá cổ phiếu:\n`/canhbao FPT <90000` giá xuống dưới 90,000\n`/canhbao FPT >110k` giá vượt 110,000\n"
+                    "`/canhbao FPT -5%` giá thấp hơn giá vốn 5%\n`/canhbao FPT +10%` lãi 10% so với giá vốn\n\nXóa: `/xoacanhbao 3`, `/xoacanhbao FPT`, `/xoacanhbao all`")
+
+async def get_price_alerts(uid):
+    alerts = await price_alerts.user_alerts(uid)
+    if not alerts: return "🔕 Chưa có cảnh báo giá nào.\n\n" + PRICE_ALERT_HELP
+    return "🔔 CẢNH BÁO GIÁ\n" + "\n".join(f"`{aid}`. {alert_rules.describe(a)}" + (" ✅ đã báo" if a['fired'] else "") for aid, a in alerts) + "\n\n" + PRICE_ALERT_HELP
+
+async def get_search_menu(uid, query, page=None):
+    """Kết quả tìm kiếm theo trang; câu tìm kiếm nằm trong user_data, callback_data chỉ mang page token như màn lịch sử"""
+    f = search.parse_query(query, parse_amount)
+    pg, cursor = parse_page_token(page)
+    rows, prev, summary = await db.read(search.load_page, uid, f, cursor)
+    if not rows: return f"🔍 Không có giao dịch nào khớp: {search.describe(f)}", None
+    display, has_next, pg = rows[:search.SEARCH_PAGE_SIZE], len(rows) > search.SEARCH_PAGE_SIZE, pg or 0
+    msg = f"🔍 {search.describe(f)}\n" + (f"Tìm thấy {summary[0]} giao dịch | 📤 Nạp: {format_money(summary[1])} | 📥 Rút: {format_money(summary[2])}\n" if summary else f"Trang {pg+1}\n")
+    msg += "\n".join(f"• {r[4]} | {r[1]} | {r[2]} {format_money(r[3])}" + (f"\n   📝 {r[5][:80]}" if r[5] else "") for r in display)
+    nav = []
+    if pg > 0: nav.append(InlineKeyboardButton("⬅️ Trước", callback_data=f"srch_{page_token(pg-1, prev if pg > 1 else None)}"))
+    if has_next: nav.append(InlineKeyboardButton("Sau ➡️", callback_data=f"srch_{page_token(pg+1, (rows[-1][4], rows[-1][0]))}"))
+    return msg, InlineKeyboardMarkup([nav]) if nav else None
+
+# Nhãn đo độ trễ: chỉ dùng tập giá trị hữu hạn (nút menu, lệnh, trạng thái, tiền tố callback) để metrics không phình theo nội dung người dùng gõ
+MENU_ACTIONS = {b.text for mk in (get_main_menu(), get_asset_menu(), get_stats_menu(), get_sys_menu()) for row in mk.keyboard for b in row} | {'➕ Nạp tiền', '➖ Rút tiền', '🧹 Xóa trí nhớ AI'}
+CALLBACK_PREFIXES = ('view_page_', 'back_view_', 'back_to_recent', 'hist_', 'edit_', 'del_', 'undo_', 'bal_', 'cat_', 'chart_', 'srch_', 'per_')
+
+def text_action(update, context):
     text = update.message.text.strip(); state = context.user_data.get('state')
+    if text.startswith('/'): return text.split()[0].split('@')[0]
+    if text in MENU_ACTIONS: return text
+    return "state:" + "_".join(str(state).split("_")[:2]) if state else 'other'
+
+def callback_action(update, context):
+    return next((p for p in CALLBACK_PREFIXES if (update.callback_query.data or '').startswith(p)), 'other')
+
+def metrics_report():
+    lines = ["⏱️ ĐỘ TRỄ HANDLER (n | tb | p95≤)"] + [f"{a}: {n} | {avg*1000:.0f}ms | {p95*1000:g}ms" for a, n, avg, p95 in metrics.summary('handler_seconds')]
+    lines += ["", "🗄️ SQL TỐN THỜI GIAN NHẤT"] + [f"{n} | {avg*1000:.2f}ms | {a[:80]}" for a, n, avg, p95 in metrics.summary('db_query_seconds', limit=5)]
+    return "\n".join(lines)
+
+@metrics.timed_handler('text', text_action)
+@per_chat
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip(); state = context.user_data.get('state'); uid = update.effective_chat.id
 
     if text in ['/start', '🏠 Menu Chính']:
         context.user_data.clear(); await update.message.reply_text("🏠 DASHBOARD CHÍNH", reply_markup=get_main_menu()); return
 
+    elif text == '/kiem_tra_db' and uid in ADMIN_IDS:
+        bad = await db.write(verify_totals)
+        if bad: await update.message.reply_text("🛠️ Bảng tổng hợp bị lệch ở: " + ", ".join(f"{u}/{c}/{t}" for u, c, t in bad) + "\n✅ Đã tính lại từ lịch sử giao dịch.")
+        else: await update.message.reply_text("✅ Bảng tổng hợp khớp với lịch sử giao dịch.")
+        return
+
+    elif text == '/metrics' and uid in ADMIN_IDS:
+        await update.message.reply_text(metrics_report())
+        await update.message.reply_document(document=metrics.render().encode(), filename="metrics.txt"); return
+
     # --- TÍNH NĂNG MỚI: NÚT XÓA TRÍ NHỚ TÍCH HỢP ---
     elif text in ['/xoa_tri_nho', '🧹 Xóa trí nhớ AI']:
-        portfolio_ai.chat_history = []
+        portfolio_ai.clear_history(uid)
         await update.message.reply_text("🧹 Đã xóa sạch trí nhớ của AI! Bộ não đã được làm trống. Hãy bắt đầu một chủ đề phân tích mới nhé.")
         return
 
+    elif text.split()[0].split('@')[0] == '/tim' or text == '🔍 Tìm kiếm':
+        query = (text.split(maxsplit=1) + [''])[1] if text.startswith('/') else ''
+        if not query: context.user_data['state'] = 'awaiting_search'; await update.message.reply_text(SEARCH_HELP, parse_mode='Markdown'); return
+        context.user_data.pop('state', None); context.user_data['search'] = query
+        msg, mk = await get_search_menu(uid, query); await update.message.reply_text(msg, reply_markup=mk)
+        return
+
     if text == '🏦 Quản lý Tài sản': await update.message.reply_text("🏦 QUẢN LÝ TÀI SẢN", reply_markup=get_asset_menu())
+    elif text.split()[0].split('@')[0] == '/canhbao':
+        args = text.split(maxsplit=2)[1:]
+        if len(args) < 2: await update.message.reply_text(await get_price_alerts(uid), parse_mode='Markdown'); return
+        try:
+            a = await price_alerts.add(uid, args[0], *alert_rules.parse_rule(args[1], parse_amount))
+            await update.message.reply_text(f"✅ Đã đặt cảnh báo: {alert_rules.describe(a)}")
+        except ValueError: await update.message.reply_text(PRICE_ALERT_HELP, parse_mode='Markdown')
+        except PriceAlertError as e: await update.message.reply_text(f"❌ {e}")
+        return
+
+    elif text.split()[0].split('@')[0] == '/xoacanhbao':
+        target = (text.split(maxsplit=1) + [''])[1]
+        if not target: await update.message.reply_text(await get_price_alerts(uid), parse_mode='Markdown'); return
+        n = await price_alerts.remove(uid, target)
+        await update.message.reply_text(f"🗑️ Đã xóa {n} cảnh báo." if n else "❌ Không tìm thấy cảnh báo đó."); return
+
     elif text == '📊 Thống kê': await update.message.reply_text("📊 THỐNG KÊ", reply_markup=get_stats_menu())
     elif text == '⚙️ Hệ thống':
         await update.message.reply_text("⚙️ HỆ THỐNG", reply_markup=get_sys_menu())
 
-    elif text == '💾 Backup DB':
+    elif text in ['💾 Backup DB', '♻️ Restore DB', '/backup_delta'] and uid not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Chỉ quản trị viên mới được sao lưu/khôi phục toàn bộ Database.")
+
+    elif text in ['💾 Backup DB', '/backup_delta']:
         if os.path.exists(DB_FILE):
-            await update.message.reply_document(document=open(DB_FILE, 'rb'), filename=DB_FILE, caption="📦 Đây là file Database dự phòng. Hãy tải về và cất giữ cẩn thận!")
+            # Chụp nhất quán qua backup API rồi nén, không gửi thẳng file đang được ghi
+            path = await asyncio.to_thread(backup.create_backup, text == '/backup_delta')
+            with open(path, 'rb') as f: await update.message.reply_document(document=f, filename=os.path.basename(path), caption="📦 Đây là file Database dự phòng (nén gzip). Hãy tải về và cất giữ cẩn thận!")
         else:
             await update.message.reply_text("❌ Chưa có dữ liệu để backup.")
 
     elif text == '♻️ Restore DB':
-        await update.message.reply_text("🛠️ **HƯỚNG DẪN KHÔI PHỤC:**\n\nHãy gửi file `portfolio.db` lên đây. Bot sẽ tự động nhận diện và khôi phục dữ liệu cho bạn.", parse_mode='Markdown')
+        await update.message.reply_text("🛠️ **HƯỚNG DẪN KHÔI PHỤC:**\n\nHãy gửi file `.db`, bản sao lưu `.db.gz` hoặc bản vi sai `.delta.gz` (`/backup_delta`, cần bản full gốc còn trên máy chủ) lên đây. Bot sẽ kiểm tra file rồi mới thay thế dữ liệu hiện tại.", parse_mode='Markdown')
 
     elif text == '📊 Xuất Excel':
         loading = await update.message.reply_text("⌛ Đang trích xuất dữ liệu và vẽ biểu đồ...")
         # Gọi module exporter
-        excel_file = reporter.export_excel_report()
+        excel_file = await reporter.export(uid)
         if excel_file:
             await loading.delete()
-            await update.message.reply_document(document=excel_file, filename=f"Bao_Cao_{datetime.datetime.now().strftime('%d-%m-%Y')}.xlsx", caption="✅ Gửi bạn báo cáo tài chính chi tiết.")
+            name = f"Bao_Cao_{datetime.datetime.now().strftime('%d-%m-%Y')}.xlsx"
+            # Báo cáo lấy từ cache của exporter (dữ liệu chưa đổi) trùng nội dung -> gửi lại bằng file_id; file gửi thẳng từ đĩa
+            with excel_file:
+                await file_cache.send(lambda media: update.message.reply_document(document=media, filename=name, caption="✅ Gửi bạn báo cáo tài chính chi tiết."), excel_file, 'excel', name)
         else:
             await loading.delete()
             await update.message.reply_text("❌ Lỗi: Không thể tạo báo cáo. Có thể Database đang trống.")
@@ -165,7 +420,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif state == 'chatting_ai':
         # 1. Thu thập dữ liệu ổn định từ hàm get_stats() của bạn
-        s = get_stats()
+        s = await get_stats(uid); r = await get_returns(uid)
         d = s['details']
         loading = await update.message.reply_text("⌛ AI đang soi chi tiết bảng tài sản của bạn...")
         
@@ -179,67 +434,58 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"- Crypto: Có {format_money(d['Crypto']['hien_co'])}đ, Vốn {format_money(d['Crypto']['von'])}đ, Lãi {d['Crypto']['pct']:.1f}%\n"
             f"- Stock: Có {format_money(d['Stock']['hien_co'])}đ, Vốn {format_money(d['Stock']['von'])}đ, Lãi {d['Stock']['pct']:.1f}%\n"
             f"- Tiền mặt: {format_money(d['Cash']['hien_co'])}đ\n"
+            f"- Hiệu suất theo thời điểm nạp/rút (XIRR %/năm, TWR lũy kế): Tổng {format_rate(r['*']['xirr'])} / {format_rate(r['*']['twr'])}, "
+            f"Crypto {format_rate(r['Crypto']['xirr'])} / {format_rate(r['Crypto']['twr'])}, Stock {format_rate(r['Stock']['xirr'])} / {format_rate(r['Stock']['twr'])}\n"
         )
         
         try:
-            # 3. Gửi sang AI (Truyền full_context thay vì chỉ biến s)
-            reply = await portfolio_ai.get_advice(text, full_context)
-            await loading.delete()
-            await update.message.reply_text(reply)
+            # 3. Gửi sang AI và hiển thị dần câu trả lời ngay khi có token đầu tiên
+            await stream_to_message(loading, portfolio_ai.stream_advice(text, full_context, uid))
         except Exception as e:
             await loading.delete()
             await update.message.reply_text(f"❌ Lỗi AI: {e}")
         return
 
     elif text == '💰 Xem Tổng Tài sản':
-        s = get_stats(); d = s['details']
-        msg = (f"🏆 *TỔNG TÀI SẢN*\n`{format_money(s['total_val'])}` VNĐ\n{'📈' if s['total_lai']>=0 else '📉'} {format_money(s['total_lai'])} ({s['total_lai_pct']:.1f}%)\n"
+        s = await get_stats(uid); d = s['details']; r = await get_returns(uid)
+        msg = (f"🏆 *TỔNG TÀI SẢN*\n`{format_money(s['total_val'])}` VNĐ\n{'📈' if s['total_lai']>=0 else '📉'} {format_money(s['total_lai'])} ({s['total_lai_pct']:.1f}%)\n{returns_line(r['*'])}\n"
                f"🎯 Mục tiêu: {s['progress']:.1f}% (`{format_money(s['total_val'])} / {format_money(s['target_asset'])}`)\n----------------------------------\n"
                f"📤 Tổng nạp: {format_money(s['total_nap'])}\n📥 Tổng rút: {format_money(s['total_rut'])}\n----------------------------------\n\n"
                f"🟡 *CRYPTO*\n💰 Hiện có: {format_money(d['Crypto']['hien_co'])}\n🏦 Vốn thực: {format_money(d['Crypto']['von'])}\n"
-               f"📤 Nạp: {format_money(d['Crypto']['nap'])} | 📥 Rút: {format_money(d['Crypto']['rut'])}\n📈 Lãi/Lỗ: {format_money(d['Crypto']['lai'])} ({d['Crypto']['pct']:.1f}%)\n\n"
+               f"📤 Nạp: {format_money(d['Crypto']['nap'])} | 📥 Rút: {format_money(d['Crypto']['rut'])}\n📈 Lãi/Lỗ: {format_money(d['Crypto']['lai'])} ({d['Crypto']['pct']:.1f}%)\n{returns_line(r['Crypto'])}\n\n"
                f"📈 *STOCK*\n💰 Hiện có: {format_money(d['Stock']['hien_co'])}\n🏦 Vốn thực: {format_money(d['Stock']['von'])}\n"
-               f"📤 Nạp: {format_money(d['Stock']['nap'])} | 📥 Rút: {format_money(d['Stock']['rut'])}\n📈 Lãi/Lỗ: {format_money(d['Stock']['lai'])} ({d['Stock']['pct']:.1f}%)\n\n"
-               f"💵 *TIỀN MẶT*: {format_money(d['Cash']['hien_co'])}")
+               f"📤 Nạp: {format_money(d['Stock']['nap'])} | 📥 Rút: {format_money(d['Stock']['rut'])}\n📈 Lãi/Lỗ: {format_money(d['Stock']['lai'])} ({d['Stock']['pct']:.1f}%)\n{returns_line(r['Stock'])}\n\n"
+               f"{await get_holdings_block(uid)}💵 *TIỀN MẶT*: {format_money(d['Cash']['hien_co'])}")
         await update.message.reply_text(msg, parse_mode='Markdown')
 
     elif text == '📈 Biểu đồ':
-        conn = sqlite3.connect(DB_FILE); txs = conn.execute("SELECT date, type, amount FROM transactions ORDER BY date ASC").fetchall(); conn.close()
-        if txs:
-            daily = {}; s = get_stats()
-            for ds, t, a in txs: daily[ds] = daily.get(ds, 0) + (a if t == 'Nạp' else -a)
-            dates, caps, cur = [], [], 0
-            for d_str in sorted(daily.keys()): cur += daily[d_str]; dates.append(datetime.datetime.strptime(d_str, "%Y-%m-%d")); caps.append(cur)
-            fig, ax = plt.subplots(figsize=(10, 5)); ax.plot(dates, caps, color='#1f77b4', linewidth=2, label='Vốn thực nạp ròng', marker='o', markersize=3); ax.fill_between(dates, caps, color='#1f77b4', alpha=0.15)
-            color_t = '#2ecc71' if s['total_val'] >= caps[-1] else '#e74c3c'
-            ax.plot([dates[-1], datetime.datetime.now()], [caps[-1], s['total_val']], label=f"Tài sản thực hiện có", color=color_t, marker='o', linestyle='--', linewidth=2)
-            ax.yaxis.set_major_formatter(ticker.FuncFormatter(lambda x, p: f"{x/1000000:,.0f}M")); ax.xaxis.set_major_formatter(mdates.DateFormatter('%m/%Y'))
-            ax.grid(True, linestyle='--', alpha=0.4); ax.legend(); buf = io.BytesIO(); plt.savefig(buf, format='png', dpi=120); plt.close(); buf.seek(0)
-            await update.message.reply_photo(photo=buf)
+        png, mk = await get_chart(uid)
+        if png: await file_cache.send(lambda media: update.message.reply_photo(photo=media, reply_markup=mk), png, 'chart')
             
     elif text == '🥧 Phân bổ':
-        s = get_stats(); d = s['details']; labels = [l for l in ['Crypto', 'Stock', 'Cash'] if d[l]['hien_co'] > 0]; vals = [d[l]['hien_co'] for l in labels]
-        if vals: plt.figure(figsize=(6,6)); plt.pie(vals, labels=labels, autopct='%1.1f%%', startangle=90); buf = io.BytesIO(); plt.savefig(buf, format='png'); plt.close(); buf.seek(0); await update.message.reply_photo(photo=buf)
+        s = await get_stats(uid); d = s['details']; labels = [l for l in ['Crypto', 'Stock', 'Cash'] if d[l]['hien_co'] > 0]; vals = [d[l]['hien_co'] for l in labels]
+        if vals: png = await chart_service.allocation_chart(labels, vals); await file_cache.send(lambda media: update.message.reply_photo(photo=media), png, 'allocation')
 
-    elif text == '📜 Lịch sử': msg, mk = get_history_menu(); await update.message.reply_text(msg, reply_markup=mk)
+    elif text == '🗓️ Theo kỳ': msg, mk = await get_period_report(uid); await update.message.reply_text(msg, reply_markup=mk)
+    elif text == '📜 Lịch sử': msg, mk = await get_history_menu(uid); await update.message.reply_text(msg, reply_markup=mk)
     elif text == '💵 Cập nhật Số dư': await update.message.reply_text("Chọn tài sản:", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🪙 Crypto", callback_data="bal_Crypto"), InlineKeyboardButton("📈 Stock", callback_data="bal_Stock")], [InlineKeyboardButton("💵 Tiền mặt", callback_data="bal_Cash")]]))
     elif text in ['➕ Nạp tiền', '➖ Rút tiền']: a = 'nap' if 'Nạp' in text else 'rut'; await update.message.reply_text("Chọn danh mục:", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🪙 Crypto", callback_data=f"cat_{a}_Crypto"), InlineKeyboardButton("📈 Stock", callback_data=f"cat_{a}_Stock")], [InlineKeyboardButton("💵 Tiền mặt", callback_data=f"cat_{a}_Cash")]]))
-    elif text == '💳 Quỹ Tiền mặt': d = get_stats()['details']['Cash']; await update.message.reply_text(f"💵 TIỀN MẶT\n💰 Số dư: {format_money(d['hien_co'])}\n📥 Nạp: {format_money(d['nap'])}\n📤 Rút: {format_money(d['rut'])}")
-    elif text == '❓ Hướng dẫn': await update.message.reply_text("📘 **CẨM NANG SỬ DỤNG BOT**\n1️⃣ **Nhập số tiền:** Gõ `10tr`, `50m`.\n2️⃣ **Nạp/Rút:** Có nút **Hoàn tác** để xóa nhanh.\n3️⃣ **AI:** Bấm Trợ lý AI rồi gõ câu hỏi.", parse_mode='Markdown')
+    elif text == '💳 Quỹ Tiền mặt': d = (await get_stats(uid))['details']['Cash']; await update.message.reply_text(f"💵 TIỀN MẶT\n💰 Số dư: {format_money(d['hien_co'])}\n📥 Nạp: {format_money(d['nap'])}\n📤 Rút: {format_money(d['rut'])}")
+    elif text == '❓ Hướng dẫn': await update.message.reply_text("📘 **CẨM NANG SỬ DỤNG BOT**\n1️⃣ **Nhập số tiền:** Gõ `10tr`, `50m`.\n2️⃣ **Nạp/Rút:** Có nút **Hoàn tác** để xóa nhanh. Nhiều giao dịch: gửi file sao kê `.csv`/`.xlsx` (gửi lại không bị trùng).\n3️⃣ **AI:** Bấm Trợ lý AI rồi gõ câu hỏi.\n4️⃣ **Tìm kiếm:** `/tim lương 2024` hoặc nút 🔍 Tìm kiếm trong Thống kê.\n5️⃣ **Cảnh báo giá:** `/canhbao FPT <90000` hoặc `/canhbao FPT -5%` (so với giá vốn).", parse_mode='Markdown')
 
     elif text == '🎯 Đặt Mục tiêu': context.user_data['state'] = 'awaiting_target'; await update.message.reply_text("🎯 Nhập mục tiêu (VD: Hòa vốn, Lãi 15%, 2 tỷ):")
     elif state == 'awaiting_target':
-        s = get_stats(); nt = None; text_l = text.lower()
+        s = await get_stats(uid); nt = None; text_l = text.lower()
         if 'hòa vốn' in text_l or 'hoà vốn' in text_l: nt = s['total_von']
         else:
             m = re.search(r'(lãi|lời|âm|lỗ)\s*([\d\.]+)\s*(%|tr|triệu|m|tỷ|ty|k)?', text_l)
             if m: dv = 1 if m.group(1) in ['lãi', 'lời'] else -1; v, u = float(m.group(2)), m.group(3); nt = s['total_von'] + (s['total_von'] * (dv * v / 100)) if u == '%' else s['total_von'] + (dv * (parse_amount(f"{v}{u or ''}") or 0))
             else: nt = parse_amount(text)
-        if nt is not None: conn = sqlite3.connect(DB_FILE); conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('target_asset', ?)", (nt,)); conn.commit(); conn.close(); context.user_data.clear(); await update.message.reply_text(f"✅ Đã đặt mục tiêu: {format_money(nt)}", reply_markup=get_asset_menu())
+        if nt is not None: await db.execute("INSERT OR REPLACE INTO settings (user_id, key, value) VALUES (?, 'target_asset', ?)", (uid, nt)); context.user_data.clear(); await update.message.reply_text(f"✅ Đã đặt mục tiêu: {format_money(nt)}", reply_markup=get_asset_menu())
 
     elif state and state.startswith('awaiting_balance_'):
         cat, amt = state.split("_")[2], parse_amount(text)
-        if amt is not None: conn = sqlite3.connect(DB_FILE); conn.execute("INSERT OR REPLACE INTO assets (category, current_value) VALUES (?, ?)", (cat, amt)); conn.commit(); conn.close(); context.user_data.clear(); await update.message.reply_text(f"✅ Đã cập nhật {cat}.", reply_markup=get_asset_menu())
+        if amt is not None: await db.execute("INSERT OR REPLACE INTO assets (user_id, category, current_value) VALUES (?, ?, ?)", (uid, cat, amt)); context.user_data.clear(); await update.message.reply_text(f"✅ Đã cập nhật {cat}.", reply_markup=get_asset_menu())
             
     elif state in ['awaiting_nap', 'awaiting_rut']:
         amt = parse_amount(text)
@@ -257,10 +503,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         t_type = 'Nạp' if context.user_data.get('prev_state') == 'awaiting_nap' else 'Rút'
         note = "" if text == "." else text
         
-        conn = sqlite3.connect(DB_FILE); c = conn.cursor()
-        c.execute("INSERT INTO transactions (category, type, amount, date, note) VALUES (?, ?, ?, ?, ?)", 
-                  (cat, t_type, amt, datetime.datetime.now().strftime("%Y-%m-%d"), note))
-        tx_id = c.lastrowid; conn.commit(); conn.close()
+        tx_id = await db.execute("INSERT INTO transactions (user_id, category, type, amount, date, note) VALUES (?, ?, ?, ?, ?, ?)", 
+                                 (uid, cat, t_type, amt, datetime.datetime.now().strftime("%Y-%m-%d"), note))
         
         context.user_data.clear()
         kb = [[InlineKeyboardButton("↩️ Hoàn tác", callback_data=f"undo_{tx_id}")]]
@@ -268,34 +512,119 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                        reply_markup=InlineKeyboardMarkup(kb))
         return
             
+    elif state == 'awaiting_search':
+        context.user_data.pop('state', None); context.user_data['search'] = text
+        msg, mk = await get_search_menu(uid, text); await update.message.reply_text(msg, reply_markup=mk)
+
     elif state and str(state).startswith('awaiting_edit_'):
         parts = state.split("_"); tx_id, bd, amt = parts[2], parts[3], parse_amount(text)
-        if amt is not None: conn = sqlite3.connect(DB_FILE); conn.execute("UPDATE transactions SET amount = ? WHERE id = ?", (amt, tx_id)); conn.commit(); conn.close(); context.user_data.clear(); pg = None if bd == "recent" else int(bd); m, mk = get_history_menu(pg); await update.message.reply_text("✅ Đã sửa giao dịch thành công.\n\n" + m, reply_markup=mk)
+        if amt is not None: await db.execute("UPDATE transactions SET amount = ? WHERE id = ? AND user_id = ?", (amt, tx_id, uid)); context.user_data.clear(); m, mk = await get_history_menu(uid, bd); await update.message.reply_text("✅ Đã sửa giao dịch thành công.\n\n" + m, reply_markup=mk)
 
+@metrics.timed_handler('callback', callback_action)
+@per_chat
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer(); d = q.data
-    if d.startswith("undo_"): conn = sqlite3.connect(DB_FILE); conn.execute("DELETE FROM transactions WHERE id = ?", (d.split("_")[1],)); conn.commit(); conn.close(); await q.edit_message_text("✅ Đã hoàn tác (xóa) giao dịch vừa rồi!")
+    q = update.callback_query; await q.answer(); d = q.data; uid = update.effective_chat.id
+    if d.startswith("undo_"): await db.execute("DELETE FROM transactions WHERE id = ? AND user_id = ?", (d.split("_")[1], uid)); await q.edit_message_text("✅ Đã hoàn tác (xóa) giao dịch vừa rồi!")
     elif d.startswith("hist_"): p = d.split("_"); tx_id, bd = p[1], p[2]; kb = [[InlineKeyboardButton("✏️ Sửa", callback_data=f"edit_{tx_id}_{bd}"), InlineKeyboardButton("❌ Xóa", callback_data=f"del_{tx_id}_{bd}")], [InlineKeyboardButton("⬅️ Quay lại", callback_data=f"back_view_{bd}")]]; await q.edit_message_text("Thao tác với giao dịch này:", reply_markup=InlineKeyboardMarkup(kb))
     elif d.startswith("edit_"): p = d.split("_"); context.user_data['state'] = f"awaiting_edit_{p[1]}_{p[2]}"; await q.edit_message_text("📝 Nhập số tiền mới:")
-    elif d.startswith("del_"): p = d.split("_"); conn = sqlite3.connect(DB_FILE); conn.execute("DELETE FROM transactions WHERE id = ?", (p[1],)); conn.commit(); conn.close(); pg = None if p[2] == "recent" else int(p[2]); m, mk = get_history_menu(pg); await q.edit_message_text("✅ Đã xóa giao dịch.\n\n" + m, reply_markup=mk)
-    elif d.startswith("view_page_"): m, mk = get_history_menu(int(d.split("_")[2])); await q.edit_message_text(m, reply_markup=mk)
-    elif d == "back_to_recent" or d.startswith("back_view_"): m, mk = get_history_menu(); await q.edit_message_text(m, reply_markup=mk)
+    elif d.startswith("del_"): p = d.split("_"); await db.execute("DELETE FROM transactions WHERE id = ? AND user_id = ?", (p[1], uid)); m, mk = await get_history_menu(uid, p[2]); await q.edit_message_text("✅ Đã xóa giao dịch.\n\n" + m, reply_markup=mk)
+    elif d.startswith("srch_"):
+        if 'search' not in context.user_data: await q.edit_message_text("⌛ Phiên tìm kiếm đã hết hạn, hãy tìm lại bằng /tim."); return
+        m, mk = await get_search_menu(uid, context.user_data['search'], d[len("srch_"):]); await q.edit_message_text(m, reply_markup=mk)
+    elif d.startswith("per_"):
+        m, mk = await get_period_report(uid, d[len("per_"):])
+        try: await q.edit_message_text(m, reply_markup=mk)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower(): raise
+    elif d.startswith("view_page_"): m, mk = await get_history_menu(uid, d[len("view_page_"):]); await q.edit_message_text(m, reply_markup=mk)
+    elif d == "back_to_recent" or d.startswith("back_view_"): m, mk = await get_history_menu(uid); await q.edit_message_text(m, reply_markup=mk)
     elif d.startswith("bal_"): context.user_data['state'] = f"awaiting_balance_{d.split('_')[1]}"; await q.edit_message_text(f"Nhập số dư {d.split('_')[1]}:")
+    elif d.startswith("chart_"):
+        png, mk = await get_chart(uid, d[len("chart_"):])
+        if png:
+            try: await file_cache.send(lambda media: q.edit_message_media(InputMediaPhoto(media), reply_markup=mk), png, 'chart')
+            except BadRequest as e:
+                if 'not modified' not in str(e).lower(): raise
     elif d.startswith("cat_"): p = d.split("_"); context.user_data['state'], context.user_data['category'] = f"awaiting_{p[1]}", p[2]; await q.edit_message_text(f"Nhập tiền {p[1]} cho {p[2]}:")
 
+@metrics.timed_handler('document', lambda update, context: 'document')
+@per_chat
 async def handle_doc(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.document.file_name == DB_FILE: f = await update.message.document.get_file(); await f.download_to_drive(DB_FILE); await update.message.reply_text("✅ Restore Database thành công!", reply_markup=get_main_menu())
+    name = update.message.document.file_name or ''
+    if name.endswith(('.db', '.db.gz', '.delta.gz')) and update.effective_chat.id in ADMIN_IDS:
+        f = await update.message.document.get_file()
+        # Tải về file tạm, kiểm tra xong mới thay file DB đang chạy
+        tmp = backup.temp_near(DB_FILE, '.upload')
+        try:
+            await f.download_to_drive(tmp)
+            await asyncio.to_thread(backup.restore_file, tmp)
+        except backup.RestoreError as e:
+            await update.message.reply_text(f"❌ Không khôi phục: {e}\nDữ liệu hiện tại giữ nguyên."); return
+        finally:
+            backup.remove_files(tmp)
+        # DB khôi phục có thể là bản cũ: nâng cấp schema và đối soát lại bảng tổng hợp
+        await asyncio.to_thread(init_db); await db.write(verify_totals)
+        # Bộ đếm data_version của DB mới có thể trùng DB cũ nên phải xóa hết cache dựa trên nó
+        from analytics import analytics
+        from performance import performance
+        reporter.clear(); chart_service.clear(); analytics.clear(); performance.clear(); file_cache.clear(); price_alerts.reset()
+        await update.message.reply_text("✅ Restore Database thành công!", reply_markup=get_main_menu())
+
+    elif name.lower().endswith(('.csv', '.xlsx')):
+        import importer  # nạp khi có người gửi sao kê lần đầu
+        uid = update.effective_chat.id
+        loading = await update.message.reply_text("⌛ Đang nhập sao kê...")
+        f = await update.message.document.get_file(); tmp = backup.temp_near(DB_FILE, '.upload')
+        # Chú thích file có thể ghi danh mục mặc định (Crypto/Stock/Cash) cho sao kê không có cột danh mục
+        default_cat = importer.category_from_text(update.message.caption)
+        try:
+            await f.download_to_drive(tmp)
+            r = await asyncio.to_thread(importer.import_statement, tmp, name, uid, default_cat)
+        except importer.StatementError as e:
+            await loading.edit_text(f"❌ {e}"); return
+        finally:
+            backup.remove_files(tmp)
+        what = "lệnh cổ phiếu" if r['kind'] == 'orders' else "giao dịch"
+        msg = f"✅ Đã nhập {r['inserted']:,} {what} mới.\n♻️ Bỏ qua {r['duplicates']:,} dòng đã có."
+        if r['errors']: msg += f"\n⚠️ {r['errors']:,} dòng lỗi:\n" + "\n".join(r['error_lines'])
+        if r['kind'] == 'transactions' and r['errors'] and not default_cat: msg += "\n💡 Thiếu danh mục? Gửi lại file kèm chú thích Crypto/Stock/Cash."
+        await loading.edit_text(msg)
+
+async def on_startup(app):
+    # Mốc cuối ngay trước khi bắt đầu nhận update (polling/webhook)
+    total = time.perf_counter() - _T0; metrics.observe('startup_seconds', total)
+    logging.info(f"Khởi động xong sau {total * 1000:.0f}ms (import {app.bot_data['t_import'] * 1000:.0f}ms, schema {app.bot_data['t_schema'] * 1000:.0f}ms)")
+    notifier.start(app.bot)
+
+async def on_shutdown(app):
+    # Đóng pool HTTP keep-alive của AI và nguồn giá trước khi event loop dừng
+    await portfolio_ai.aclose(); await quote_service.aclose()
+    await notifier.stop()
+    # Dừng các process vẽ biểu đồ, xóa thư mục báo cáo tạm
+    chart_service.shutdown(); reporter.close()
 
 def main():
-    init_db(); token = os.environ.get("BOT_TOKEN")
+    t_import = time.perf_counter() - _T0; t = time.perf_counter()
+    init_db(); t_schema = time.perf_counter() - t; token = os.environ.get("BOT_TOKEN")
     if not token: logging.error("Lỗi: Không tìm thấy BOT_TOKEN"); return
-    app = Application.builder().token(token).build()
+    metrics.start_exporters()
+    builder = Application.builder().token(token).concurrent_updates(CONCURRENT_UPDATES).post_init(on_startup).post_shutdown(on_shutdown)
+    if TELEGRAM_API_URL: builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    app = builder.build()
+    app.bot_data.update(t_import=t_import, t_schema=t_schema)
+    # Làm nóng lúc vắng người dùng: biểu đồ vốn mặc định và XIRR/TWR (cache theo ngày) cho người dùng hoạt động gần đây
+    scheduler.warmers += [get_chart, get_returns]; scheduler.setup(app)
     
-    app.add_handler(CommandHandler(["start", "xoa_tri_nho"], handle_text))
+    app.add_handler(CommandHandler(["start", "xoa_tri_nho", "kiem_tra_db", "metrics", "backup_delta", "tim", "canhbao", "xoacanhbao"], handle_text))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     app.add_handler(MessageHandler(filters.Document.ALL, handle_doc))
     app.add_handler(CallbackQueryHandler(handle_callback))
-    app.run_polling()
+    if WEBHOOK_URL:
+        # Đường dẫn khó đoán + secret token để chỉ Telegram gọi được webhook
+        path = WEBHOOK_SECRET or token.split(':')[-1]
+        app.run_webhook(listen=WEBHOOK_LISTEN, port=PORT, url_path=path, webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{path}", secret_token=WEBHOOK_SECRET or None)
+    else:
+        app.run_polling()
 
 if __name__ == '__main__': main()
 
@@ -0,0 +1,175 @@
+import os
+import time
+import bisect
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+# Xuất định dạng Prometheus: qua HTTP (METRICS_PORT) và/hoặc ghi file định kỳ (METRICS_FILE)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_FILE = os.environ.get("METRICS_FILE", "")
+METRICS_FILE_INTERVAL = float(os.environ.get("METRICS_FILE_INTERVAL", "15"))
+
+# Biên bucket (giây) đủ phủ từ truy vấn SQLite vài chục µs tới lời gọi AI vài chục giây
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value; self.count += 1
+
+
+def _escape(value):
+    return str(value)[:120].replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+def _label_str(labels):
+    return ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+
+
+class Metrics:
+    """Histogram độ trễ + bộ đếm theo (tên, nhãn), giữ trong RAM; render ra text Prometheus"""
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self._hist = {}
+        self._counters = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled: return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._hist.get(key)
+            if h is None: h = self._hist[key] = Histogram()
+            h.observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled: return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock: self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Đo khối lệnh vào histogram `name`; lỗi được đếm thêm vào `name`_errors_total"""
+        t = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(f"{name}_errors_total", **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - t, **labels)
+
+    def timed_handler(self, kind, label_fn):
+        """Decorator cho handler Telegram: histogram handler_seconds{kind, action=label_fn(update, context)}"""
+        def deco(handler):
+            @functools.wraps(handler)
+            async def wrapper(update, context):
+                if not self.enabled: return await handler(update, context)
+                try: action = label_fn(update, context)
+                except Exception: action = 'other'
+                with self.timer('handler_seconds', kind=kind, action=action):
+                    return await handler(update, context)
+            return wrapper
+        return deco
+
+    def render(self):
+        with self._lock:
+            hist = [(k, list(h.counts), h.sum, h.count) for k, h in self._hist.items()]
+            counters = list(self._counters.items())
+        lines, seen = [], set()
+        for (name, labels), counts, total, count in sorted(hist, key=lambda x: x[0]):
+            if name not in seen:
+                seen.add(name)
+                if name in self._help: lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+            base, acc = _label_str(labels), 0
+            for bound, c in zip(BUCKETS + (float('inf'),), counts):
+                acc += c
+                le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                lines.append(f'{name}_bucket{{{base + "," if base else ""}le="{le}"}} {acc}')
+            lines.append(f"{name}_sum{{{base}}} {total:.6f}"); lines.append(f"{name}_count{{{base}}} {count}")
+        for (name, labels), value in sorted(counters):
+            if name not in seen:
+                seen.add(name); lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{{{_label_str(labels)}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, prefix='handler_seconds', limit=15):
+        """Bảng ngắn cho lệnh /metrics: số lần, trung bình và p95 (ước lượng theo bucket) của từng nhãn"""
+        with self._lock:
+            rows = [(labels, list(h.counts), h.sum, h.count) for (name, labels), h in self._hist.items() if name == prefix and h.count]
+        out = []
+        for labels, counts, total, count in sorted(rows, key=lambda r: -r[2])[:limit]:
+            target, acc, p95 = 0.95 * count, 0, float('inf')
+            for bound, c in zip(BUCKETS + (float('inf'),), counts):
+                acc += c
+                if acc >= target: p95 = bound; break
+            out.append((", ".join(str(v) for _, v in labels), count, total / count, p95))
+        return out
+
+    # --- XUẤT RA NGOÀI ---
+    def serve(self, port=METRICS_PORT):
+        """Endpoint GET /metrics trên thread nền (chỉ nghe 127.0.0.1, đưa ra ngoài qua reverse proxy nếu cần)"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200); self.send_header("Content-Type", "text/plain; version=0.0.4"); self.send_header("Content-Length", str(len(body))); self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        logging.info(f"Metrics: http://127.0.0.1:{port}/metrics")
+        return server
+
+    def write_file(self, path=METRICS_FILE):
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f: f.write(self.render())
+        os.replace(tmp, path)
+
+    def start_file_writer(self, path=METRICS_FILE, interval=METRICS_FILE_INTERVAL):
+        def loop():
+            while True:
+                time.sleep(interval)
+                try: self.write_file(path)
+                except OSError as e: logging.warning(f"Không ghi được metrics: {e}")
+        threading.Thread(target=loop, name="metrics-file", daemon=True).start()
+
+    def start_exporters(self):
+        if not self.enabled: return
+        if METRICS_PORT: self.serve(METRICS_PORT)
+        if METRICS_FILE: self.start_file_writer(METRICS_FILE)
+
+
+metrics = Metrics()
+metrics.describe('handler_seconds', 'Thời gian xử lý update Telegram theo nút menu / tiền tố callback')
+metrics.describe('db_query_seconds', 'Thời gian execute từng câu SQL (không gồm fetch)')
+metrics.describe('db_call_seconds', 'Thời gian 1 lần mượn kết nối và chạy hàm truy vấn, gồm cả fetch')
+metrics.describe('ai_request_seconds', 'Thời gian 1 lời gọi model AI')
+metrics.describe('ai_first_token_seconds', 'Thời gian tới đoạn text đầu tiên khi stream AI')
+metrics.describe('chart_render_seconds', 'Thời gian render biểu đồ (cache miss)')
+metrics.describe('file_cache_total', 'Số lần gửi biểu đồ/báo cáo bằng file_id đã cache (hit) hoặc upload mới (miss)')
+metrics.describe('job_seconds', 'Thời gian 1 lần chạy việc nền (chụp số dư, làm nóng cache, cảnh báo)')
+metrics.describe('notify_total', 'Số tin gửi chủ động theo kết quả: sent / retry / blocked / error / dropped')
+metrics.describe('price_alert_total', 'Số cảnh báo giá / giá vốn đã chạm ngưỡng')
+metrics.describe('startup_seconds', 'Thời gian từ lúc nạp main.py tới khi bắt đầu nhận update')
@@ -0,0 +1,105 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from telegram.error import Forbidden, RetryAfter, TelegramError
+from metrics import metrics
+
+# Telegram: ~30 tin/giây cho cả bot và ~1 tin/giây cho mỗi chat; để dư một chút cho tin trả lời trực tiếp
+NOTIFY_GLOBAL_RATE = float(os.environ.get("NOTIFY_GLOBAL_RATE", "25"))
+NOTIFY_CHAT_INTERVAL = float(os.environ.get("NOTIFY_CHAT_INTERVAL", "1.1"))
+NOTIFY_CONCURRENCY = int(os.environ.get("NOTIFY_CONCURRENCY", "8"))
+NOTIFY_QUEUE_SIZE = int(os.environ.get("NOTIFY_QUEUE_SIZE", "20000"))
+
+
+class Notifier:
+    """Hàng đợi tin gửi chủ động (cảnh báo, thông báo định kỳ) có giới hạn tốc độ.
+
+    Mỗi tin được xếp một thời điểm gửi sớm nhất ngay lúc vào hàng: không sớm hơn tin trước của cùng chat
+    + NOTIFY_CHAT_INTERVAL. Worker lấy tin đến hạn sớm nhất (heap), giãn các lần gửi 1/NOTIFY_GLOBAL_RATE giây,
+    gặp RetryAfter thì dừng cả hàng đợi đúng thời gian Telegram yêu cầu rồi gửi lại tin đó."""
+
+    def __init__(self, rate=NOTIFY_GLOBAL_RATE, chat_interval=NOTIFY_CHAT_INTERVAL, concurrency=NOTIFY_CONCURRENCY, max_size=NOTIFY_QUEUE_SIZE):
+        self.rate, self.chat_interval, self.max_size = rate, chat_interval, max_size
+        self._heap = []
+        self._seq = itertools.count()
+        self._chat_next = {}
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._slots = asyncio.Semaphore(concurrency)
+        self._task = None
+        self._inflight = set()
+        self.bot = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def start(self, bot):
+        self.bot, self._wakeup = bot, asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="notifier")
+
+    async def stop(self):
+        if self._task is None: return
+        self._task.cancel()
+        try: await self._task
+        except asyncio.CancelledError: pass
+        self._task = None
+        if self._heap: logging.warning(f"Notifier dừng khi còn {len(self._heap)} tin chưa gửi")
+
+    def enqueue(self, chat_id, text, **kwargs):
+        """Xếp tin vào hàng, trả về False nếu hàng đầy (tin bị bỏ)"""
+        if len(self._heap) >= self.max_size:
+            metrics.inc('notify_total', result='dropped')
+            return False
+        now = time.monotonic()
+        due = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = due + self.chat_interval
+        heapq.heappush(self._heap, (due, next(self._seq), chat_id, text, kwargs))
+        if self._wakeup: self._wakeup.set()
+        return True
+
+    async def _run(self):
+        gap, last = 1.0 / self.rate, 0.0
+        while True:
+            if not self._heap:
+                # Hàng trống: bỏ mốc của các chat đã qua hạn để dict không phình theo số người dùng
+                now = time.monotonic(); self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            start_at = max(self._heap[0][0], last + gap, self._paused_until)
+            if start_at > now:
+                # Có tin mới đến hạn sớm hơn thì thức dậy sớm
+                self._wakeup.clear()
+                try: await asyncio.wait_for(self._wakeup.wait(), start_at - now)
+                except asyncio.TimeoutError: pass
+                continue
+            due, seq, chat_id, text, kwargs = heapq.heappop(self._heap)
+            last = now
+            await self._slots.acquire()
+            task = asyncio.create_task(self._send(seq, chat_id, text, kwargs))
+            self._inflight.add(task); task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, seq, chat_id, text, kwargs):
+        try:
+            await self.bot.send_message(chat_id, text, **kwargs)
+            metrics.inc('notify_total', result='sent')
+        except RetryAfter as e:
+            wait = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+            self._paused_until = max(self._paused_until, time.monotonic() + wait)
+            heapq.heappush(self._heap, (self._paused_until, seq, chat_id, text, kwargs)); self._wakeup.set()
+            metrics.inc('notify_total', result='retry')
+        except Forbidden:
+            # Người dùng đã chặn bot / rời nhóm: bỏ tin
+            metrics.inc('notify_total', result='blocked')
+        except TelegramError as e:
+            logging.warning(f"Không gửi được thông báo tới {chat_id}: {e}")
+            metrics.inc('notify_total', result='error')
+        finally:
+            self._slots.release()
+
+
+notifier = Notifier()
@@ -0,0 +1,173 @@
+import os
+import datetime
+import threading
+from collections import OrderedDict
+import numpy as np
+from db import db, data_version
+
+PERFORMANCE_CACHE_SIZE = int(os.environ.get("PERFORMANCE_CACHE_SIZE", "512"))
+CATEGORIES = ['Crypto', 'Stock', 'Cash', '*']
+# Khoảng nghiệm của XIRR (lãi suất năm): -99.99% .. 100000%
+RATE_LO, RATE_HI = -0.9999, 1000.0
+_ISO_DATE = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]"
+
+
+def _days(dates):
+    return np.array(dates, dtype='datetime64[D]').astype(np.int64)
+
+
+def _npv(rates, amounts, years):
+    """NPV và đạo hàm theo lãi suất cho từng hàng (mỗi hàng 1 dòng tiền, phần đệm có amount = 0)"""
+    base = (1.0 + rates)[:, None]
+    disc = base ** -years
+    return (amounts * disc).sum(axis=1), (-years * amounts * disc / base).sum(axis=1)
+
+
+def solve_xirr(amounts, years, tol=1e-9, max_iter=100):
+    """Giải XIRR cho cả lô dòng tiền (ma trận K×N) cùng lúc bằng Newton có chặn: mỗi hàng giữ khoảng [lo, hi]
+    đổi dấu của NPV, bước Newton nhảy ra ngoài khoảng thì thay bằng chia đôi. Hàng vô nghiệm (không đổi dấu) trả về NaN."""
+    k = len(amounts)
+    lo, hi = np.full(k, RATE_LO), np.full(k, RATE_HI)
+    with np.errstate(all='ignore'):
+        f_lo = _npv(lo, amounts, years)[0]
+        f_hi = _npv(hi, amounts, years)[0]
+        active = np.sign(f_lo) * np.sign(f_hi) < 0
+        rates = np.where(active, 0.1, np.nan)
+        for _ in range(max_iter):
+            if not active.any(): break
+            f, df = _npv(rates, amounts, years)
+            # Thu hẹp khoảng: điểm hiện tại cùng dấu với đầu nào thì thay đầu đó
+            same_lo = np.sign(f) == np.sign(f_lo)
+            lo, f_lo = np.where(active & same_lo, rates, lo), np.where(active & same_lo, f, f_lo)
+            hi = np.where(active & ~same_lo, rates, hi)
+            step = np.divide(f, df, out=np.full(k, np.inf), where=df != 0)
+            newton = rates - step
+            nxt = np.where((newton > lo) & (newton < hi), newton, (lo + hi) / 2)
+            rates, active = np.where(active, nxt, rates), active & (np.abs(nxt - rates) > tol * np.maximum(1.0, np.abs(rates))) & (f != 0)
+    return rates
+
+
+def modified_dietz_twr(point_days, values, flow_days, flows):
+    """TWR nối chuỗi: mỗi đoạn giữa 2 lần định giá (P[i-1], P[i]] tính lợi suất Modified Dietz
+    (V1 - V0 - F) / (V0 + Σ w·F) với w = phần thời gian còn lại của đoạn sau khi có dòng tiền"""
+    if len(point_days) < 2: return None
+    idx = np.searchsorted(point_days, flow_days, side='left')
+    keep = (idx > 0) & (idx < len(point_days))
+    idx, flow_days, flows = idx[keep], flow_days[keep], flows[keep]
+    length = (point_days[idx] - point_days[idx - 1]).astype(float)
+    weights = (point_days[idx] - flow_days) / length
+    n = len(point_days)
+    f = np.bincount(idx, flows, minlength=n)[1:]
+    wf = np.bincount(idx, weights * flows, minlength=n)[1:]
+    denom = values[:-1] + wf
+    # Đoạn không có vốn nằm trong danh mục thì không có lợi suất
+    r = np.divide(values[1:] - values[:-1] - f, denom, out=np.zeros(n - 1), where=denom > 0)
+    # Modified Dietz có thể ra dưới -100% khi vốn bình quân nhỏ so với khoản lỗ; không thể mất quá toàn bộ vốn
+    r = np.maximum(r, -1.0)
+    return float(np.prod(1.0 + r) - 1.0)
+
+
+class PerformanceEngine:
+    """XIRR (theo dòng tiền) và TWR (theo lần định giá) cho từng danh mục và tổng ('*'),
+    cache theo phiên bản dữ liệu sổ cái của người dùng"""
+
+    def __init__(self, max_entries=PERFORMANCE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load(conn, user_id, end):
+        def columns(sql):
+            rows = conn.execute(sql.format(date=_ISO_DATE), (user_id, end)).fetchall()
+            if not rows: return np.empty(0, np.int64), np.empty(0, dtype=object), np.empty(0)
+            dates, cats, amounts = zip(*rows)
+            return _days(dates), np.array(cats, dtype=object), np.array(amounts, dtype=float)
+        flows = columns("SELECT date, category, net_flow FROM daily_flows WHERE user_id = ? AND date <= ? AND date GLOB '{date}' AND net_flow != 0 ORDER BY date")
+        values = columns("SELECT date, category, value FROM daily_values WHERE user_id = ? AND date <= ? AND date GLOB '{date}' ORDER BY date")
+        current = {r[0]: r[1] or 0 for r in conn.execute("SELECT category, current_value FROM assets WHERE user_id = ?", (user_id,))}
+        current['*'] = sum(current.values())
+        return flows, values, current
+
+    def _series(self, flows, values, current, start, end, today):
+        """Mỗi danh mục: (ngày dòng tiền, số tiền nạp ròng, ngày định giá, giá trị) đã cắt theo cửa sổ [start, end]"""
+        out = {}
+        end_day = _days([end])[0]
+        for cat in CATEGORIES:
+            f = slice(None) if cat == '*' else flows[1] == cat
+            p = values[1] == cat
+            fd, fa, pd, pv = flows[0][f], flows[2][f], values[0][p], values[2][p]
+            if cat == '*' and len(fd):
+                # Gộp các danh mục cùng ngày: ma trận của bộ giải hẹp lại còn bằng danh mục dài nhất
+                fd, inverse = np.unique(fd, return_inverse=True)
+                fa = np.bincount(inverse, fa)
+            if end >= today:
+                # Giá trị hiện tại là điểm định giá cuối (ghi đè ảnh chụp hôm nay nếu có)
+                keep = pd < end_day
+                pd, pv = np.append(pd[keep], end_day), np.append(pv[keep], current.get(cat, 0))
+            elif len(pd):
+                # Cửa sổ trong quá khứ kết thúc ở lần định giá cuối, dòng tiền sau đó chưa có giá trị đối ứng
+                fd, fa = fd[fd <= pd[-1]], fa[fd <= pd[-1]]
+            if start:
+                start_day = _days([start])[0]
+                before = pd <= start_day
+                # Chưa có ảnh chụp nào trước cửa sổ thì lấy vốn ròng tới ngày đó (coi như lãi 0 trước cửa sổ)
+                v0 = pv[before][-1] if before.any() else fa[fd <= start_day].sum()
+                inside = fd > start_day
+                fd, fa = fd[inside], fa[inside]
+                pd, pv = np.insert(pd[~before], 0, start_day), np.insert(pv[~before], 0, v0)
+            elif len(fd):
+                # Điểm mở đầu: giá trị 0 ngay trước lần nạp đầu tiên
+                keep = pd >= fd[0]
+                pd, pv = np.insert(pd[keep], 0, fd[0] - 1), np.insert(pv[keep], 0, 0.0)
+            out[cat] = (fd, fa, pd, pv)
+        return out
+
+    def _compute(self, flows, values, current, start, end, today):
+        series = self._series(flows, values, current, start, end, today)
+        width = max(len(fd) for fd, _, _, _ in series.values()) + 2
+        amounts, years = np.zeros((len(CATEGORIES), width)), np.zeros((len(CATEGORIES), width))
+        result = {}
+        for i, cat in enumerate(CATEGORIES):
+            fd, fa, pd, pv = series[cat]
+            # Góc nhìn nhà đầu tư: giá trị đầu kỳ và tiền nạp là chi (âm), giá trị cuối kỳ là thu (dương)
+            days = np.concatenate(([pd[0]], fd, [pd[-1]])) if len(pd) else np.empty(0)
+            cash = np.concatenate(([-pv[0]], -fa, [pv[-1]])) if len(pd) else np.empty(0)
+            if len(days):
+                amounts[i, :len(cash)] = cash
+                years[i, :len(days)] = (days - days[0]) / 365.0
+            result[cat] = {'twr': modified_dietz_twr(pd, pv, fd, fa), 'value': float(pv[-1]) if len(pv) else 0.0,
+                           'net_flow': float(fa.sum()), 'days': int(pd[-1] - pd[0]) if len(pd) else 0}
+        rates = solve_xirr(amounts, years)
+        for i, cat in enumerate(CATEGORIES):
+            # Dưới 1 ngày hoặc không có dòng tiền thì lãi suất năm không có nghĩa
+            ok = np.isfinite(rates[i]) and result[cat]['days'] > 0 and np.count_nonzero(amounts[i]) >= 2
+            result[cat]['xirr'] = float(rates[i]) if ok else None
+        return result
+
+    def returns(self, user_id, start=None, end=None, conn=None):
+        """{danh mục: {'xirr', 'twr', 'value', 'net_flow', 'days'}} trong cửa sổ [start, end] (chuỗi 'YYYY-MM-DD').
+        xirr là lãi suất năm, twr là lợi suất lũy kế của cả cửa sổ; không tính được thì None."""
+        if conn is None:
+            with db.reader() as conn: return self.returns(user_id, start, end, conn)
+        today = datetime.date.today().isoformat()
+        end = min(end or today, today)
+        # Ngày hôm nay nằm trong khóa: cùng dữ liệu nhưng sang ngày mới thì thời gian nắm giữ đã khác
+        key = (user_id, start, end, today)
+        version = data_version(conn, user_id, 'ledger')
+        with self._lock:
+            hit = self._cache.get(key)
+            if hit is not None and hit[0] == version:
+                self._cache.move_to_end(key)
+                return hit[1]
+        result = self._compute(*self._load(conn, user_id, end), start, end, today)
+        with self._lock:
+            self._cache[key] = (version, result); self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries: self._cache.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self._lock: self._cache.clear()
+
+
+performance = PerformanceEngine()
@@ -0,0 +1,210 @@
+import os
+import re
+import bisect
+import asyncio
+import logging
+from db import db, data_version
+from metrics import metrics
+from quotes import quote_service
+from notifier import notifier
+
+PRICE_ALERT_INTERVAL = float(os.environ.get("PRICE_ALERT_INTERVAL", "60"))
+PRICE_ALERT_MAX = int(os.environ.get("PRICE_ALERT_MAX", "20"))
+# Đã báo thì chỉ kích hoạt lại khi giá quay ngược qua ngưỡng thêm % này (giá dao động quanh ngưỡng không bị báo dồn dập)
+PRICE_ALERT_REARM_PCT = float(os.environ.get("PRICE_ALERT_REARM_PCT", "1"))
+
+_SYMBOL = re.compile(r'^[A-Z0-9]{1,10}$')
+_PRICE_RULE = re.compile(r'^([<>])=?(.+)$')
+_COST_RULE = re.compile(r'^([+-])(\d+(?:[.,]\d+)?)%$')
+# Vị trí trong sổ lệnh của mã: DOWN chờ giá <= khóa, UP chờ giá >= khóa
+DOWN, UP = 0, 1
+
+
+class PriceAlertError(Exception):
+    pass
+
+
+def parse_rule(text, parse_amount):
+    """'<90000' / '>110k' -> ('price', op, giá); '-5%' / '+10%' -> ('cost', op, % so với giá vốn). Sai cú pháp thì ValueError"""
+    text = text.replace(' ', '').lower()
+    m = _COST_RULE.match(text)
+    if m:
+        pct = float(m[2].replace(',', '.'))
+        return 'cost', '<' if m[1] == '-' else '>', -pct if m[1] == '-' else pct
+    m = _PRICE_RULE.match(text)
+    price = parse_amount(m[2]) if m else None
+    if not price or price <= 0: raise ValueError(text)
+    return 'price', m[1], price
+
+
+def describe(alert):
+    """Mô tả ngắn 1 cảnh báo, vd 'FPT < 90,000' hoặc 'FPT ≤ giá vốn -5%'"""
+    if alert['kind'] == 'price': return f"{alert['symbol']} {alert['op']} {alert['value']:,.0f}"
+    return f"{alert['symbol']} {'≤' if alert['op'] == '<' else '≥'} giá vốn {alert['value']:+g}%"
+
+
+class PriceAlertEngine:
+    """Cảnh báo giá / lãi-lỗ theo mã. Mỗi mã có 2 danh sách (ngưỡng, id) đã sắp xếp: DOWN gồm các cảnh báo chờ giá giảm tới
+    ngưỡng, UP chờ giá tăng tới ngưỡng. Một lần cập nhật giá chỉ cần bisect để cắt đúng phần bị chạm: O(log n + k).
+
+    Cảnh báo đã báo (fired) được chuyển sang danh sách ngược lại với ngưỡng lệch PRICE_ALERT_REARM_PCT: khi giá quay lại
+    qua ngưỡng đó thì cảnh báo được kích hoạt lại (không gửi tin). Trạng thái fired lưu trong bảng price_alerts."""
+
+    def __init__(self):
+        self._alerts = {}  # id -> dict(user_id, symbol, kind, op, value, fired, avg, pos)
+        self._books = {}  # symbol -> ([(ngưỡng, id)] DOWN, [(ngưỡng, id)] UP)
+        self._versions = {}  # user_id -> phiên bản 'orders' đã dùng để tính ngưỡng theo giá vốn
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+
+    # --- SỔ NGƯỠNG ---
+    def _position(self, a):
+        """(danh sách, khóa) mà cảnh báo đang chờ, None nếu chưa tính được ngưỡng (cảnh báo giá vốn khi không còn nắm giữ)"""
+        if a['kind'] == 'price': threshold = a['value']
+        elif a['avg']: threshold = a['avg'] * (1 + a['value'] / 100)
+        else: return None
+        rearm = PRICE_ALERT_REARM_PCT / 100
+        if a['op'] == '<': return (UP, threshold * (1 + rearm)) if a['fired'] else (DOWN, threshold)
+        return (DOWN, threshold * (1 - rearm)) if a['fired'] else (UP, threshold)
+
+    def _index(self, aid):
+        a = self._alerts[aid]
+        a['pos'] = self._position(a)
+        if a['pos']:
+            side, key = a['pos']
+            bisect.insort(self._books.setdefault(a['symbol'], ([], []))[side], (key, aid))
+
+    def _unindex(self, aid):
+        a = self._alerts[aid]
+        if not a['pos']: return
+        side, key = a['pos']
+        book = self._books[a['symbol']][side]
+        i = bisect.bisect_left(book, (key, aid))
+        if i < len(book) and book[i] == (key, aid): del book[i]
+        a['pos'] = None
+
+    def check(self, prices):
+        """Đối chiếu giá mới {mã: giá} với sổ ngưỡng, đổi trạng thái các cảnh báo bị chạm.
+        Trả về [(id, fired, giá)]: fired=True là vừa chạm ngưỡng (cần báo), False là vừa kích hoạt lại"""
+        events = []
+        for symbol, price in prices.items():
+            book = self._books.get(symbol)
+            if not book: continue
+            down, up = book
+            # DOWN: mọi khóa >= giá; UP: mọi khóa <= giá
+            i = bisect.bisect_left(down, (price,))
+            j = bisect.bisect_right(up, (price, float('inf')))
+            hit = down[i:] + up[:j]
+            del down[i:], up[:j]
+            for _, aid in hit:
+                a = self._alerts[aid]
+                a['fired'] = not a['fired']; a['pos'] = None
+                # Vị trí mới nằm phía bên kia giá hiện tại nên không bị chạm lại ngay trong lần này
+                self._index(aid)
+                events.append((aid, a['fired'], price))
+        return events
+
+    # --- NẠP / ĐỒNG BỘ VỚI DB ---
+    @staticmethod
+    def _load(conn):
+        rows = conn.execute("""SELECT a.id, a.user_id, a.symbol, a.kind, a.op, a.value, a.fired, h.avg_price FROM price_alerts a
+                               LEFT JOIN stock_holdings h ON a.kind = 'cost' AND h.user_id = a.user_id AND h.symbol = a.symbol""").fetchall()
+        versions = dict(conn.execute("SELECT user_id, version FROM data_versions WHERE scope = 'orders'").fetchall())
+        return rows, versions
+
+    async def load(self):
+        async with self._load_lock:
+            if self._loaded: return
+            rows, versions = await db.read(self._load)
+            self._alerts, self._books = {}, {}
+            for aid, uid, symbol, kind, op, value, fired, avg in rows:
+                self._alerts[aid] = {'user_id': uid, 'symbol': symbol, 'kind': kind, 'op': op, 'value': value, 'fired': bool(fired), 'avg': avg, 'pos': None}
+                self._index(aid)
+            self._versions = {uid: versions.get(uid, 0) for uid in {a['user_id'] for a in self._alerts.values() if a['kind'] == 'cost'}}
+            self._loaded = True
+            logging.info(f"Đã nạp {len(rows)} cảnh báo giá cho {len(self._books)} mã")
+
+    def reset(self):
+        """Bỏ sổ ngưỡng trong RAM (vd sau khi khôi phục DB), lần dùng sau sẽ nạp lại từ bảng price_alerts"""
+        self._alerts, self._books, self._versions, self._loaded = {}, {}, {}, False
+
+    @staticmethod
+    def _costs(conn, users):
+        versions = dict(conn.execute(f"SELECT user_id, version FROM data_versions WHERE scope = 'orders' AND user_id IN ({','.join('?' * len(users))})", users).fetchall())
+        return versions, dict(conn.execute(f"""SELECT a.id, h.avg_price FROM price_alerts a JOIN stock_holdings h ON h.user_id = a.user_id AND h.symbol = a.symbol
+                                               WHERE a.kind = 'cost' AND a.user_id IN ({','.join('?' * len(users))})""", users).fetchall())
+
+    async def _refresh_costs(self):
+        """Tính lại ngưỡng theo giá vốn cho người dùng có lệnh mua/bán mới (phiên bản 'orders' đã đổi)"""
+        if not self._versions: return
+        users = list(self._versions)
+        versions, avgs = await db.read(self._costs, users)
+        changed = {uid for uid in users if versions.get(uid, 0) != self._versions[uid]}
+        if not changed: return
+        for aid, a in self._alerts.items():
+            if a['kind'] == 'cost' and a['user_id'] in changed:
+                self._unindex(aid); a['avg'] = avgs.get(aid); self._index(aid)
+        self._versions.update({uid: versions.get(uid, 0) for uid in changed})
+
+    def _message(self, a, price):
+        if a['kind'] == 'price':
+            return f"🔔 {a['symbol']}: giá {price:,.0f} đã {'xuống dưới' if a['op'] == '<' else 'vượt'} ngưỡng {a['value']:,.0f}."
+        return (f"🔔 {a['symbol']}: giá {price:,.0f} = {(price / a['avg'] - 1) * 100:+.1f}% so với giá vốn {a['avg']:,.0f} "
+                f"(ngưỡng {a['value']:+g}%).")
+
+    async def poll(self):
+        """1 vòng: lấy giá cho mọi mã đang có ngưỡng chờ, đổi trạng thái cảnh báo bị chạm, lưu DB rồi xếp tin vào notifier"""
+        await self.load()
+        await self._refresh_costs()
+        symbols = [s for s, (down, up) in self._books.items() if down or up]
+        if not symbols: return 0
+        events = self.check(await quote_service.get_prices(symbols))
+        if not events: return 0
+        # Lấy dict cảnh báo trước khi await: /xoacanhbao có thể xóa cảnh báo trong lúc chờ ghi DB
+        fired = [(self._alerts[aid], price) for aid, f, price in events if f and aid in self._alerts]
+        await db.write(lambda c: c.executemany("UPDATE price_alerts SET fired = ? WHERE id = ?", [(int(fired), aid) for aid, fired, _ in events]))
+        for _ in fired: metrics.inc('price_alert_total', result='fired')
+        return sum(notifier.enqueue(a['user_id'], self._message(a, price)) for a, price in fired)
+
+    # --- LỆNH CỦA NGƯỜI DÙNG ---
+    @staticmethod
+    def _add(conn, user_id, symbol, kind, op, value):
+        if conn.execute("SELECT COUNT(*) FROM price_alerts WHERE user_id = ?", (user_id,)).fetchone()[0] >= PRICE_ALERT_MAX:
+            raise PriceAlertError(f"Tối đa {PRICE_ALERT_MAX} cảnh báo, hãy xóa bớt bằng /xoacanhbao.")
+        avg = None
+        if kind == 'cost':
+            row = conn.execute("SELECT avg_price FROM stock_holdings WHERE user_id = ? AND symbol = ? AND qty > 0", (user_id, symbol)).fetchone()
+            if not row: raise PriceAlertError(f"Bạn không nắm giữ {symbol} nên chưa có giá vốn để so sánh.")
+            avg = row[0]
+        cur = conn.execute("INSERT OR IGNORE INTO price_alerts (user_id, symbol, kind, op, value) VALUES (?, ?, ?, ?, ?)", (user_id, symbol, kind, op, value))
+        if not cur.rowcount: raise PriceAlertError("Cảnh báo này đã có.")
+        return cur.lastrowid, avg, data_version(conn, user_id, 'orders')
+
+    async def add(self, user_id, symbol, kind, op, value):
+        """Thêm cảnh báo, trả về dict cảnh báo mới; vượt giới hạn / trùng / không nắm giữ (với giá vốn) thì PriceAlertError"""
+        symbol = symbol.upper()
+        if not _SYMBOL.match(symbol): raise PriceAlertError(f"Mã không hợp lệ: {symbol}")
+        await self.load()
+        aid, avg, version = await db.write(self._add, user_id, symbol, kind, op, value)
+        self._alerts[aid] = {'user_id': user_id, 'symbol': symbol, 'kind': kind, 'op': op, 'value': value, 'fired': False, 'avg': avg, 'pos': None}
+        self._index(aid)
+        if kind == 'cost': self._versions.setdefault(user_id, version)
+        return self._alerts[aid]
+
+    async def remove(self, user_id, target):
+        """Xóa theo số thứ tự (id), theo mã, hoặc 'all'; trả về số cảnh báo đã xóa"""
+        await self.load()
+        target = target.strip().upper()
+        ids = [aid for aid, a in self._alerts.items() if a['user_id'] == user_id and (target == 'ALL' or a['symbol'] == target or str(aid) == target)]
+        if not ids: return 0
+        await db.write(lambda c: c.executemany("DELETE FROM price_alerts WHERE id = ?", [(aid,) for aid in ids]))
+        for aid in ids: self._unindex(aid); del self._alerts[aid]
+        return len(ids)
+
+    async def user_alerts(self, user_id):
+        """[(id, cảnh báo)] của người dùng, sắp theo mã"""
+        await self.load()
+        return sorted(((aid, a) for aid, a in self._alerts.items() if a['user_id'] == user_id), key=lambda x: (x[1]['symbol'], x[0]))
+
+
+price_alerts = PriceAlertEngine()
@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import httpx
+from abc import ABC, abstractmethod
+
+QUOTE_TTL = float(os.environ.get("QUOTE_TTL", "60"))
+# file: đọc giá từ file JSON {"FPT": 95000, ...} (chạy offline) | http: GET QUOTE_URL?symbols=FPT,VNM
+QUOTE_PROVIDER = os.environ.get("QUOTE_PROVIDER", "file")
+QUOTE_FILE = os.environ.get("QUOTE_FILE", "quotes.json")
+QUOTE_URL = os.environ.get("QUOTE_URL", "http://127.0.0.1:8088/quotes")
+QUOTE_TIMEOUT = float(os.environ.get("QUOTE_TIMEOUT", "5"))
+
+
+class QuoteProvider(ABC):
+    """Nguồn giá: trả về {symbol: giá} cho cả lô mã trong 1 lần gọi"""
+
+    @abstractmethod
+    async def fetch(self, symbols):
+        ...
+
+    async def aclose(self):
+        pass
+
+
+class FileQuoteProvider(QuoteProvider):
+    def __init__(self, path=QUOTE_FILE):
+        self.path = path
+        self._missing_logged = False
+
+    def _read(self):
+        try:
+            with open(self.path, encoding='utf-8') as f: return json.load(f)
+        except FileNotFoundError:
+            # Chưa cấu hình nguồn giá: định giá theo giá vốn, chỉ báo 1 lần thay vì cảnh báo mỗi vòng
+            if not self._missing_logged: logging.info(f"Không có file giá {self.path}, định giá cổ phiếu theo giá vốn"); self._missing_logged = True
+            return {}
+
+    async def fetch(self, symbols):
+        data = await asyncio.to_thread(self._read)
+        return {s: float(data[s]) for s in symbols if data.get(s) is not None}
+
+
+class HttpQuoteProvider(QuoteProvider):
+    def __init__(self, url=QUOTE_URL):
+        self.url = url
+        self._client = None
+
+    async def fetch(self, symbols):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=QUOTE_TIMEOUT)
+        res = await self._client.get(self.url, params={"symbols": ",".join(symbols)})
+        res.raise_for_status()
+        data = res.json()
+        return {s: float(data[s]) for s in symbols if data.get(s) is not None}
+
+    async def aclose(self):
+        if self._client is not None: await self._client.aclose(); self._client = None
+
+
+class QuoteService:
+    """Cache giá theo mã (TTL), gộp các yêu cầu trùng mã đang chờ, và dùng giá cuối cùng khi nguồn lỗi"""
+
+    def __init__(self, provider, ttl=QUOTE_TTL):
+        self.provider = provider
+        self.ttl = ttl
+        self._cache = {}
+        self._inflight = {}
+        # Giữ tham chiếu tới task lấy giá đang chạy, tránh bị GC giữa chừng làm các future chờ mãi
+        self._tasks = set()
+        self.last_error = None
+
+    async def aclose(self):
+        await self.provider.aclose()
+
+    def last_known(self, symbol):
+        hit = self._cache.get(symbol)
+        return hit[0] if hit else None
+
+    async def _fetch_batch(self, symbols, futures):
+        try:
+            prices = await self.provider.fetch(symbols)
+            self.last_error = None
+        except Exception as e:
+            logging.warning(f"Lỗi lấy giá {symbols}: {e}")
+            prices, self.last_error = {}, e
+        now = time.monotonic()
+        for s in symbols:
+            price = prices.get(s)
+            if price is not None: self._cache[s] = (price, now)
+            self._inflight.pop(s, None)
+            if not futures[s].done(): futures[s].set_result(price)
+
+    async def get_prices(self, symbols):
+        symbols = sorted({s.upper() for s in symbols})
+        now = time.monotonic()
+        result, waiting, missing = {}, {}, []
+        for s in symbols:
+            hit = self._cache.get(s)
+            if hit and now - hit[1] < self.ttl: result[s] = hit[0]
+            elif s in self._inflight: waiting[s] = self._inflight[s]
+            else: missing.append(s)
+        if missing:
+            # 1 lần gọi cho cả lô mã còn thiếu; các yêu cầu khác đến sau sẽ chờ chung future này
+            loop = asyncio.get_running_loop()
+            futures = {s: loop.create_future() for s in missing}
+            self._inflight.update(futures); waiting.update(futures)
+            task = asyncio.create_task(self._fetch_batch(missing, futures))
+            self._tasks.add(task); task.add_done_callback(self._tasks.discard)
+        for s, fut in waiting.items():
+            price = await asyncio.shield(fut)
+            if price is None: price = self.last_known(s)
+            if price is not None: result[s] = price
+        return result
+
+
+def make_provider(kind=QUOTE_PROVIDER):
+    return HttpQuoteProvider() if kind == "http" else FileQuoteProvider()
+
+
+quote_service = QuoteService(make_provider())
+
+
+def serve_stub(path=QUOTE_FILE, port=8088):
+    """Máy chủ giá giả lập đọc từ file JSON, dùng để thử HttpQuoteProvider khi không có mạng"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            symbols = parse_qs(urlparse(self.path).query).get("symbols", [""])[0].split(",")
+            with open(path, encoding='utf-8') as f: data = json.load(f)
+            body = json.dumps({s: data[s] for s in symbols if s in data}).encode()
+            self.send_response(200); self.send_header("Content-Type", "application/json"); self.send_header("Content-Length", str(len(body))); self.end_headers()
+            self.wfile.write(body)
+
+    ThreadingHTTPServer(("127.0.0.1", port), Handler).serve_forever()
+
+
+if __name__ == '__main__':
+    # python quotes.py [quotes.json] [port]
+    serve_stub(*(sys.argv[1:2] or [QUOTE_FILE]), *([int(sys.argv[2])] if len(sys.argv) > 2 else []))
@@ -0,0 +1,140 @@
+import os
+import time
+import asyncio
+import logging
+import datetime
+from db import db
+from schema import snapshot_values
+from metrics import metrics
+from notifier import notifier
+from price_alerts import price_alerts, PRICE_ALERT_INTERVAL
+
+SCHEDULER_ENABLED = os.environ.get("SCHEDULER_ENABLED", "1") != "0"
+# Giờ địa phương "HH:MM": chụp số dư cuối ngày và làm nóng cache lúc vắng người dùng
+SNAPSHOT_TIME = os.environ.get("SNAPSHOT_TIME", "23:55")
+WARM_TIME = os.environ.get("WARM_TIME", "04:30")
+WARM_MAX_USERS = int(os.environ.get("WARM_MAX_USERS", "200"))
+ALERT_INTERVAL = float(os.environ.get("ALERT_INTERVAL", "3600"))
+# % tiến độ mục tiêu sẽ được báo khi vượt qua; tụt xuống dưới mốc quá ALERT_HYSTERESIS % thì mốc đó được báo lại
+TARGET_MILESTONES = tuple(float(x) for x in os.environ.get("TARGET_MILESTONES", "50,75,90,100").split(","))
+ALERT_HYSTERESIS = float(os.environ.get("ALERT_HYSTERESIS", "5"))
+# Sụt giảm lãi/lỗ (đã trừ dòng nạp/rút) so với đỉnh trong DRAWDOWN_DAYS ngày, báo theo bậc DRAWDOWN_STEP %
+DRAWDOWN_STEP = float(os.environ.get("DRAWDOWN_STEP", "10"))
+DRAWDOWN_DAYS = int(os.environ.get("DRAWDOWN_DAYS", "90"))
+
+
+def _local_time(hhmm):
+    h, m = (int(x) for x in hhmm.split(":"))
+    return datetime.time(h, m, tzinfo=datetime.datetime.now().astimezone().tzinfo)
+
+def _money(amount):
+    return f"{int(amount):,}"
+
+
+# --- ĐÁNH GIÁ CẢNH BÁO (chạy trên 1 reader, trả về danh sách việc cần làm) ---
+def target_alerts(conn, state):
+    """Người dùng đã tự đặt mục tiêu: báo mốc cao nhất vừa vượt qua. ref = số tiền mục tiêu (đổi mục tiêu thì tính lại)"""
+    out = []
+    rows = conn.execute("""SELECT s.user_id, s.value, COALESCE(SUM(a.current_value), 0) FROM settings s LEFT JOIN assets a ON a.user_id = s.user_id
+                           WHERE s.key = 'target_asset' AND s.value > 0 GROUP BY s.user_id""").fetchall()
+    for uid, target, total in rows:
+        level, ref = state.get((uid, 'target'), (0.0, None))
+        if ref != target: level = 0.0
+        progress = total / target * 100
+        reached = max((m for m in TARGET_MILESTONES if progress >= m), default=0.0)
+        if reached > level:
+            text = (f"🎉 Chúc mừng! Tổng tài sản {_money(total)} đã đạt mục tiêu {_money(target)}." if reached >= 100 else
+                    f"🎯 Tổng tài sản {_money(total)} đã vượt mốc {reached:g}% mục tiêu ({progress:.1f}% của {_money(target)}).")
+            out.append((uid, 'target', reached, target, text))
+        elif progress < level - ALERT_HYSTERESIS or ref != target:
+            # Tụt hẳn xuống dưới mốc đã báo (hoặc đổi mục tiêu): hạ mức để lần vượt sau được báo lại, không gửi tin
+            out.append((uid, 'target', max((m for m in TARGET_MILESTONES if progress >= m), default=0.0), target, None))
+    return out
+
+def drawdown_alerts(conn, state, today):
+    """Lãi/lỗ = giá trị - vốn ròng; sụt giảm = đỉnh lãi/lỗ trong cửa sổ - hiện tại, tính theo % giá trị tại đỉnh.
+    ref = ngày (ordinal) của đỉnh: đỉnh mới thì bắt đầu đợt sụt giảm mới"""
+    since = (today - datetime.timedelta(days=DRAWDOWN_DAYS)).isoformat()
+    values, flows = {}, {}
+    for uid, d, v in conn.execute("SELECT user_id, date, value FROM daily_values WHERE category = '*' AND date >= ? ORDER BY user_id, date", (since,)):
+        values.setdefault(uid, []).append((d, v))
+    for uid, d, f in conn.execute("SELECT user_id, date, SUM(net_flow) FROM daily_flows WHERE date > ? GROUP BY user_id, date ORDER BY user_id, date", (since,)):
+        flows.setdefault(uid, []).append((d, f))
+    current = dict(conn.execute("SELECT user_id, COALESCE(SUM(current_value), 0) FROM assets GROUP BY user_id").fetchall())
+    out = []
+    for uid, points in values.items():
+        fl, i, cum, peak = flows.get(uid, []), 0, 0.0, None
+        for d, v in points:
+            while i < len(fl) and fl[i][0] <= d: cum += fl[i][1]; i += 1
+            if peak is None or v - cum > peak[0]: peak = (v - cum, v, d)
+        cum += sum(f for _, f in fl[i:])
+        pnl_now = current.get(uid, 0.0) - cum
+        if not peak or peak[1] <= 0: continue
+        pct = (peak[0] - pnl_now) / peak[1] * 100
+        level, ref = state.get((uid, 'drawdown'), (0.0, None))
+        peak_day = datetime.date.fromisoformat(peak[2]).toordinal()
+        if ref != peak_day: level = 0.0
+        step = (pct // DRAWDOWN_STEP) * DRAWDOWN_STEP
+        if step >= DRAWDOWN_STEP and step > level:
+            out.append((uid, 'drawdown', step, peak_day, f"📉 Cảnh báo sụt giảm: tài sản giảm {pct:.1f}% so với đỉnh ngày {peak[2]} (đã trừ nạp/rút), lỗ {_money(peak[0] - pnl_now)}."))
+        elif ref != peak_day:
+            out.append((uid, 'drawdown', step if step >= DRAWDOWN_STEP else 0.0, peak_day, None))
+    return out
+
+
+class Scheduler:
+    """Việc nền trên JobQueue của Application: chụp số dư cuối ngày, làm nóng cache, cảnh báo mục tiêu/sụt giảm và cảnh báo giá.
+    warmers: các hàm async fn(uid) được gọi lần lượt cho người dùng hoạt động gần đây"""
+
+    def __init__(self):
+        self.warmers = []
+
+    def setup(self, app):
+        if not SCHEDULER_ENABLED: return
+        if app.job_queue is None:
+            logging.warning("Thiếu JobQueue (cài python-telegram-bot[job-queue]): bỏ qua việc nền")
+            return
+        jq = app.job_queue
+        jq.run_daily(self.snapshot_job, _local_time(SNAPSHOT_TIME), name="snapshot")
+        jq.run_daily(self.warm_job, _local_time(WARM_TIME), name="warm")
+        jq.run_repeating(self.alert_job, ALERT_INTERVAL, first=60, name="alerts")
+        jq.run_repeating(self.price_job, PRICE_ALERT_INTERVAL, first=10, name="price_alerts")
+
+    async def snapshot_job(self, context=None):
+        with metrics.timer('job_seconds', job='snapshot'):
+            n = await db.write(snapshot_values)
+        logging.info(f"Đã chụp số dư cuối ngày: {n} dòng mới")
+
+    async def warm_job(self, context=None):
+        with metrics.timer('job_seconds', job='warm'):
+            # Người dùng có giao dịch gần nhất được ưu tiên (cache là LRU nên làm nóng quá nhiều cũng bị đẩy ra)
+            users = [r[0] for r in await db.fetchall("SELECT user_id FROM daily_flows GROUP BY user_id ORDER BY MAX(date) DESC LIMIT ?", (WARM_MAX_USERS,))]
+            t = time.perf_counter()
+            for uid in users:
+                for warm in self.warmers:
+                    try: await warm(uid)
+                    except Exception as e: logging.warning(f"Làm nóng cache {uid} lỗi: {e}")
+                await asyncio.sleep(0)  # nhường event loop cho update đang chờ
+        logging.info(f"Đã làm nóng cache cho {len(users)} người dùng sau {time.perf_counter() - t:.1f}s")
+
+    async def alert_job(self, context=None):
+        with metrics.timer('job_seconds', job='alerts'):
+            today = datetime.date.today()
+
+            def evaluate(conn):
+                state = {(r[0], r[1]): (r[2], r[3]) for r in conn.execute("SELECT user_id, kind, level, ref FROM alert_state")}
+                return target_alerts(conn, state) + drawdown_alerts(conn, state, today)
+
+            changes = await db.read(evaluate)
+            if changes:
+                await db.write(lambda c: c.executemany("INSERT OR REPLACE INTO alert_state (user_id, kind, level, ref) VALUES (?, ?, ?, ?)", [ch[:4] for ch in changes]))
+            sent = sum(notifier.enqueue(uid, text) for uid, _, _, _, text in changes if text)
+        if sent: logging.info(f"Đã xếp {sent} cảnh báo vào hàng gửi")
+        return sent
+
+    async def price_job(self, context=None):
+        with metrics.timer('job_seconds', job='price_alerts'):
+            return await price_alerts.poll()
+
+
+scheduler = Scheduler()
@@ -0,0 +1,273 @@
+import os
+import logging
+from db import db
+
+# Chat sở hữu dữ liệu cũ (DB 1 người dùng trước đây) và dữ liệu mẫu trong data.py
+OWNER_CHAT_ID = int(os.environ.get("OWNER_CHAT_ID", "0"))
+
+# Mọi bảng dữ liệu người dùng đều phân vùng theo user_id (= chat_id Telegram)
+TABLES = [
+    '''CREATE TABLE IF NOT EXISTS assets (user_id INTEGER NOT NULL, category TEXT NOT NULL, current_value REAL, PRIMARY KEY (user_id, category))''',
+    '''CREATE TABLE IF NOT EXISTS transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL DEFAULT 0, category TEXT, type TEXT, amount REAL, date TEXT, note TEXT, content_hash TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS settings (user_id INTEGER NOT NULL, key TEXT NOT NULL, value REAL, PRIMARY KEY (user_id, key))''',
+    '''CREATE TABLE IF NOT EXISTS stock_holdings (user_id INTEGER NOT NULL, symbol TEXT NOT NULL, qty REAL, avg_price REAL, total_cost REAL, PRIMARY KEY (user_id, symbol))''',
+    '''CREATE TABLE IF NOT EXISTS stock_orders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, symbol TEXT, type TEXT, qty REAL, price REAL, fee REAL, date TEXT, content_hash TEXT)''',
+    # Bảng tổng hợp Nạp/Rút theo danh mục, được trigger cập nhật trên mỗi lần thêm/sửa/xóa giao dịch
+    '''CREATE TABLE IF NOT EXISTS tx_totals (user_id INTEGER NOT NULL, category TEXT NOT NULL, type TEXT NOT NULL, total REAL NOT NULL DEFAULT 0, cnt INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (user_id, category, type)) WITHOUT ROWID''',
+    # Phiên bản dữ liệu theo người dùng: mọi thay đổi đều làm cache phụ thuộc hết hạn
+    # Chuỗi ngày cho biểu đồ: dòng tiền ròng (Nạp - Rút) theo ngày/danh mục và ảnh chụp số dư thực ('*' = tổng)
+    '''CREATE TABLE IF NOT EXISTS daily_flows (user_id INTEGER NOT NULL, date TEXT NOT NULL, category TEXT NOT NULL, net_flow REAL NOT NULL DEFAULT 0, cnt INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (user_id, date, category)) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS daily_values (user_id INTEGER NOT NULL, date TEXT NOT NULL, category TEXT NOT NULL, value REAL NOT NULL, PRIMARY KEY (user_id, date, category)) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS data_versions (user_id INTEGER NOT NULL, scope TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (user_id, scope)) WITHOUT ROWID''',
+]
+
+INDEXES = [
+    # Chỉ mục phủ cho màn lịch sử: seek theo (user_id, date, id) không cần đọc bảng gốc
+    "CREATE INDEX IF NOT EXISTS idx_tx_history ON transactions (user_id, date, id, category, type, amount)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_user ON stock_orders (user_id, id)",
+]
+
+TOTALS_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS trg_totals_ins AFTER INSERT ON transactions BEGIN
+        INSERT INTO tx_totals (user_id, category, type, total, cnt) VALUES (NEW.user_id, COALESCE(NEW.category, ''), COALESCE(NEW.type, ''), COALESCE(NEW.amount, 0), 1)
+        ON CONFLICT (user_id, category, type) DO UPDATE SET total = total + excluded.total, cnt = cnt + 1;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_totals_del AFTER DELETE ON transactions BEGIN
+        UPDATE tx_totals SET total = total - COALESCE(OLD.amount, 0), cnt = cnt - 1 WHERE user_id = OLD.user_id AND category = COALESCE(OLD.category, '') AND type = COALESCE(OLD.type, '');
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_totals_upd AFTER UPDATE OF user_id, category, type, amount ON transactions BEGIN
+        UPDATE tx_totals SET total = total - COALESCE(OLD.amount, 0), cnt = cnt - 1 WHERE user_id = OLD.user_id AND category = COALESCE(OLD.category, '') AND type = COALESCE(OLD.type, '');
+        INSERT INTO tx_totals (user_id, category, type, total, cnt) VALUES (NEW.user_id, COALESCE(NEW.category, ''), COALESCE(NEW.type, ''), COALESCE(NEW.amount, 0), 1)
+        ON CONFLICT (user_id, category, type) DO UPDATE SET total = total + excluded.total, cnt = cnt + 1;
+    END''',
+]
+
+def _flow(row):
+    return f"CASE WHEN {row}.type = 'Nạp' THEN COALESCE({row}.amount, 0) ELSE -COALESCE({row}.amount, 0) END"
+
+_FLOW_ADD = '''INSERT INTO daily_flows (user_id, date, category, net_flow, cnt) VALUES (NEW.user_id, substr(COALESCE(NEW.date, ''), 1, 10), COALESCE(NEW.category, ''), {flow}, 1)
+        ON CONFLICT (user_id, date, category) DO UPDATE SET net_flow = net_flow + excluded.net_flow, cnt = cnt + 1;'''.format(flow=_flow('NEW'))
+_FLOW_SUB = '''UPDATE daily_flows SET net_flow = net_flow - {flow}, cnt = cnt - 1 WHERE user_id = OLD.user_id AND date = substr(COALESCE(OLD.date, ''), 1, 10) AND category = COALESCE(OLD.category, '');'''.format(flow=_flow('OLD'))
+_VALUE_SNAPSHOT = '''INSERT INTO daily_values (user_id, date, category, value) VALUES (NEW.user_id, date('now', 'localtime'), NEW.category, COALESCE(NEW.current_value, 0))
+        ON CONFLICT (user_id, date, category) DO UPDATE SET value = excluded.value;
+        INSERT INTO daily_values (user_id, date, category, value) SELECT NEW.user_id, date('now', 'localtime'), '*', COALESCE(SUM(current_value), 0) FROM assets WHERE user_id = NEW.user_id
+        ON CONFLICT (user_id, date, category) DO UPDATE SET value = excluded.value;'''
+
+SERIES_TRIGGERS = [
+    f'''CREATE TRIGGER IF NOT EXISTS trg_flows_ins AFTER INSERT ON transactions BEGIN {_FLOW_ADD} END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_flows_del AFTER DELETE ON transactions BEGIN {_FLOW_SUB} END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_flows_upd AFTER UPDATE OF user_id, category, type, amount, date ON transactions BEGIN {_FLOW_SUB} {_FLOW_ADD} END''',
+    # Số dư thực chỉ có giá trị hiện tại nên mỗi lần cập nhật ghi đè ảnh chụp của ngày hôm nay
+    f'''CREATE TRIGGER IF NOT EXISTS trg_values_ins AFTER INSERT ON assets BEGIN {_VALUE_SNAPSHOT} END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_values_upd AFTER UPDATE OF current_value ON assets BEGIN {_VALUE_SNAPSHOT} END''',
+]
+
+def _version_triggers(scope, tables):
+    for table in tables:
+        for event, row in [('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')]:
+            yield f'''CREATE TRIGGER IF NOT EXISTS trg_ver_{table}_{event.lower()} AFTER {event} ON {table} BEGIN
+                INSERT INTO data_versions (user_id, scope, version) VALUES ({row}.user_id, '{scope}', 1) ON CONFLICT (user_id, scope) DO UPDATE SET version = version + 1;
+            END'''
+
+VERSION_TRIGGERS = list(_version_triggers('ledger', ['transactions', 'assets', 'settings'])) + list(_version_triggers('orders', ['stock_orders']))
+
+
+def _columns(c, table):
+    # table_xinfo liệt kê cả cột sinh (generated column)
+    return [r[1] for r in c.execute(f"PRAGMA table_xinfo({table})")]
+
+def _upgrade_single_user(c):
+    """Nâng cấp DB 1 người dùng cũ: gán toàn bộ dữ liệu cho OWNER_CHAT_ID"""
+    if not _columns(c, 'transactions') or 'user_id' in _columns(c, 'transactions'): return
+    logging.info(f"Nâng cấp DB cũ sang đa người dùng, dữ liệu thuộc chat {OWNER_CHAT_ID}")
+    if not OWNER_CHAT_ID: logging.warning("OWNER_CHAT_ID chưa đặt: dữ liệu cũ sẽ không hiển thị cho ai")
+    for (name,) in c.execute("SELECT name FROM sqlite_master WHERE type='trigger'").fetchall(): c.execute(f"DROP TRIGGER {name}")
+    for obj in ['tx_totals', 'data_versions', 'daily_flows', 'daily_values']: c.execute(f"DROP TABLE IF EXISTS {obj}")
+    c.execute("DROP INDEX IF EXISTS idx_tx_history")
+    # Thêm note TEXT vào bảng transactions rất cũ
+    if 'note' not in _columns(c, 'transactions'): c.execute("ALTER TABLE transactions ADD COLUMN note TEXT")
+    c.execute("ALTER TABLE transactions ADD COLUMN user_id INTEGER NOT NULL DEFAULT 0")
+    c.execute("UPDATE transactions SET user_id = ?", (OWNER_CHAT_ID,))
+    # assets/settings đổi khóa chính nên phải dựng lại bảng
+    for table, cols in [('assets', 'category, current_value'), ('settings', 'key, value')]:
+        if not _columns(c, table): continue
+        c.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+        c.execute(next(t for t in TABLES if f" {table} (" in t))
+        c.execute(f"INSERT INTO {table} (user_id, {cols}) SELECT ?, {cols} FROM {table}_legacy", (OWNER_CHAT_ID,))
+        c.execute(f"DROP TABLE {table}_legacy")
+
+def _seed_owner(c):
+    try:
+        from data import INITIAL_ASSETS, INITIAL_TRANSACTIONS
+    except ImportError:
+        return
+    if OWNER_CHAT_ID and INITIAL_TRANSACTIONS and c.execute("SELECT COUNT(*) FROM transactions WHERE user_id = ?", (OWNER_CHAT_ID,)).fetchone()[0] == 0:
+        c.executemany("INSERT OR REPLACE INTO assets (user_id, category, current_value) VALUES (?, ?, ?)", [(OWNER_CHAT_ID, *a) for a in INITIAL_ASSETS])
+        # Thêm cột note rỗng cho dữ liệu ban đầu để tránh lỗi
+        processed_tx = [(OWNER_CHAT_ID, *t, "") for t in INITIAL_TRANSACTIONS]
+        c.executemany("INSERT INTO transactions (user_id, category, type, amount, date, note) VALUES (?, ?, ?, ?, ?, ?)", processed_tx)
+
+def _migrate_1(c):
+    """Schema gốc: nhận cả DB mới, DB 1 người dùng cũ và DB tạo trước khi có user_version"""
+    _upgrade_single_user(c)
+    has_totals = c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='tx_totals'").fetchone()
+    has_series = c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='daily_flows'").fetchone()
+    for sql in TABLES + INDEXES + TOTALS_TRIGGERS + SERIES_TRIGGERS + VERSION_TRIGGERS: c.execute(sql)
+    if not has_totals: rebuild_totals(c)
+    if not has_series: rebuild_series(c)
+    _seed_owner(c)
+
+# Dòng nhập từ sao kê mang hash nội dung; dòng nhập tay để NULL nên không bị chặn trùng
+HASH_INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_tx_hash ON transactions (user_id, content_hash) WHERE content_hash IS NOT NULL",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_hash ON stock_orders (user_id, content_hash) WHERE content_hash IS NOT NULL",
+]
+
+def _migrate_2(c):
+    """content_hash + chỉ mục UNIQUE cho nhập sao kê CSV/XLSX"""
+    for table in ('transactions', 'stock_orders'):
+        if 'content_hash' not in _columns(c, table): c.execute(f"ALTER TABLE {table} ADD COLUMN content_hash TEXT")
+    for sql in HASH_INDEXES: c.execute(sql)
+
+# file_id Telegram trả về sau lần upload đầu, khóa theo hash nội dung PNG/XLSX (dùng chung mọi chat)
+FILE_ID_TABLE = [
+    "CREATE TABLE IF NOT EXISTS tg_file_ids (hash TEXT PRIMARY KEY, kind TEXT NOT NULL, file_id TEXT NOT NULL, last_used REAL NOT NULL) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS idx_tg_file_ids_used ON tg_file_ids (last_used)",
+]
+
+def _migrate_3(c):
+    """Cache file_id cho biểu đồ/báo cáo đã gửi"""
+    for sql in FILE_ID_TABLE: c.execute(sql)
+
+# Chỉ mục FTS5 cho ghi chú giao dịch (external content: chỉ lưu chỉ mục, nội dung đọc từ bảng transactions).
+# Cột user_id cũng được đánh chỉ mục để FTS tự giao với danh sách dòng của 1 người dùng thay vì trả về khớp của mọi người;
+# remove_diacritics để gõ không dấu vẫn tìm ra ghi chú có dấu
+NOTES_FTS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS tx_notes_fts USING fts5(note, user_id, content='transactions', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS trg_notes_ins AFTER INSERT ON transactions WHEN NEW.note != '' BEGIN INSERT INTO tx_notes_fts (rowid, note, user_id) VALUES (NEW.id, NEW.note, NEW.user_id); END",
+    "CREATE TRIGGER IF NOT EXISTS trg_notes_del AFTER DELETE ON transactions WHEN OLD.note != '' BEGIN INSERT INTO tx_notes_fts (tx_notes_fts, rowid, note, user_id) VALUES ('delete', OLD.id, OLD.note, OLD.user_id); END",
+    """CREATE TRIGGER IF NOT EXISTS trg_notes_upd AFTER UPDATE OF note, user_id ON transactions BEGIN
+        INSERT INTO tx_notes_fts (tx_notes_fts, rowid, note, user_id) SELECT 'delete', OLD.id, OLD.note, OLD.user_id WHERE OLD.note != '';
+        INSERT INTO tx_notes_fts (rowid, note, user_id) SELECT NEW.id, NEW.note, NEW.user_id WHERE NEW.note != '';
+    END""",
+    # Lọc theo danh mục/loại rồi khoảng ngày khi tìm kiếm (chỉ mục phủ, không đọc bảng gốc)
+    "CREATE INDEX IF NOT EXISTS idx_tx_filter ON transactions (user_id, category, type, date, id, amount)",
+]
+
+def _migrate_4(c):
+    """Tìm kiếm ghi chú (FTS5) + chỉ mục lọc; đánh chỉ mục lại toàn bộ ghi chú đã có"""
+    for sql in NOTES_FTS: c.execute(sql)
+    # 'rebuild' sẽ đánh chỉ mục cả dòng không có ghi chú (trigger thì bỏ qua) nên tự nạp các dòng có ghi chú
+    c.execute("INSERT INTO tx_notes_fts (rowid, note, user_id) SELECT id, note, user_id FROM transactions WHERE note != ''")
+
+# Tổng Nạp/Rút theo tháng ('YYYY-MM')/danh mục; quý và năm cộng từ tối đa 3/12 dòng tháng nên không lưu riêng
+ROLLUP_TABLE = '''CREATE TABLE IF NOT EXISTS period_rollups (user_id INTEGER NOT NULL, month TEXT NOT NULL, category TEXT NOT NULL, inflow REAL NOT NULL DEFAULT 0, outflow REAL NOT NULL DEFAULT 0, cnt INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (user_id, month, category)) WITHOUT ROWID'''
+
+def _split(row):
+    amount = f"COALESCE({row}.amount, 0)"
+    return f"CASE WHEN {row}.type = 'Nạp' THEN {amount} ELSE 0 END", f"CASE WHEN {row}.type = 'Nạp' THEN 0 ELSE {amount} END"
+
+_ROLLUP_ADD = '''INSERT INTO period_rollups (user_id, month, category, inflow, outflow, cnt) VALUES (NEW.user_id, substr(COALESCE(NEW.date, ''), 1, 7), COALESCE(NEW.category, ''), {0}, {1}, 1)
+        ON CONFLICT (user_id, month, category) DO UPDATE SET inflow = inflow + excluded.inflow, outflow = outflow + excluded.outflow, cnt = cnt + 1;'''.format(*_split('NEW'))
+_ROLLUP_SUB = '''UPDATE period_rollups SET inflow = inflow - {0}, outflow = outflow - {1}, cnt = cnt - 1
+        WHERE user_id = OLD.user_id AND month = substr(COALESCE(OLD.date, ''), 1, 7) AND category = COALESCE(OLD.category, '');'''.format(*_split('OLD'))
+
+ROLLUP_TRIGGERS = [
+    f'''CREATE TRIGGER IF NOT EXISTS trg_rollup_ins AFTER INSERT ON transactions BEGIN {_ROLLUP_ADD} END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_rollup_del AFTER DELETE ON transactions BEGIN {_ROLLUP_SUB} END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_rollup_upd AFTER UPDATE OF user_id, category, type, amount, date ON transactions BEGIN {_ROLLUP_SUB} {_ROLLUP_ADD} END''',
+]
+
+# Ngày dạng số YYYYMMDD (cột sinh VIRTUAL, không tốn chỗ trong bảng) để lọc khoảng ngày bằng chỉ mục số
+DATE_INT = "INTEGER GENERATED ALWAYS AS (CAST(replace(substr(date, 1, 10), '-', '') AS INTEGER)) VIRTUAL"
+DATE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_tx_date_int ON transactions (user_id, date_int, category, type, amount)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_date_int ON stock_orders (user_id, date_int, type, qty, price)",
+]
+
+def _migrate_5(c):
+    """Cột ngày dạng số + chỉ mục, bảng tổng hợp theo tháng cho màn thống kê theo kỳ"""
+    for table in ('transactions', 'stock_orders'):
+        if 'date_int' not in _columns(c, table): c.execute(f"ALTER TABLE {table} ADD COLUMN date_int {DATE_INT}")
+    for sql in [ROLLUP_TABLE] + DATE_INDEXES + ROLLUP_TRIGGERS: c.execute(sql)
+    rebuild_rollups(c)
+
+# Trạng thái cảnh báo định kỳ của từng người dùng: mức đã báo (level) và mốc tham chiếu (ref) để không báo lặp
+ALERT_TABLE = "CREATE TABLE IF NOT EXISTS alert_state (user_id INTEGER NOT NULL, kind TEXT NOT NULL, level REAL NOT NULL DEFAULT 0, ref REAL, PRIMARY KEY (user_id, kind)) WITHOUT ROWID"
+
+def _migrate_6(c):
+    """Bảng trạng thái cho cảnh báo mục tiêu / sụt giảm"""
+    c.execute(ALERT_TABLE)
+
+# Cảnh báo giá theo mã: kind 'price' (value = giá) hoặc 'cost' (value = % so với giá vốn bình quân), op '<' / '>'.
+# fired = đã báo và đang chờ giá quay lại qua ngưỡng để kích hoạt lại
+PRICE_ALERT_TABLE = """CREATE TABLE IF NOT EXISTS price_alerts (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, symbol TEXT NOT NULL, kind TEXT NOT NULL,
+                       op TEXT NOT NULL, value REAL NOT NULL, fired INTEGER NOT NULL DEFAULT 0, UNIQUE (user_id, symbol, kind, op, value))"""
+
+def _migrate_7(c):
+    """Bảng cảnh báo giá / lãi-lỗ theo mã cổ phiếu"""
+    c.execute(PRICE_ALERT_TABLE)
+
+# Mỗi bước nâng schema lên 1 phiên bản; chỉ thêm bước mới vào cuối, không sửa bước đã phát hành
+MIGRATIONS = [_migrate_1, _migrate_2, _migrate_3, _migrate_4, _migrate_5, _migrate_6, _migrate_7]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def _create_schema(c):
+    """Chạy các migration còn thiếu theo PRAGMA user_version, trả về số bước đã chạy (0 = schema đã mới nhất)"""
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION: logging.warning(f"DB có schema v{version} mới hơn bản bot này (v{SCHEMA_VERSION})")
+    for v in range(version, SCHEMA_VERSION):
+        logging.info(f"Nâng cấp schema DB v{v} -> v{v + 1}")
+        MIGRATIONS[v](c)
+        c.execute(f"PRAGMA user_version = {v + 1}")
+    return max(0, SCHEMA_VERSION - version)
+
+def init_db():
+    with db.writer() as c:
+        return _create_schema(c)
+
+
+def rebuild_totals(c):
+    """Tính lại toàn bộ bảng tx_totals từ transactions (dùng sau khi restore DB cũ)"""
+    c.execute("DELETE FROM tx_totals")
+    c.execute("INSERT INTO tx_totals (user_id, category, type, total, cnt) SELECT user_id, COALESCE(category, ''), COALESCE(type, ''), COALESCE(SUM(amount), 0), COUNT(*) FROM transactions GROUP BY 1, 2, 3")
+
+def rebuild_series(c):
+    """Dựng lại daily_flows từ transactions; số dư thực không có lịch sử nên chỉ chụp được ngày hôm nay"""
+    c.execute("DELETE FROM daily_flows")
+    c.execute(f"""INSERT INTO daily_flows (user_id, date, category, net_flow, cnt)
+                  SELECT user_id, substr(COALESCE(date, ''), 1, 10), COALESCE(category, ''), SUM({_flow('transactions')}), COUNT(*) FROM transactions GROUP BY 1, 2, 3""")
+    snapshot_values(c)
+
+def snapshot_values(c):
+    """Chụp số dư thực hôm nay cho mọi người dùng (ngày đã có ảnh chụp thì giữ nguyên), trả về số dòng mới"""
+    return c.execute("""INSERT OR IGNORE INTO daily_values (user_id, date, category, value)
+                        SELECT user_id, date('now', 'localtime'), category, COALESCE(current_value, 0) FROM assets
+                        UNION ALL SELECT user_id, date('now', 'localtime'), '*', COALESCE(SUM(current_value), 0) FROM assets GROUP BY user_id""").rowcount
+
+def rebuild_rollups(c):
+    """Dựng lại period_rollups từ transactions"""
+    inflow, outflow = _split('transactions')
+    c.execute("DELETE FROM period_rollups")
+    c.execute(f"""INSERT INTO period_rollups (user_id, month, category, inflow, outflow, cnt)
+                  SELECT user_id, substr(COALESCE(date, ''), 1, 7), COALESCE(category, ''), SUM({inflow}), SUM({outflow}), COUNT(*) FROM transactions GROUP BY 1, 2, 3""")
+
+def _diff(actual, stored):
+    return [k for k in actual.keys() | stored.keys() if k not in actual or k not in stored or any(abs(a - b) > 0.5 for a, b in zip(actual[k], stored[k]))]
+
+def verify_totals(c, rebuild=True):
+    """So khớp tx_totals, daily_flows và period_rollups với dữ liệu gốc, trả về danh sách (user_id, danh mục, loại/ngày) bị lệch"""
+    actual = {r[:3]: r[3:] for r in c.execute("SELECT user_id, COALESCE(category, ''), COALESCE(type, ''), COALESCE(SUM(amount), 0), COUNT(*) FROM transactions GROUP BY 1, 2, 3")}
+    stored = {r[:3]: r[3:] for r in c.execute("SELECT user_id, category, type, total, cnt FROM tx_totals WHERE cnt != 0 OR total != 0")}
+    bad = _diff(actual, stored)
+    if bad and rebuild: rebuild_totals(c)
+    actual = {r[:3]: r[3:] for r in c.execute(f"SELECT user_id, COALESCE(category, ''), substr(COALESCE(date, ''), 1, 10), SUM({_flow('transactions')}), COUNT(*) FROM transactions GROUP BY 1, 2, 3")}
+    stored = {r[:3]: r[3:] for r in c.execute("SELECT user_id, category, date, net_flow, cnt FROM daily_flows WHERE cnt != 0 OR net_flow != 0")}
+    bad_series = _diff(actual, stored)
+    if bad_series and rebuild: rebuild_series(c)
+    inflow, outflow = _split('transactions')
+    actual = {r[:3]: r[3:] for r in c.execute(f"SELECT user_id, COALESCE(category, ''), substr(COALESCE(date, ''), 1, 7), SUM({inflow}), SUM({outflow}), COUNT(*) FROM transactions GROUP BY 1, 2, 3")}
+    stored = {r[:3]: r[3:] for r in c.execute("SELECT user_id, category, month, inflow, outflow, cnt FROM period_rollups WHERE cnt != 0 OR inflow != 0 OR outflow != 0")}
+    bad_rollups = _diff(actual, stored)
+    if bad_rollups and rebuild: rebuild_rollups(c)
+    return sorted(bad + bad_series + bad_rollups)
@@ -0,0 +1,101 @@
+import re
+import datetime
+
+SEARCH_PAGE_SIZE = 10
+CATEGORY_WORDS = {'crypto': 'Crypto', 'coin': 'Crypto', 'stock': 'Stock', 'ck': 'Stock', 'cash': 'Cash', 'tienmat': 'Cash'}
+TYPE_WORDS = {'nạp': 'Nạp', 'nap': 'Nạp', 'rút': 'Rút', 'rut': 'Rút'}
+
+_COMPARE = re.compile(r'^(>=|<=|>|<)(.+)$')
+_DAY = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})$|^(\d{1,2})/(\d{1,2})/(\d{4})$')
+_MONTH = re.compile(r'^(\d{4})-(\d{1,2})$|^(\d{1,2})/(\d{4})$')
+_YEAR = re.compile(r'^(19|20)\d{2}$')
+
+
+def _next_month(y, m):
+    return (y + 1, 1) if m == 12 else (y, m + 1)
+
+def date_bounds(token):
+    """'2024' / '03/2024' / '2024-03' / '15/03/2024' -> (từ ngày, tới trước ngày) dạng 'YYYY-MM-DD', không phải ngày thì None"""
+    try:
+        if _YEAR.match(token): y = int(token); return f"{y:04d}-01-01", f"{y + 1:04d}-01-01"
+        m = _MONTH.match(token)
+        if m:
+            y, mo = (int(m[1]), int(m[2])) if m[1] else (int(m[4]), int(m[3]))
+            datetime.date(y, mo, 1)
+            return f"{y:04d}-{mo:02d}-01", "%04d-%02d-01" % _next_month(y, mo)
+        m = _DAY.match(token)
+        if m:
+            y, mo, d = (int(m[1]), int(m[2]), int(m[3])) if m[1] else (int(m[6]), int(m[5]), int(m[4]))
+            day = datetime.date(y, mo, d)
+            return day.isoformat(), (day + datetime.timedelta(days=1)).isoformat()
+    except ValueError:
+        return None
+    return None
+
+def parse_query(text, parse_amount):
+    """Tách câu tìm kiếm thành bộ lọc + từ khóa ghi chú.
+
+    crypto/stock/cash -> danh mục, nạp/rút -> loại, >5tr / <=10tr / 1tr-5tr -> khoảng số tiền,
+    2024 / 03/2024 / 15/03/2024 / 2024-01..2024-06 -> khoảng ngày; còn lại là từ khóa tìm trong ghi chú"""
+    f = {'words': [], 'category': None, 'type': None, 'min': None, 'max': None, 'from': None, 'to': None}
+    for token in text.lower().split():
+        if token in CATEGORY_WORDS: f['category'] = CATEGORY_WORDS[token]; continue
+        if token in TYPE_WORDS: f['type'] = TYPE_WORDS[token]; continue
+        if '..' in token:
+            lo, hi = (date_bounds(t) for t in token.split('..', 1))
+            if lo and hi: f['from'], f['to'] = lo[0], hi[1]; continue
+        bounds = date_bounds(token)
+        if bounds: f['from'], f['to'] = bounds; continue
+        m = _COMPARE.match(token)
+        if m and _amount(m[2], parse_amount) is not None:
+            f['min' if m[1].startswith('>') else 'max'] = _amount(m[2], parse_amount); continue
+        if '-' in token:
+            lo, hi = (_amount(t, parse_amount) for t in token.split('-', 1))
+            if lo is not None and hi is not None: f['min'], f['max'] = min(lo, hi), max(lo, hi); continue
+        word = token.strip('"\'.,;:!?()')
+        if word: f['words'].append(word)
+    return f
+
+def _amount(token, parse_amount):
+    try: return parse_amount(token)
+    except ValueError: return None
+
+def fts_query(user_id, words):
+    """Mỗi từ là 1 tiền tố trong dấu nháy (không bị hiểu thành cú pháp FTS5), các từ nối bằng AND, giới hạn trong ghi chú của user_id"""
+    return f'user_id : "{user_id}" AND note : (' + " ".join('"' + w.replace('"', '""') + '"*' for w in words) + ')'
+
+def describe(f):
+    parts = [f"“{' '.join(f['words'])}”"] if f['words'] else []
+    if f['category']: parts.append(f['category'])
+    if f['type']: parts.append(f['type'])
+    if f['min'] is not None: parts.append(f"≥ {int(f['min']):,}")
+    if f['max'] is not None: parts.append(f"≤ {int(f['max']):,}")
+    if f['from']: parts.append(f"{f['from']} → {(datetime.date.fromisoformat(f['to']) - datetime.timedelta(days=1)).isoformat()}")
+    return ", ".join(parts)
+
+def _where(user_id, f):
+    """(FROM, WHERE, tham số): có từ khóa thì đi từ các dòng FTS khớp (ít) rồi tra bảng theo khóa chính,
+    không thì seek chỉ mục (user_id, ...) như màn lịch sử"""
+    source, sql, args = "transactions t", ["t.user_id = ?"], [user_id]
+    if f['words']:
+        source = "tx_notes_fts CROSS JOIN transactions t ON t.id = tx_notes_fts.rowid"
+        sql.insert(0, "tx_notes_fts MATCH ?"); args.insert(0, fts_query(user_id, f['words']))
+    if f['category']: sql.append("t.category = ?"); args.append(f['category'])
+    if f['type']: sql.append("t.type = ?"); args.append(f['type'])
+    if f['min'] is not None: sql.append("t.amount >= ?"); args.append(f['min'])
+    if f['max'] is not None: sql.append("t.amount <= ?"); args.append(f['max'])
+    if f['from']: sql.append("t.date >= ? AND t.date < ?"); args += [f['from'], f['to']]
+    return f"{source} WHERE " + " AND ".join(sql), args
+
+def load_page(conn, user_id, f, cursor=None):
+    """Giống _load_history_page nhưng có bộ lọc: seek theo (date, id) nên trang sâu không phải quét lại từ đầu.
+    Trả về (rows, prev, summary); summary = (số giao dịch, tổng nạp, tổng rút) chỉ tính ở trang đầu"""
+    where, args = _where(user_id, f)
+    cols = "SELECT t.id, t.category, t.type, t.amount, t.date, t.note FROM " + where
+    if cursor is None:
+        rows = conn.execute(cols + " ORDER BY t.date DESC, t.id DESC LIMIT ?", (*args, SEARCH_PAGE_SIZE + 1)).fetchall()
+        summary = conn.execute("SELECT COUNT(*), COALESCE(SUM(CASE WHEN t.type = 'Nạp' THEN t.amount END), 0), COALESCE(SUM(CASE WHEN t.type = 'Rút' THEN t.amount END), 0) FROM " + where, args).fetchone()
+        return rows, None, summary
+    rows = conn.execute(cols + " AND (t.date, t.id) <= (?, ?) ORDER BY t.date DESC, t.id DESC LIMIT ?", (*args, *cursor, SEARCH_PAGE_SIZE + 1)).fetchall()
+    prev = conn.execute("SELECT t.date, t.id FROM " + where + " AND (t.date, t.id) > (?, ?) ORDER BY t.date ASC, t.id ASC LIMIT 1 OFFSET ?", (*args, *cursor, SEARCH_PAGE_SIZE - 1)).fetchone()
+    return rows, prev, None
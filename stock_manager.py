@@ -1,124 +1,153 @@
-import sqlite3
-import pandas as pd
+import asyncio
 import datetime
-import os
+from db import db
+from analytics import analytics
+from quotes import quote_service
 
-DB_FILE = 'portfolio.db'
+FEE_RATE = 0.001  # Giả định phí giao dịch 0.1%
+
+class OrderError(Exception):
+    pass
 
 class StockManager:
     def __init__(self):
         # Không gọi init_db ở đây để tránh xung đột, 
-        # việc tạo bảng sẽ do main.py quản lý khi khởi động.
+        # việc tạo bảng sẽ do schema.init_db quản lý khi khởi động.
         pass
 
-    def _get_conn(self):
-        return sqlite3.connect(DB_FILE)
-
     # --- BƯỚC 1, 2, 3: QUẢN LÝ TIỀN MẶT (CASH) ---
-    def get_stock_cash(self):
+    def get_stock_cash(self, user_id):
         """Lấy số dư tiền mặt chuyên biệt cho chứng khoán từ bảng assets"""
-        with self._get_conn() as conn:
-            res = conn.execute("SELECT current_value FROM assets WHERE category='Stock'").fetchone()
+        with db.reader() as conn:
+            res = conn.execute("SELECT current_value FROM assets WHERE user_id=? AND category='Stock'", (user_id,)).fetchone()
             return res[0] if res else 0
 
-    def update_stock_cash(self, amount, tx_type="Nạp"):
-        """Nạp/Rút tiền vào tài khoản chứng khoán (Đồng bộ với module Main)"""
-        with self._get_conn() as conn:
-            curr = self.get_stock_cash()
-            new_bal = curr + amount if tx_type == "Nạp" else curr - amount
-            
-            # Cập nhật bảng assets (để module main hiển thị đúng tổng tài sản)
-            conn.execute("INSERT OR REPLACE INTO assets (category, current_value) VALUES ('Stock', ?)", (new_bal,))
-            
-            # Ghi vào lịch sử giao dịch chung
-            date_str = datetime.datetime.now().strftime("%Y-%m-%d")
-            conn.execute("INSERT INTO transactions (category, type, amount, date) VALUES ('Stock', ?, ?, ?)",
-                         (tx_type, abs(amount), date_str))
-            conn.commit()
+    def _apply_cash(self, conn, user_id, amount, tx_type, date_str, note=None):
+        """Cập nhật số dư Stock + ghi sổ giao dịch chung trên kết nối đang giữ khóa ghi"""
+        res = conn.execute("SELECT current_value FROM assets WHERE user_id=? AND category='Stock'", (user_id,)).fetchone()
+        curr = res[0] if res else 0
+        new_bal = curr + amount if tx_type == "Nạp" else curr - amount
+
+        # Cập nhật bảng assets (để module main hiển thị đúng tổng tài sản)
+        conn.execute("INSERT OR REPLACE INTO assets (user_id, category, current_value) VALUES (?, 'Stock', ?)", (user_id, new_bal))
+
+        # Ghi vào lịch sử giao dịch chung
+        conn.execute("INSERT INTO transactions (user_id, category, type, amount, date, note) VALUES (?, 'Stock', ?, ?, ?, ?)",
+                     (user_id, tx_type, abs(amount), date_str[:10], note))
         return new_bal
 
+    def update_stock_cash(self, user_id, amount, tx_type="Nạp"):
+        """Nạp/Rút tiền vào tài khoản chứng khoán (Đồng bộ với module Main)"""
+        with db.writer() as conn:
+            return self._apply_cash(conn, user_id, amount, tx_type, datetime.datetime.now().strftime("%Y-%m-%d"))
+
     # --- BƯỚC 5, 6: QUẢN LÝ GIAO DỊCH CỔ PHIẾU (ORDER) ---
-    def execute_order(self, symbol, qty, price, order_type="Mua"):
-        """Xử lý lệnh Mua/Bán cổ phiếu"""
+    def _apply_order(self, conn, user_id, symbol, qty, price, order_type="Mua", date_str=None):
+        """Áp dụng 1 lệnh trong giao dịch ghi đang mở: kiểm tra -> lệnh -> danh mục -> tiền mặt -> sổ cái"""
         symbol = symbol.upper()
         total_value = qty * price
-        fee = total_value * 0.001  # Giả định phí giao dịch 0.1%
-        
-        cash = self.get_stock_cash()
-        if order_type == "Mua" and cash < (total_value + fee):
-            return False, f"❌ Không đủ tiền! Cần: {(total_value+fee):,.0f}đ"
-
-        with self._get_conn() as conn:
-            c = conn.cursor()
-            
-            # 1. Ghi lịch sử lệnh vào bảng stock_orders
-            date_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-            c.execute("""INSERT INTO stock_orders (symbol, type, qty, price, fee, date) 
-                         VALUES (?, ?, ?, ?, ?, ?)""", (symbol, order_type, qty, price, fee, date_str))
-
-            # 2. Cập nhật bảng stock_holdings (Danh mục đang nắm giữ)
-            c.execute("SELECT qty, total_cost FROM stock_holdings WHERE symbol=?", (symbol,))
-            row = c.fetchone()
-            
-            if order_type == "Mua":
-                new_qty = (row[0] if row else 0) + qty
-                new_cost = (row[1] if row else 0) + total_value + fee
-                avg_price = new_cost / new_qty
-                c.execute("INSERT OR REPLACE INTO stock_holdings VALUES (?, ?, ?, ?)", 
-                          (symbol, new_qty, avg_price, new_cost))
-                # Trừ tiền mặt trong tài khoản Stock
-                self.update_stock_cash(total_value + fee, "Rút")
-            
-            elif order_type == "Bán":
-                if not row or row[0] < qty:
-                    return False, f"❌ Không đủ cổ phiếu {symbol}!"
-                
-                new_qty = row[0] - qty
-                # Tính lãi lỗ cho lệnh bán này
-                profit = (price * qty) - (row[2] * qty) - fee # (Giá bán - Giá vốn) * SL - Phí
-                
-                if new_qty == 0:
-                    c.execute("DELETE FROM stock_holdings WHERE symbol=?", (symbol,))
-                else:
-                    # Giảm trừ giá vốn tương ứng số lượng còn lại
-                    new_cost = row[1] * (new_qty / row[0])
-                    c.execute("UPDATE stock_holdings SET qty=?, total_cost=? WHERE symbol=?", 
-                              (new_qty, new_cost, symbol))
-                
-                # Cộng tiền mặt vào tài khoản Stock sau khi bán
-                self.update_stock_cash(total_value - fee, "Nạp")
-
-            conn.commit()
+        fee = total_value * FEE_RATE
+        date_str = date_str or datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+
+        # Đọc số dư & vị thế trong cùng giao dịch BEGIN IMMEDIATE nên không bị lệnh khác chen giữa
+        res = conn.execute("SELECT current_value FROM assets WHERE user_id=? AND category='Stock'", (user_id,)).fetchone()
+        cash = res[0] if res else 0
+        row = conn.execute("SELECT qty, total_cost, avg_price FROM stock_holdings WHERE user_id=? AND symbol=?", (user_id, symbol)).fetchone()
+
+        if order_type == "Mua":
+            if cash < (total_value + fee):
+                raise OrderError(f"❌ Không đủ tiền! Cần: {(total_value+fee):,.0f}đ")
+            new_qty = (row[0] if row else 0) + qty
+            new_cost = (row[1] if row else 0) + total_value + fee
+            avg_price = new_cost / new_qty
+            conn.execute("INSERT OR REPLACE INTO stock_holdings (user_id, symbol, qty, avg_price, total_cost) VALUES (?, ?, ?, ?, ?)",
+                         (user_id, symbol, new_qty, avg_price, new_cost))
+            # Trừ tiền mặt trong tài khoản Stock
+            cash_amount, cash_type = total_value + fee, "Rút"
+
+        elif order_type == "Bán":
+            if not row or row[0] < qty:
+                raise OrderError(f"❌ Không đủ cổ phiếu {symbol}!")
+            new_qty = row[0] - qty
+            if new_qty == 0:
+                conn.execute("DELETE FROM stock_holdings WHERE user_id=? AND symbol=?", (user_id, symbol))
+            else:
+                # Giảm trừ giá vốn tương ứng số lượng còn lại
+                new_cost = row[1] * (new_qty / row[0])
+                conn.execute("UPDATE stock_holdings SET qty=?, total_cost=? WHERE user_id=? AND symbol=?",
+                             (new_qty, new_cost, user_id, symbol))
+            # Cộng tiền mặt vào tài khoản Stock sau khi bán
+            cash_amount, cash_type = total_value - fee, "Nạp"
+        else:
+            raise OrderError(f"❌ Loại lệnh không hợp lệ: {order_type}")
+
+        # Ghi lịch sử lệnh vào bảng stock_orders
+        order_id = conn.execute("""INSERT INTO stock_orders (user_id, symbol, type, qty, price, fee, date)
+                                   VALUES (?, ?, ?, ?, ?, ?, ?)""", (user_id, symbol, order_type, qty, price, fee, date_str)).lastrowid
+        self._apply_cash(conn, user_id, cash_amount, cash_type, date_str, note=f"{order_type} {qty:g} {symbol} @ {price:,.0f}")
+        return order_id
+
+    def execute_order(self, user_id, symbol, qty, price, order_type="Mua"):
+        """Xử lý lệnh Mua/Bán cổ phiếu trong đúng 1 giao dịch (1 kết nối, 1 lần commit)"""
+        try:
+            with db.writer() as conn:
+                self._apply_order(conn, user_id, symbol, qty, price, order_type)
+        except OrderError as e:
+            return False, str(e)
         return True, "Thành công"
 
+    def execute_orders(self, user_id, orders):
+        """Khớp cả lô lệnh trong 1 giao dịch: lỗi ở lệnh nào thì hủy toàn bộ lô.
+        orders: iterable các tuple (symbol, qty, price, order_type[, date])"""
+        count = 0
+        try:
+            with db.writer() as conn:
+                for count, order in enumerate(orders, 1):
+                    self._apply_order(conn, user_id, *order)
+        except OrderError as e:
+            return False, f"Lệnh #{count}: {e}"
+        return True, f"Thành công {count} lệnh"
+
     # --- BƯỚC 4, 9: PHÂN TÍCH HIỆU SUẤT ---
-    def get_portfolio_summary(self):
-        """Lấy dữ liệu để hiển thị Dashboard (Bước 2) và Phân tích (Bước 9)"""
-        with self._get_conn() as conn:
-            df_holdings = pd.read_sql_query("SELECT * FROM stock_holdings", conn)
-            df_orders = pd.read_sql_query("SELECT * FROM stock_orders", conn)
-        
-        cash = self.get_stock_cash()
-        stock_value = df_holdings['total_cost'].sum() # Tạm thời lấy theo giá vốn
+    def get_portfolio_summary(self, user_id, prices=None):
+        """Lấy dữ liệu để hiển thị Dashboard (Bước 2) và Phân tích (Bước 9).
+        prices: {symbol: giá thị trường}; mã không có giá thì định giá theo giá vốn"""
+        with db.reader() as conn:
+            holdings = [dict(zip(('symbol', 'qty', 'avg_price', 'total_cost'), r)) for r in
+                        conn.execute("SELECT symbol, qty, avg_price, total_cost FROM stock_holdings WHERE user_id=?", (user_id,))]
+            res = conn.execute("SELECT current_value FROM assets WHERE user_id=? AND category='Stock'", (user_id,)).fetchone()
+            m = analytics.metrics(user_id, conn)
+
+        cash = res[0] if res else 0
+        prices = prices or {}
+        for h in holdings:
+            price = prices.get(h['symbol'])
+            h['market_price'] = price
+            h['market_value'] = h['qty'] * price if price is not None else (h['total_cost'] or 0)
+            h['unrealized_pnl'] = h['market_value'] - (h['total_cost'] or 0)
+        stock_value = sum(h['market_value'] for h in holdings)
         nav = cash + stock_value
-        
-        # Tính toán các chỉ số nâng cao cho Demo Bước 9
-        win_rate = 0
-        if not df_orders.empty:
-            sell_orders = df_orders[df_orders['type'] == 'Bán']
-            # Logic win-rate có thể phức tạp hơn, đây là bản đơn giản
-            win_rate = 100 if len(sell_orders) > 0 else 0 
+        pf = m['profit_factor']
 
         return {
             "cash": cash,
             "stock_value": stock_value,
             "nav": nav,
-            "holdings": df_holdings.to_dict('records'),
+            "holdings": holdings,
             "metrics": {
-                "win_rate": f"{win_rate}%",
-                "drawdown": "-1.5%", # Giả lập dữ liệu
-                "profit_factor": "2.0"
+                "win_rate": f"{m['win_rate']:.1f}%",
+                "drawdown": f"-{m['max_drawdown_pct']:.1f}%",
+                "profit_factor": "∞" if pf == float('inf') else (f"{pf:.2f}" if pf is not None else "N/A"),
+                "realized_pnl": m['realized_pnl'],
+                "trades": m['trades'],
+                "exposure": f"{(stock_value / nav * 100) if nav else 0:.1f}%",
             }
         }
 
+    async def get_live_summary(self, user_id):
+        """Như get_portfolio_summary nhưng định giá theo thị trường (1 lần lấy giá cho mọi mã đang giữ)"""
+        rows = await db.fetchall("SELECT symbol FROM stock_holdings WHERE user_id=?", (user_id,))
+        prices = await quote_service.get_prices([r[0] for r in rows]) if rows else {}
+        return await asyncio.to_thread(self.get_portfolio_summary, user_id, prices)
+
 stock_manager = StockManager()
\ No newline at end of file
@@ -0,0 +1,37 @@
+import os
+import sys
+import tempfile
+import itertools
+import pytest
+
+# Cấu hình phải có trước khi import các module của bot (đọc biến môi trường lúc import)
+os.environ.setdefault("DB_FILE", os.path.join(tempfile.mkdtemp(prefix="bot-test-"), "portfolio.db"))
+os.environ["AI_CACHE_DB"] = ""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.stubs import StubServer
+
+
+@pytest.fixture
+def stub():
+    """Gemini + Telegram Bot API giả lập trên cổng ngẫu nhiên"""
+    server = StubServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope='session')
+def database():
+    """DB tạm dùng chung cả phiên kiểm thử, đã nâng cấp schema; mỗi test dùng user_id riêng qua fixture `uid`"""
+    from schema import init_db
+    from db import db
+    init_db()
+    return db
+
+
+_uids = itertools.count(1000)
+
+
+@pytest.fixture
+def uid(database):
+    return next(_uids)
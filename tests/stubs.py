@@ -0,0 +1,147 @@
+"""Máy chủ giả lập cho kiểm thử và chạy thử offline: Gemini (SSE streamGenerateContent) + Telegram Bot API.
+
+    python -m tests.stubs 8081     # rồi chạy bot với GEMINI_BASE_URL=http://127.0.0.1:8081/v1beta
+                                   # và TELEGRAM_API_URL=http://127.0.0.1:8081
+
+Hành vi từng model Gemini đặt qua `server.models[tên] = kịch bản`:
+    ('ok', [đoạn, ...])           trả từng đoạn theo SSE rồi kết thúc bình thường
+    ('status', 503)               trả mã lỗi HTTP ngay
+    ('cut', [đoạn, ...])          trả các đoạn rồi đóng kết nối giữa chừng (thân chunked chưa kết thúc)
+    ('slow', giây, [đoạn, ...])   chờ `giây` trước token đầu tiên
+Lỗi Telegram đặt qua `server.tg_failures[chat_id] = [(mã HTTP, retry_after), ...]`, mỗi lần gửi lấy ra 1 lỗi."""
+import sys
+import json
+import asyncio
+import time
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from quotes import QuoteProvider
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.models = {}
+        self.gemini_calls = []
+        self.tg_calls = []
+        self.tg_failures = {}
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown(); self.server_close()
+
+    def tg(self, method):
+        """Các lần gọi Telegram theo tên method, theo thứ tự nhận"""
+        return [params for m, params in self.tg_calls if m == method]
+
+    def next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+
+class StubProvider(QuoteProvider):
+    """Nguồn giá giả lập cho QuoteService: đếm số lần gọi, có thể chậm hoặc lỗi"""
+
+    def __init__(self, prices, delay=0.0):
+        self.prices, self.delay, self.calls, self.fail, self.closed = dict(prices), delay, [], False, False
+
+    async def fetch(self, symbols):
+        self.calls.append(list(symbols))
+        await asyncio.sleep(self.delay)
+        if self.fail: raise RuntimeError("nguồn giá lỗi")
+        return {s: self.prices[s] for s in symbols if s in self.prices}
+
+    async def aclose(self):
+        self.closed = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json"); self.send_header("Content-Length", str(len(body)))
+        self.end_headers(); self.wfile.write(body)
+
+    def _chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n"); self.wfile.flush()
+
+    def _params(self):
+        raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if 'json' in (self.headers.get("Content-Type") or ''): return json.loads(raw or b'{}')
+        return {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+
+    def do_GET(self):
+        if urlparse(self.path).path.endswith("/models"):
+            models = [{'name': f"models/{m}", 'supportedGenerationMethods': ['generateContent']} for m in self.server.models]
+            return self._json(200, {'models': models})
+        self._json(404, {})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path.startswith("/bot"): return self._telegram(path.rsplit("/", 1)[-1], self._params())
+        if path.endswith(":streamGenerateContent"): return self._gemini(path.rsplit("/", 1)[-1].split(":")[0], self._params())
+        self._json(404, {})
+
+    # --- GEMINI ---
+    def _gemini(self, model, params):
+        self.server.gemini_calls.append((model, params))
+        script = self.server.models.get(model, ('status', 404))
+        if script[0] == 'status': return self._json(script[1], {'error': {'code': script[1]}})
+        if script[0] == 'slow': time.sleep(script[1])
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream"); self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for text in script[-1]:
+                event = {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}}]}
+                self._chunk(f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n".encode())
+            if script[0] == 'cut':
+                # Đóng socket khi thân chunked chưa có khối kết thúc: phía client thấy lỗi giao thức giữa luồng
+                self.close_connection = True; return
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    # --- TELEGRAM ---
+    def _telegram(self, method, params):
+        self.server.tg_calls.append((method, params))
+        if method == 'getMe':
+            return self._json(200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'stub', 'username': 'stub_bot'}})
+        if method in ('deleteMessage', 'sendChatAction', 'setWebhook', 'deleteWebhook'): return self._json(200, {'ok': True, 'result': True})
+        chat_id = int(params.get('chat_id', 0))
+        failures = self.server.tg_failures.get(chat_id)
+        if method == 'sendMessage' and failures:
+            status, retry_after = failures.pop(0)
+            if status == 429:
+                return self._json(429, {'ok': False, 'error_code': 429, 'description': f"Too Many Requests: retry after {retry_after}",
+                                        'parameters': {'retry_after': retry_after}})
+            return self._json(status, {'ok': False, 'error_code': status, 'description': "Forbidden: bot was blocked by the user"})
+        message_id = int(params['message_id']) if method == 'editMessageText' else self.server.next_message_id()
+        return self._json(200, {'ok': True, 'result': {'message_id': message_id, 'date': int(time.time()),
+                                                       'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}})
+
+
+if __name__ == '__main__':
+    # python -m tests.stubs [port]: mọi model trả lời 1 câu cố định
+    server = StubServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8081)
+    server.models = {'gemini-1.5-flash': ('ok', ["Xin chào, ", "đây là câu trả lời giả lập."])}
+    print(f"Stub Gemini + Telegram tại {server.url}")
+    server.serve_forever()
@@ -0,0 +1,78 @@
+import time
+import asyncio
+import pytest
+from telegram import Bot
+import main as bot_main
+import ai_assistant
+from ai_cache import AdviceCache
+
+
+@pytest.fixture
+def ai(stub, monkeypatch):
+    monkeypatch.setattr(ai_assistant, 'GEMINI_BASE_URL', f"{stub.url}/v1beta")
+    monkeypatch.setattr(bot_main, 'AI_EDIT_INTERVAL', 0.0)
+    engine = ai_assistant.PortfolioAI()
+    engine.api_key, engine.cache = 'test-key', AdviceCache(path='')
+    return engine
+
+
+def ask(stub, ai, question='nên làm gì', uid=1):
+    """Gửi tin chờ qua Telegram giả lập rồi stream câu trả lời vào đó; trả về nội dung sửa cuối cùng"""
+    async def go():
+        async with Bot('1:TEST', base_url=f"{stub.url}/bot") as bot:
+            placeholder = await bot.send_message(uid, "⌛")
+            try: await bot_main.stream_to_message(placeholder, ai.stream_advice(question, 'dữ liệu', uid))
+            finally: await ai.aclose()
+    asyncio.run(go())
+    return stub.tg('editMessageText')[-1]['text']
+
+
+def test_stream_edits_placeholder_until_full_reply(stub, ai):
+    stub.models = {'a-flash': ('ok', ["Giảm ", "tỷ trọng ", "crypto."])}
+    assert ask(stub, ai) == "Giảm tỷ trọng crypto."
+    # Các lần sửa tạm có con trỏ ▌, bản cuối thì không
+    assert all(e['text'].endswith(" ▌") for e in stub.tg('editMessageText')[:-1])
+
+
+def test_falls_back_to_next_model_before_first_token(stub, ai):
+    stub.models = {'a-flash': ('status', 503), 'b-flash': ('ok', ["từ model 2"])}
+    assert ask(stub, ai) == "từ model 2"
+    assert [m for m, _ in stub.gemini_calls] == ['a-flash', 'b-flash']
+
+
+def test_cut_stream_is_flagged_and_not_cached(stub, ai):
+    stub.models = {'a-flash': ('cut', ["Một nửa câu"])}
+    text = ask(stub, ai)
+    assert text == "Một nửa câu" + ai_assistant.STREAM_CUT_SUFFIX
+    assert ai.cache.get_sync(ai.cache.make_key('nên làm gì', 'dữ liệu')) is None
+    assert ai.get_history(1) == []
+
+
+def test_deadline_bounds_total_wait(stub, ai, monkeypatch):
+    monkeypatch.setattr(ai_assistant, 'AI_DEADLINE', 0.5)
+    stub.models = {'a-flash': ('slow', 3, ["quá muộn"])}
+    t = time.monotonic()
+    assert ask(stub, ai) == ai_assistant.BUSY_REPLY
+    assert time.monotonic() - t < 2.5
+
+
+def test_hedge_takes_first_model_to_answer(stub, ai, monkeypatch):
+    monkeypatch.setattr(ai_assistant, 'AI_HEDGE', True)
+    monkeypatch.setattr(ai_assistant, 'AI_HEDGE_DELAY', 0.2)
+    stub.models = {'a-flash': ('slow', 3, ["chậm"]), 'b-flash': ('ok', ["nhanh"])}
+    t = time.monotonic()
+    assert ask(stub, ai) == "nhanh"
+    assert time.monotonic() - t < 2.5
+
+
+def test_cache_only_serves_opening_questions(stub, ai):
+    stub.models = {'a-flash': ('ok', ["trả lời"])}
+    ask(stub, ai, uid=1)
+    ask(stub, ai, uid=2)        # câu mở đầu giống hệt, cùng dữ liệu: lấy từ cache
+    assert len(stub.gemini_calls) == 1
+    ask(stub, ai, uid=1)        # đã có lịch sử hội thoại: câu trả lời phụ thuộc các lượt trước, luôn hỏi model
+    ask(stub, ai, uid=1)
+    assert len(stub.gemini_calls) == 3
+    ai.clear_history(1)
+    ask(stub, ai, uid=1)        # hội thoại mới: lại lấy từ cache
+    assert len(stub.gemini_calls) == 3
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from analytics import compute_trade_metrics, summarize
+
+
+def loop_pnl(orders):
+    """Bản tham chiếu viết bằng vòng lặp: giá vốn bình quân như rebuild_holdings / StockManager._apply_order"""
+    pos, out = {}, []
+    for oid, symbol, is_buy, qty, price, fee in sorted(orders, key=lambda o: (o[1], o[0])):
+        q, cost = pos.get(symbol, (0.0, 0.0))
+        if is_buy:
+            pos[symbol] = (q + qty, cost + qty * price + fee)
+        elif q > 1e-9:
+            out.append((oid, qty * price - fee - cost / q * qty))
+            left = max(0.0, q - qty); pos[symbol] = (left, cost * left / q)
+    return out
+
+
+def vectorized(orders):
+    orders = sorted(orders, key=lambda o: (o[1], o[0]))
+    ids, symbols, is_buy, qty, price, fee = (np.array(c) for c in zip(*orders))
+    return compute_trade_metrics(ids.astype(np.int64), symbols, is_buy.astype(bool), qty.astype(float), price.astype(float), fee.astype(float))
+
+
+def random_orders(rng, n, symbols=('FPT', 'VNM', 'HPG')):
+    """Lệnh ngẫu nhiên không bán quá số đang nắm, có cả lệnh bán sạch vị thế rồi mua lại"""
+    held, orders = dict.fromkeys(symbols, 0.0), []
+    for oid in range(1, n + 1):
+        s = symbols[rng.integers(len(symbols))]
+        if held[s] > 0 and rng.random() < 0.45:
+            qty = held[s] if rng.random() < 0.25 else float(rng.integers(1, int(held[s]) + 1))
+            held[s] -= qty; orders.append((oid, s, False, qty, float(rng.integers(5, 200)) * 1000, float(rng.integers(0, 50))))
+        else:
+            qty = float(rng.integers(1, 500))
+            held[s] += qty; orders.append((oid, s, True, qty, float(rng.integers(5, 200)) * 1000, float(rng.integers(0, 50))))
+    return orders
+
+
+def test_simple_average_cost():
+    # Mua 100 @10 + 100 @20 (phí 0) -> giá vốn 15; bán 50 @30 phí 5 -> lãi 50*15 - 5
+    sell_ids, pnl = vectorized([(1, 'FPT', True, 100, 10, 0), (2, 'FPT', True, 100, 20, 0), (3, 'FPT', False, 50, 30, 5)])
+    assert sell_ids.tolist() == [3]
+    assert pnl == pytest.approx([745.0])
+
+
+def test_position_closed_then_reopened_resets_cost():
+    orders = [(1, 'A', True, 10, 100, 0), (2, 'A', False, 10, 150, 0), (3, 'A', True, 10, 300, 0), (4, 'A', False, 5, 310, 0)]
+    _, pnl = vectorized(orders)
+    assert pnl == pytest.approx([500.0, 50.0])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_loop_on_random_orders(seed):
+    orders = random_orders(np.random.default_rng(seed), 400)
+    expected = loop_pnl(orders)
+    sell_ids, pnl = vectorized(orders)
+    assert sell_ids.tolist() == [oid for oid, _ in expected]
+    assert pnl == pytest.approx([p for _, p in expected], rel=1e-9, abs=1e-6)
+
+
+def test_summarize():
+    # Chuỗi lãi/lỗ theo thứ tự lệnh: +100, -300, +50 -> đỉnh 100, đáy -200
+    r = summarize(np.array([3, 1, 2]), np.array([50.0, 100.0, -300.0]), 1000.0)
+    assert r['trades'] == 3 and r['realized_pnl'] == pytest.approx(-150.0)
+    assert r['win_rate'] == pytest.approx(200 / 3)
+    assert r['profit_factor'] == pytest.approx(0.5)
+    assert r['max_drawdown'] == pytest.approx(300.0) and r['max_drawdown_pct'] == pytest.approx(30.0)
+    assert summarize(np.empty(0), np.empty(0), 0)['profit_factor'] is None
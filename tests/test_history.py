@@ -0,0 +1,57 @@
+import asyncio
+import main as bot_main
+
+
+def add_transactions(db, uid, n):
+    """n giao dịch, ngày tăng dần theo id; trả về id theo thứ tự mới nhất trước"""
+    with db.writer() as c:
+        c.executemany("INSERT INTO transactions (user_id, category, type, amount, date, note) VALUES (?, 'Cash', 'Nạp', ?, ?, '')",
+                      [(uid, 1000 * (i + 1), f"2024-01-{i + 1:02d}") for i in range(n)])
+        return [r[0] for r in c.execute("SELECT id FROM transactions WHERE user_id = ? ORDER BY date DESC, id DESC", (uid,))]
+
+
+def open_page(uid, token=None):
+    """Mở 1 trang lịch sử; trả về (tiêu đề, id các giao dịch, {nút điều hướng: token})"""
+    msg, mk = asyncio.run(bot_main.get_history_menu(uid, token))
+    rows = [b for row in mk.inline_keyboard for b in row]
+    ids = [int(b.callback_data.split('_')[1]) for b in rows if b.callback_data.startswith('hist_')]
+    nav = {b.text: b.callback_data[len('view_page_'):] for b in rows if b.callback_data.startswith('view_page_')}
+    return msg, ids, nav
+
+
+def test_forward_and_back(database, uid):
+    ids = add_transactions(database, uid, 25)
+    msg, page, nav = open_page(uid)
+    assert page == ids[:10]
+    msg, page, nav = open_page(uid, nav["📄 Xem full lịch sử"])
+    assert "Trang 1" in msg and page == ids[:10] and list(nav) == ["Sau ➡️"]
+    msg, page, nav = open_page(uid, nav["Sau ➡️"])
+    assert "Trang 2" in msg and page == ids[10:20]
+    msg, page, nav = open_page(uid, nav["Sau ➡️"])
+    # Trang cuối: 5 dòng còn lại, không có nút Sau
+    assert "Trang 3" in msg and page == ids[20:] and list(nav) == ["⬅️ Trước"]
+    msg, page, nav = open_page(uid, nav["⬅️ Trước"])
+    assert "Trang 2" in msg and page == ids[10:20]
+    msg, page, nav = open_page(uid, nav["⬅️ Trước"])
+    assert "Trang 1" in msg and page == ids[:10]
+
+
+def test_exact_page_boundary_has_no_next(database, uid):
+    ids = add_transactions(database, uid, 20)
+    _, _, nav = open_page(uid, "0")
+    msg, page, nav = open_page(uid, nav["Sau ➡️"])
+    assert page == ids[10:] and "Sau ➡️" not in nav
+
+
+def test_back_falls_back_to_first_page_when_newer_rows_were_deleted(database, uid):
+    ids = add_transactions(database, uid, 25)
+    _, _, nav = open_page(uid, "0")
+    _, _, nav = open_page(uid, nav["Sau ➡️"])
+    third = nav["Sau ➡️"]
+    # Xóa bớt dòng mới: trước trang 3 chỉ còn 5 dòng, không đủ 1 trang để làm con trỏ lùi
+    with database.writer() as c:
+        c.executemany("DELETE FROM transactions WHERE id = ?", [(i,) for i in ids[:15]])
+    msg, page, nav = open_page(uid, third)
+    assert page == ids[20:] and nav["⬅️ Trước"] == "0"
+    msg, page, _ = open_page(uid, nav["⬅️ Trước"])
+    assert "Trang 1" in msg and page == ids[15:25]
@@ -0,0 +1,57 @@
+import pytest
+import importer
+
+
+def write_csv(tmp_path, lines, name='sao_ke.csv'):
+    path = tmp_path / name
+    path.write_text("\n".join(lines) + "\n", encoding='utf-8')
+    return str(path)
+
+
+def rows(database, sql, uid):
+    with database.reader() as conn: return conn.execute(sql, (uid,)).fetchall()
+
+
+def test_unsorted_duplicates_across_chunks_are_kept(tmp_path, uid, database, monkeypatch):
+    monkeypatch.setattr(importer, 'IMPORT_CHUNK_ROWS', 2)
+    # Sao kê không xếp theo ngày; 2 khoản nạp giống hệt nhau ngày 01/01 rơi vào 2 khối khác nhau
+    path = write_csv(tmp_path, ["Ngày,Danh mục,Loại,Số tiền,Ghi chú",
+                                "01/01/2024,Cash,Nạp,1.000.000,lương",
+                                "05/01/2024,Cash,Rút,200.000,ăn",
+                                "03/01/2024,Cash,Nạp,50.000,",
+                                "01/01/2024,Cash,Nạp,1.000.000,lương",
+                                "02/01/2024,Cash,Nạp,,lỗi"])
+    r = importer.import_statement(path, 'sao_ke.csv', uid)
+    assert (r['inserted'], r['duplicates'], r['errors']) == (4, 0, 1)
+    assert rows(database, "SELECT COUNT(*) FROM transactions WHERE user_id = ? AND date = '2024-01-01'", uid) == [(2,)]
+    # Tải lại cùng file: không thêm gì
+    r = importer.import_statement(path, 'sao_ke.csv', uid)
+    assert (r['inserted'], r['duplicates']) == (0, 4)
+
+
+def test_orders_rebuild_holdings(tmp_path, uid, database, monkeypatch):
+    monkeypatch.setattr(importer, 'IMPORT_CHUNK_ROWS', 1)
+    path = write_csv(tmp_path, ["Ngày,Mã,Lệnh,Số lượng,Giá,Phí",
+                                "02/01/2024,FPT,Bán,50,120000,0",
+                                "01/01/2024,FPT,Mua,100,100000,0",
+                                "01/01/2024,FPT,Mua,100,100000,0"])
+    r = importer.import_statement(path, 'lenh.csv', uid)
+    assert (r['kind'], r['inserted']) == ('orders', 3)
+    assert rows(database, "SELECT symbol, qty, avg_price FROM stock_holdings WHERE user_id = ?", uid) == [('FPT', 150.0, 100000.0)]
+
+
+def test_failure_midway_keeps_holdings_in_step(tmp_path, uid, database, monkeypatch):
+    monkeypatch.setattr(importer, 'IMPORT_CHUNK_ROWS', 1)
+    path = write_csv(tmp_path, ["Ngày,Mã,Lệnh,Số lượng,Giá", "01/01/2024,VNM,Mua,10,70000", "02/01/2024,VNM,Mua,10,80000"])
+    calls = []
+    real = importer.content_hash
+
+    def failing_hash(kind, values, occurrence):
+        calls.append(values)
+        if len(calls) == 2: raise RuntimeError("mất kết nối")
+        return real(kind, values, occurrence)
+    monkeypatch.setattr(importer, 'content_hash', failing_hash)
+    with pytest.raises(RuntimeError):
+        importer.import_statement(path, 'lenh.csv', uid)
+    # Khối đầu đã ghi thì stock_holdings cũng đã khớp với nó
+    assert rows(database, "SELECT symbol, qty FROM stock_holdings WHERE user_id = ?", uid) == [('VNM', 10.0)]
@@ -0,0 +1,46 @@
+import time
+import asyncio
+from telegram import Bot
+from notifier import Notifier
+
+
+def run(stub, messages, timeout=10, **kwargs):
+    """Xếp các tin (chat_id, text) vào Notifier gửi tới Telegram giả lập, chờ gửi hết; trả về thời gian chạy"""
+    async def go():
+        async with Bot('1:TEST', base_url=f"{stub.url}/bot") as bot:
+            notifier = Notifier(**kwargs)
+            notifier.start(bot)
+            t = time.monotonic()
+            for chat, text in messages: notifier.enqueue(chat, text)
+            async with asyncio.timeout(timeout):
+                while len(notifier) or notifier._inflight: await asyncio.sleep(0.02)
+            await notifier.stop()
+            return time.monotonic() - t
+    return asyncio.run(go())
+
+
+def sent(stub, chat):
+    return [p['text'] for p in stub.tg('sendMessage') if int(p['chat_id']) == chat]
+
+
+def test_per_chat_order_and_spacing(stub):
+    elapsed = run(stub, [(10, 'a'), (20, 'x'), (10, 'b'), (10, 'c')], chat_interval=0.2)
+    assert sent(stub, 10) == ['a', 'b', 'c']
+    assert sent(stub, 20) == ['x']
+    # 3 tin cùng chat cách nhau ít nhất chat_interval
+    assert elapsed >= 0.4
+
+
+def test_retry_after_pauses_and_resends(stub):
+    stub.tg_failures[20] = [(429, 1)]
+    elapsed = run(stub, [(20, 'cảnh báo'), (30, 'khác')])
+    assert sent(stub, 20) == ['cảnh báo', 'cảnh báo']
+    assert sent(stub, 30) == ['khác']
+    assert elapsed >= 1.0
+
+
+def test_blocked_chat_is_dropped_without_retry(stub):
+    stub.tg_failures[40] = [(403, 0)]
+    run(stub, [(40, 'bị chặn'), (50, 'vẫn gửi')])
+    assert sent(stub, 40) == ['bị chặn']
+    assert sent(stub, 50) == ['vẫn gửi']
@@ -0,0 +1,87 @@
+import datetime
+import numpy as np
+import pytest
+from performance import solve_xirr, modified_dietz_twr, PerformanceEngine, _days
+
+
+def xirr_rows(*flows):
+    """Ma trận (amounts, years) cho solve_xirr, mỗi đối số là 1 danh sách (ngày ISO, số tiền); hàng ngắn được đệm 0"""
+    width = max(len(f) for f in flows)
+    amounts, years = np.zeros((len(flows), width)), np.zeros((len(flows), width))
+    for i, f in enumerate(flows):
+        days = _days([d for d, _ in f])
+        amounts[i, :len(f)] = [a for _, a in f]
+        years[i, :len(f)] = (days - days[0]) / 365.0
+    return amounts, years
+
+
+EXCEL_EXAMPLE = [('2008-01-01', -10000), ('2008-03-01', 2750), ('2008-10-30', 4250), ('2009-02-15', 3250), ('2009-04-01', 2750)]
+
+
+def test_xirr_known_values():
+    rates = solve_xirr(*xirr_rows(EXCEL_EXAMPLE, [('2021-01-01', -1000), ('2022-01-01', 1100)], [('2021-01-01', -1000), ('2022-01-01', 500)]))
+    # Ví dụ trong tài liệu hàm XIRR của Excel: 37.34%; 1 năm (365 ngày) lãi 10%; 1 năm lỗ 50%
+    assert rates == pytest.approx([0.373362535, 0.1, -0.5], abs=1e-8)
+
+
+def test_xirr_batch_matches_single_rows():
+    rng = np.random.default_rng(7)
+    flows = []
+    for _ in range(20):
+        days = np.sort(rng.choice(np.arange(1500), size=rng.integers(2, 12), replace=False))
+        amounts = list(-rng.integers(1, 100, size=len(days)) * 1000.0)
+        amounts[-1] = -sum(amounts[:-1]) * rng.uniform(0.3, 3.0)
+        flows.append([(str(np.datetime64('2015-01-01') + int(d)), a) for d, a in zip(days, amounts)])
+    batch = solve_xirr(*xirr_rows(*flows))
+    single = [solve_xirr(*xirr_rows(f))[0] for f in flows]
+    assert batch == pytest.approx(single, abs=1e-9)
+    # Nghiệm thật sự là không điểm của NPV
+    amounts, years = xirr_rows(*flows)
+    npv = (amounts * (1.0 + batch[:, None]) ** -years).sum(axis=1)
+    assert (np.abs(npv) < 1e-6 * np.abs(amounts).sum(axis=1)).all()
+
+
+def test_xirr_without_sign_change_has_no_solution():
+    rates = solve_xirr(*xirr_rows([('2020-01-01', -100), ('2020-06-01', -50)], [('2020-01-01', 100), ('2021-01-01', 50)],
+                                  [('2020-01-01', -100), ('2020-01-01', 100)]))
+    # Hàng cuối: nạp và định giá cùng ngày, NPV bằng 0 với mọi lãi suất
+    assert np.isnan(rates).all()
+
+
+def test_modified_dietz():
+    point_days, flow_days = np.array([0, 10, 20]), np.array([5, 15])
+    # Đoạn 1 không có dòng tiền: 100 -> 120 (+20%); đoạn 2 nạp 50 giữa kỳ: (160 - 120 - 50) / (120 + 0.5 * 50)
+    twr = modified_dietz_twr(point_days, np.array([100.0, 120.0, 160.0]), flow_days[1:], np.array([50.0]))
+    assert twr == pytest.approx(1.2 * (1 + (160 - 120 - 50) / (120 + 25)) - 1)
+    # Dòng tiền nằm ngoài các lần định giá bị bỏ qua; chỉ 1 lần định giá thì không có TWR
+    assert modified_dietz_twr(np.array([0, 10]), np.array([100.0, 110.0]), np.array([-3, 30]), np.array([1e6, 1e6])) == pytest.approx(0.1)
+    assert modified_dietz_twr(np.array([0]), np.array([100.0]), np.empty(0, np.int64), np.empty(0)) is None
+
+
+def ledger(flows, values=()):
+    """Đầu vào của PerformanceEngine._compute từ danh sách (ngày, danh mục, số tiền)"""
+    def columns(rows):
+        if not rows: return np.empty(0, np.int64), np.empty(0, dtype=object), np.empty(0)
+        d, c, a = zip(*rows)
+        return _days(d), np.array(c, dtype=object), np.array(a, dtype=float)
+    return columns(list(flows)), columns(list(values))
+
+
+def test_single_flow_on_same_day_has_no_rates():
+    today = datetime.date.today().isoformat()
+    flows, values = ledger([(today, 'Cash', 1000.0)])
+    r = PerformanceEngine()._compute(flows, values, {'Cash': 1000.0, '*': 1000.0}, None, today, today)
+    assert r['Cash']['xirr'] is None and r['*']['xirr'] is None
+    assert r['Cash']['net_flow'] == 1000.0
+
+
+def test_compute_one_year_deposit():
+    today = datetime.date.today()
+    start = (today - datetime.timedelta(days=365)).isoformat()
+    flows, values = ledger([(start, 'Stock', 1000.0)])
+    r = PerformanceEngine()._compute(flows, values, {'Stock': 1100.0, '*': 1100.0}, None, today.isoformat(), today.isoformat())
+    assert r['Stock']['xirr'] == pytest.approx(0.1, abs=1e-8)
+    # Điểm mở đầu đặt ngay trước lần nạp (giá trị 0) nên kỳ dài 366 ngày và tiền nạp có trọng số 365/366
+    assert r['Stock']['twr'] == pytest.approx(100 / (1000 * 365 / 366))
+    assert r['*']['xirr'] == pytest.approx(r['Stock']['xirr'])
+    assert r['Crypto']['xirr'] is None and r['Crypto']['twr'] is None
@@ -0,0 +1,79 @@
+import random
+import asyncio
+import pytest
+import price_alerts as pa
+from quotes import QuoteService
+from tests.stubs import StubProvider
+
+
+def engine_with(*rules):
+    """Sổ ngưỡng trong RAM (không qua DB) từ các (mã, op, giá)"""
+    engine = pa.PriceAlertEngine()
+    for aid, (symbol, op, value) in enumerate(rules, 1):
+        engine._alerts[aid] = {'user_id': 1, 'symbol': symbol, 'kind': 'price', 'op': op, 'value': value, 'fired': False, 'avg': None, 'pos': None}
+        engine._index(aid)
+    return engine
+
+
+def test_books_stay_sorted_and_only_crossed_thresholds_fire():
+    rng = random.Random(3)
+    values = [float(rng.randint(50, 150) * 1000) for _ in range(200)]
+    engine = engine_with(*[('FPT', rng.choice('<>'), v) for v in values])
+    down, up = engine._books['FPT']
+    assert down == sorted(down) and up == sorted(up) and len(down) + len(up) == 200
+    events = engine.check({'FPT': 100_000.0, 'VNM': 1.0})
+    expected = {aid for aid, a in engine._alerts.items() if (a['op'] == '<' and a['value'] >= 100_000) or (a['op'] == '>' and a['value'] <= 100_000)}
+    assert {aid for aid, fired, _ in events} == expected and all(fired for _, fired, _ in events)
+    # Sau khi cắt, sổ vẫn sắp xếp và các cảnh báo vừa báo đã sang danh sách ngược lại
+    assert down == sorted(down) and up == sorted(up)
+    assert engine.check({'FPT': 100_000.0}) == []
+
+
+def test_crossings_in_both_directions_with_rearm():
+    engine = engine_with(('FPT', '<', 90_000.0), ('FPT', '>', 110_000.0))
+    assert engine.check({'FPT': 95_000.0}) == []
+    assert engine.check({'FPT': 89_000.0}) == [(1, True, 89_000.0)]
+    assert engine.check({'FPT': 85_000.0}) == []
+    # Chưa vượt ngưỡng kích hoạt lại (90,000 + 1%) thì vẫn im lặng
+    assert engine.check({'FPT': 90_500.0}) == []
+    assert engine.check({'FPT': 112_000.0}) == [(1, False, 112_000.0), (2, True, 112_000.0)]
+    assert engine.check({'FPT': 88_000.0}) == [(1, True, 88_000.0), (2, False, 88_000.0)]
+
+
+def test_price_equal_to_threshold_triggers():
+    engine = engine_with(('FPT', '<', 90_000.0), ('FPT', '>', 110_000.0))
+    assert engine.check({'FPT': 90_000.0}) == [(1, True, 90_000.0)]
+    assert engine.check({'FPT': 90_900.0}) == [(1, False, 90_900.0)]
+    assert engine.check({'FPT': 110_000.0}) == [(2, True, 110_000.0)]
+    assert engine.check({'FPT': 108_900.0}) == [(2, False, 108_900.0)]
+
+
+class Outbox:
+    def __init__(self):
+        self.sent = []
+
+    def enqueue(self, chat, text):
+        self.sent.append((chat, text)); return True
+
+
+def test_alert_removed_while_saving_still_notifies(uid, monkeypatch):
+    engine, outbox = pa.PriceAlertEngine(), Outbox()
+    monkeypatch.setattr(pa, 'quote_service', QuoteService(StubProvider({'PAX': 80_000.0}), ttl=0))
+    monkeypatch.setattr(pa, 'notifier', outbox)
+    write, calls = pa.db.write, []
+
+    async def write_then_remove(fn, *args):
+        # Lần ghi thứ 2 là của poll: /xoacanhbao chen vào đúng lúc poll đang chờ ghi trạng thái fired
+        calls.append(fn); result = await write(fn, *args)
+        if len(calls) == 2: await engine.remove(uid, 'PAX')
+        return result
+    monkeypatch.setattr(pa.db, 'write', write_then_remove)
+
+    async def go():
+        await engine.add(uid, 'PAX', 'price', '<', 90_000.0)
+        return await engine.poll()
+    assert asyncio.run(go()) == 1
+    assert outbox.sent == [(uid, "🔔 PAX: giá 80,000 đã xuống dưới ngưỡng 90,000.")]
+    assert not engine._alerts and engine._books['PAX'] == ([], [])
+    with pa.db.reader() as c:
+        assert c.execute("SELECT COUNT(*) FROM price_alerts WHERE user_id = ?", (uid,)).fetchone()[0] == 0
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import pytest
+import main as bot_main
+import stock_manager as sm
+from quotes import QuoteService, FileQuoteProvider
+from tests.stubs import StubProvider
+
+
+def test_concurrent_requests_share_one_fetch():
+    provider = StubProvider({'FPT': 95000.0, 'VNM': 70000.0}, delay=0.1)
+    service = QuoteService(provider, ttl=60)
+
+    async def go():
+        return await asyncio.gather(service.get_prices(['fpt', 'VNM']), service.get_prices(['VNM']), service.get_prices(['FPT']))
+    a, b, c = asyncio.run(go())
+    assert a == {'FPT': 95000.0, 'VNM': 70000.0} and b == {'VNM': 70000.0} and c == {'FPT': 95000.0}
+    assert provider.calls == [['FPT', 'VNM']]
+
+
+def test_ttl_cache_and_last_known_price_on_error():
+    provider = StubProvider({'FPT': 95000.0})
+    service = QuoteService(provider, ttl=60)
+    asyncio.run(service.get_prices(['FPT']))
+    asyncio.run(service.get_prices(['FPT']))
+    assert len(provider.calls) == 1
+    # Hết hạn cache mà nguồn lỗi: vẫn trả giá cuối cùng đã biết
+    service.ttl, provider.fail = 0, True
+    assert asyncio.run(service.get_prices(['FPT'])) == {'FPT': 95000.0}
+    assert len(provider.calls) == 2 and service.last_error is not None
+    asyncio.run(service.aclose())
+    assert provider.closed
+
+
+def test_missing_quote_file_is_quiet(tmp_path, caplog):
+    service = QuoteService(FileQuoteProvider(str(tmp_path / 'khong-co.json')), ttl=0)
+    with caplog.at_level(logging.INFO):
+        for _ in range(3): assert asyncio.run(service.get_prices(['FPT'])) == {}
+    assert not [r for r in caplog.records if r.levelno >= logging.WARNING]
+    assert len(caplog.records) == 1 and service.last_error is None
+
+
+@pytest.fixture
+def holdings(uid, monkeypatch):
+    """Tài khoản có FPT 100 và VNM 50; chỉ FPT có giá thị trường"""
+    provider = StubProvider({'FPT': 120000.0})
+    monkeypatch.setattr(sm, 'quote_service', QuoteService(provider, ttl=60))
+    sm.stock_manager.update_stock_cash(uid, 20_000_000)
+    for symbol, qty, price in [('FPT', 100, 100000), ('VNM', 50, 60000)]:
+        assert sm.stock_manager.execute_order(uid, symbol, qty, price)[0]
+    return provider
+
+
+def test_live_summary_marks_to_market(uid, holdings):
+    p = asyncio.run(sm.stock_manager.get_live_summary(uid))
+    by_symbol = {h['symbol']: h for h in p['holdings']}
+    assert by_symbol['FPT']['market_value'] == pytest.approx(12_000_000)
+    assert by_symbol['FPT']['unrealized_pnl'] == pytest.approx(12_000_000 - 100 * 100000 * 1.001)
+    # Mã không có giá: định giá theo giá vốn, không lãi/lỗ
+    assert by_symbol['VNM']['market_price'] is None and by_symbol['VNM']['unrealized_pnl'] == 0
+    assert p['nav'] == pytest.approx(p['cash'] + 12_000_000 + by_symbol['VNM']['total_cost'])
+    assert holdings.calls == [['FPT', 'VNM']]
+
+
+def test_portfolio_view_shows_market_prices(uid, holdings):
+    block = asyncio.run(bot_main.get_holdings_block(uid))
+    assert "FPT: 100 × 120,000" in block and "VNM: 50 × giá vốn" in block
+    # Chưa có cổ phiếu: không hiện khối và không gọi nguồn giá
+    assert asyncio.run(bot_main.get_holdings_block(uid + 10_000)) == ""
+    assert len(holdings.calls) == 1
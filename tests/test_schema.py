@@ -0,0 +1,65 @@
+import random
+import pytest
+from schema import verify_totals, rebuild_totals, rebuild_series, rebuild_rollups
+
+CATEGORIES, TYPES = ['Crypto', 'Stock', 'Cash', None], ['Nạp', 'Rút', 'Khác', None]
+AGGREGATES = {
+    'tx_totals': "SELECT user_id, category, type, total, cnt FROM tx_totals WHERE user_id IN ({}) AND (cnt != 0 OR total != 0)",
+    'daily_flows': "SELECT user_id, date, category, net_flow, cnt FROM daily_flows WHERE user_id IN ({}) AND (cnt != 0 OR net_flow != 0)",
+    'period_rollups': "SELECT user_id, month, category, inflow, outflow, cnt FROM period_rollups WHERE user_id IN ({}) AND (cnt != 0 OR inflow != 0 OR outflow != 0)",
+}
+
+
+def random_row(rng, users):
+    date = f"2024-{rng.randint(1, 3):02d}-{rng.randint(1, 28):02d}" + rng.choice(['', ' 09:30'])
+    return rng.choice(users), rng.choice(CATEGORIES), rng.choice(TYPES), rng.choice([None, float(rng.randint(1, 500) * 1000)]), date
+
+
+def mutate(c, rng, users, steps):
+    """Thêm/sửa/xóa ngẫu nhiên giao dịch của `users`, có cả đổi user_id/ngày và giá trị NULL"""
+    for _ in range(steps):
+        ids = [r[0] for r in c.execute(f"SELECT id FROM transactions WHERE user_id IN ({','.join('?' * len(users))})", users)]
+        op = rng.random()
+        if op < 0.5 or not ids:
+            c.execute("INSERT INTO transactions (user_id, category, type, amount, date, note) VALUES (?, ?, ?, ?, ?, '')", random_row(rng, users))
+        elif op < 0.8:
+            col, value = rng.choice(list(zip(('user_id', 'category', 'type', 'amount', 'date'), random_row(rng, users))))
+            c.execute(f"UPDATE transactions SET {col} = ? WHERE id = ?", (value, rng.choice(ids)))
+        else:
+            c.execute("DELETE FROM transactions WHERE id = ?", (rng.choice(ids),))
+
+
+def aggregates(c, users):
+    marks = ','.join('?' * len(users))
+    return {name: sorted(c.execute(sql.format(marks), users).fetchall()) for name, sql in AGGREGATES.items()}
+
+
+def assert_same(a, b):
+    for name in AGGREGATES:
+        assert [r[:-2] for r in a[name]] == [r[:-2] for r in b[name]], name
+        assert [r[-2:] for r in a[name]] == pytest.approx([r[-2:] for r in b[name]]), name
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_triggers_match_rebuild_after_random_changes(database, seed):
+    rng = random.Random(seed)
+    users = [9_000 + 10 * seed, 9_001 + 10 * seed]
+    with database.writer() as c:
+        mutate(c, rng, users, 300)
+        assert verify_totals(c, rebuild=False) == []
+        incremental = aggregates(c, users)
+        rebuild_totals(c); rebuild_series(c); rebuild_rollups(c)
+        assert_same(incremental, aggregates(c, users))
+
+
+def test_verify_totals_reports_and_repairs_drift(database):
+    users = [9_100]
+    with database.writer() as c:
+        mutate(c, random.Random(42), users, 50)
+        expected = aggregates(c, users)
+        c.execute("UPDATE tx_totals SET total = total + 1000 WHERE user_id = ?", users)
+        c.execute("DELETE FROM daily_flows WHERE user_id = ?", users)
+        c.execute("UPDATE period_rollups SET cnt = cnt + 1 WHERE user_id = ?", users)
+        assert {k[0] for k in verify_totals(c)} == set(users)
+        assert verify_totals(c, rebuild=False) == []
+        assert_same(expected, aggregates(c, users))
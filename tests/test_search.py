@@ -0,0 +1,62 @@
+import pytest
+from main import parse_amount
+from search import parse_query, fts_query, load_page
+
+NOTES = [
+    ('2024-01-05', 'Cash', 'Nạp', 5_000_000, 'Lương tháng 1'),
+    ('2024-02-05', 'Cash', 'Nạp', 5_000_000, 'lương tháng 2 NEAR cuối tháng'),
+    ('2024-02-10', 'Crypto', 'Rút', 2_000_000, 'rút về ví "lạnh" *khẩn*'),
+    ('2024-03-01', 'Stock', 'Nạp', 10_000_000, 'thưởng tết - bù trừ'),
+    ('2024-03-05', 'Cash', 'Rút', 300_000, 'ăn uống NOT lương'),
+]
+
+
+@pytest.fixture
+def notes(database, uid):
+    with database.writer() as c:
+        c.executemany("INSERT INTO transactions (user_id, date, category, type, amount, note) VALUES (?, ?, ?, ?, ?, ?)",
+                      [(uid, *n) for n in NOTES] + [(-uid, '2024-04-01', 'Cash', 'Nạp', 1, 'lương người khác')])
+    return uid
+
+
+def search(database, uid, text):
+    with database.reader() as c:
+        rows, _, summary = load_page(c, uid, parse_query(text, parse_amount))
+    return [r[5] for r in rows], summary
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('"lạnh"', ['rút về ví "lạnh" *khẩn*']),
+    ('khẩn*', ['rút về ví "lạnh" *khẩn*']),
+    ('NEAR', ['lương tháng 2 NEAR cuối tháng']),
+    ('NEAR(cuối', ['lương tháng 2 NEAR cuối tháng']),
+    ('NOT', ['ăn uống NOT lương']),
+    ('bù-trừ', ['thưởng tết - bù trừ']),
+    ('-', []),
+    ('note:thưởng', []),
+    ('^ăn', ['ăn uống NOT lương']),
+])
+def test_fts_syntax_in_keywords_is_literal(database, notes, text, expected):
+    # Toán tử/ký tự đặc biệt của FTS5 chỉ là chữ thường trong ghi chú, không gây lỗi cú pháp
+    assert search(database, notes, text)[0] == expected
+
+
+def test_quotes_are_doubled_inside_phrase():
+    assert fts_query(7, ['a"b', 'c']) == 'user_id : "7" AND note : ("a""b"* "c"*)'
+
+
+def test_prefix_diacritics_and_all_words_required(database, notes):
+    # Tiền tố, không dấu/không phân biệt hoa thường; mọi từ đều phải khớp; chỉ trong ghi chú của chính người dùng
+    assert search(database, notes, 'luong')[0] == ['ăn uống NOT lương', 'lương tháng 2 NEAR cuối tháng', 'Lương tháng 1']
+    assert search(database, notes, 'luo thang 1')[0] == ['Lương tháng 1']
+    assert search(database, notes, 'luong khác')[0] == []
+
+
+def test_results_rank_newest_first_with_filters_and_summary(database, notes):
+    # Kết quả xếp theo ngày giảm dần (cùng thứ tự với màn lịch sử), bộ lọc áp trên kết quả FTS
+    notes_found, summary = search(database, notes, 'lương nạp')
+    assert notes_found == ['lương tháng 2 NEAR cuối tháng', 'Lương tháng 1']
+    assert summary == (2, 10_000_000, 0)
+    assert search(database, notes, 'lương 02/2024')[0] == ['lương tháng 2 NEAR cuối tháng']
+    assert search(database, notes, 'tháng >6tr')[0] == []
+    assert search(database, notes, 'stock')[0] == ['thưởng tết - bù trừ']
@@ -0,0 +1,86 @@
+import socket
+import asyncio
+import httpx
+import pytest
+from telegram import Update
+from telegram.ext import Application, MessageHandler, filters
+import main as bot_main
+import ai_assistant
+from ai_cache import AdviceCache
+
+
+@pytest.fixture
+def app(stub, monkeypatch):
+    monkeypatch.setattr(ai_assistant, 'GEMINI_BASE_URL', f"{stub.url}/v1beta")
+    ai = ai_assistant.PortfolioAI()
+    ai.api_key, ai.cache = 'test-key', AdviceCache(path='')
+    events = []
+
+    @bot_main.per_chat
+    async def handler(update, context):
+        chat, text = update.effective_chat.id, update.message.text
+        events.append(('start', chat, text))
+        if text == 'ai':
+            placeholder = await update.message.reply_text("⌛")
+            await bot_main.stream_to_message(placeholder, ai.stream_advice(text, 'dữ liệu', chat))
+        else:
+            await update.message.reply_text("ok")
+        events.append(('end', chat, text))
+
+    application = Application.builder().token('1:TEST').base_url(f"{stub.url}/bot").concurrent_updates(8).build()
+    application.add_handler(MessageHandler(filters.TEXT, handler))
+    application.events, application.ai = events, ai
+    return application
+
+
+def message(update_id, chat, text):
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'date': 0, 'text': text,
+                                                'chat': {'id': chat, 'type': 'private'}, 'from': {'id': chat, 'is_bot': False, 'first_name': 'u'}}}
+
+
+async def drain(app, count, timeout=10):
+    async with asyncio.timeout(timeout):
+        while sum(1 for e in app.events if e[0] == 'end') < count: await asyncio.sleep(0.02)
+
+
+def test_other_chats_are_not_blocked_and_same_chat_is_ordered(stub, app):
+    stub.models = {'a-flash': ('slow', 1, ["trả lời chậm"])}
+
+    async def go():
+        async with app:
+            await app.start()
+            for i, (chat, text) in enumerate([(1, 'ai'), (2, 'xin chào'), (1, 'tiếp')]):
+                await app.update_queue.put(Update.de_json(message(i + 1, chat, text), app.bot))
+            await drain(app, 3)
+            await app.stop(); await app.ai.aclose()
+    asyncio.run(go())
+
+    ev = app.events
+    # Chat 2 được trả lời trong lúc chat 1 còn đang chờ AI
+    assert ev.index(('end', 2, 'xin chào')) < ev.index(('end', 1, 'ai'))
+    # Tin tiếp theo của chat 1 chỉ bắt đầu khi tin trước đã xong
+    assert ev.index(('start', 1, 'tiếp')) > ev.index(('end', 1, 'ai'))
+    assert stub.tg('editMessageText')[-1]['text'] == "trả lời chậm"
+
+
+def test_webhook_checks_secret_token(stub, app):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0)); port = s.getsockname()[1]
+
+    async def go():
+        async with app:
+            await app.updater.start_webhook(listen='127.0.0.1', port=port, url_path='hook',
+                                            webhook_url=f"http://127.0.0.1:{port}/hook", secret_token='s3cret')
+            await app.start()
+            async with httpx.AsyncClient() as client:
+                bad = await client.post(f"http://127.0.0.1:{port}/hook", json=message(1, 5, 'sai khóa'),
+                                        headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+                good = await client.post(f"http://127.0.0.1:{port}/hook", json=message(2, 5, 'đúng khóa'),
+                                         headers={'X-Telegram-Bot-Api-Secret-Token': 's3cret'})
+            await drain(app, 1)
+            await app.updater.stop(); await app.stop()
+        return bad.status_code, good.status_code
+    assert asyncio.run(go()) == (403, 200)
+
+    assert stub.tg('setWebhook')[0]['secret_token'] == 's3cret'
+    assert [e for e in app.events if e[0] == 'end'] == [('end', 5, 'đúng khóa')]